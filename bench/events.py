@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Tuple, Iterator, Optional
+
+from synthetic import SyntheticGuild, EMOJI, OTHER_EMOJIS, iso
+
+from discord.utils import time_snowflake
+
+from cache import MemoryCache, GitCache
+from Client import create_client, Client
+from histogram import ReactionHistogram
+
+# Gateway event storm: feeds gateway payloads into the client's parsers (the same entrypoint the websocket uses) at
+# fixed rates, without a connection. Per rate prints JSON: achieved events/s, end-to-end latency percentiles (parser
+# call -> handler done), the most handlers/raw persists/queued GitCache writes at once (backlog, and the GitCache's part
+# of it), and cache growth.
+# Where the backlog keeps growing and the drain time goes up, ingestion is saturated.
+#
+# python3 ./bench/events.py [--rates 100 1000 10000] [--seconds 5] [--mix MESSAGE_CREATE=5,MESSAGE_REACTION_ADD=3] [--raw] [--git [--git-executor thread]]
+# python3 ./bench/events.py --replay events.jsonl # Lines of gateway payloads ({"t": ..., "d": ...}) or persisted RawEvents
+
+DEFAULT_MIX = {'MESSAGE_CREATE': 5, 'MESSAGE_REACTION_ADD': 3, 'MESSAGE_REACTION_REMOVE': 1, 'MESSAGE_UPDATE': 0.5, 'MESSAGE_DELETE': 0.5}
+
+class Storm:
+
+    def __init__(self, synthetic: SyntheticGuild, seed: int = 0):
+        self.synthetic = synthetic
+        self.rng = random.Random(seed)
+        self.recent: List[Tuple[int, int]] = [] # (channel_id, message_id), targets for reactions/edits/deletes
+        self.sequence = 0
+
+    def message_id(self) -> int:
+        self.sequence += 1
+        return time_snowflake(datetime.now(timezone.utc)) + self.sequence % 4096
+
+    def target(self) -> Tuple[int, int]:
+        if not self.recent: self.recent.append(self.create()[1])
+        return self.rng.choice(self.recent)
+
+    def create(self) -> Tuple[Dict[str, Any], Tuple[int, int]]:
+        channel_id = self.rng.choice(self.synthetic.channel_ids)
+        message_id = self.message_id()
+        self.recent = [*self.recent[-999:], (channel_id, message_id)]
+        return dict(self.synthetic.message(channel_id, message_id), guild_id=str(self.synthetic.id)), (channel_id, message_id)
+
+    def reaction(self) -> Dict[str, Any]:
+        channel_id, message_id = self.target()
+        emoji = self.rng.choice((str(EMOJI), *OTHER_EMOJIS))
+        return {
+            'user_id': str(self.rng.choice(self.synthetic.members)), 'channel_id': str(channel_id), 'message_id': str(message_id), 'guild_id': str(self.synthetic.id),
+            'emoji': {'id': str(EMOJI.id), 'name': EMOJI.name} if emoji == str(EMOJI) else {'id': None, 'name': emoji}, 'burst': False, 'type': 0,
+        }
+
+    def payload(self, name: str) -> Dict[str, Any]:
+        if name == 'MESSAGE_CREATE': return self.create()[0]
+        if name in ('MESSAGE_REACTION_ADD', 'MESSAGE_REACTION_REMOVE'): return self.reaction()
+
+        channel_id, message_id = self.target()
+        if name == 'MESSAGE_UPDATE': return dict(self.synthetic.message(channel_id, message_id), guild_id=str(self.synthetic.id), content='edited', edited_timestamp=iso(datetime.now(timezone.utc)))
+        if name == 'MESSAGE_DELETE': return {'id': str(message_id), 'channel_id': str(channel_id), 'guild_id': str(self.synthetic.id)}
+        raise NotImplementedError(name)
+
+    def events(self, mix: Dict[str, float]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        names, weights = list(mix), list(mix.values())
+        while True:
+            name = self.rng.choices(names, weights=weights)[0]
+            yield name, self.payload(name)
+
+def replayed(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    events = []
+    for line in open(path):
+        if not line.strip(): continue
+        event = json.loads(line)
+        events.append((event.get('t', event.get('name')), event.get('d', event.get('data'))))
+
+    while True: yield from events
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class Probe:
+
+    # Times every scheduled handler from the parser call that dispatched it until it's done
+    def __init__(self, client: Client):
+        self.client = client
+        self.ingested_at = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.max_mirror_backlog = 0
+        self.latencies: List[float] = []
+
+        schedule = client._schedule_event
+        def timed_schedule(coro, event_name: str, *args, **kwargs) -> asyncio.Task:
+            ingested_at = self.ingested_at
+            self.in_flight += 1
+
+            def done(task: asyncio.Task) -> None:
+                self.in_flight -= 1
+                self.latencies.append(time.perf_counter() - ingested_at)
+
+            task = schedule(coro, event_name, *args, **kwargs)
+            task.add_done_callback(done)
+            return task
+
+        client._schedule_event = timed_schedule
+
+    # Handlers and raw persists in flight, and what the GitCache mirror still has queued in its lanes
+    def backlog(self) -> int: return self.in_flight + len(self.client.raw_tasks) + self.mirror_backlog()
+    def mirror_backlog(self) -> int:
+        git = self.client.cache.mirror(GitCache)
+        return 0 if git is None else git.pending()
+
+    def feed(self, name: str, data: Dict[str, Any]) -> None:
+        self.ingested_at = time.perf_counter()
+        self.client._connection.parsers[name](data)
+        self.max_in_flight = max(self.max_in_flight, self.backlog())
+        self.max_mirror_backlog = max(self.max_mirror_backlog, self.mirror_backlog())
+
+async def storm(client: Client, probe: Probe, events: Iterator[Tuple[str, Dict[str, Any]]], rate: float, seconds: float, tick: float = 0.01) -> Dict[str, Any]:
+    probe.latencies, probe.max_in_flight, probe.max_mirror_backlog = [], 0, 0
+    cached = client.cache.count()
+
+    start = time.perf_counter()
+    fed = 0
+    while (elapsed := time.perf_counter() - start) < seconds:
+        for i in range(int(rate * elapsed) - fed):
+            probe.feed(*next(events))
+            fed += 1
+        await asyncio.sleep(tick)
+    fed_at = time.perf_counter() - start
+
+    while probe.backlog() > 0: await asyncio.sleep(tick) # Drain
+    drained_at = time.perf_counter() - start
+
+    return {
+        'fed': fed,
+        'fed_per_second': fed / fed_at,
+        'handled_per_second': len(probe.latencies) / drained_at,
+        'drain_seconds': drained_at - fed_at,
+        'latency': {f'p{int(q * 100)}': percentile(probe.latencies, q) for q in (0.5, 0.95, 0.99)} | {'max': max(probe.latencies, default=None)},
+        'max_backlog': probe.max_in_flight,
+        'max_mirror_backlog': probe.max_mirror_backlog,
+        'cache_growth': client.cache.count() - cached,
+        'cache_size': client.cache.count(),
+    }
+
+async def main_async(args: argparse.Namespace) -> Dict[str, Any]:
+    with contextlib.ExitStack() as stack:
+        mirrors = [ReactionHistogram()]
+        if args.git:
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO())) # GitCache prints every write
+            mirrors.append(GitCache(repository='', directory=stack.enter_context(tempfile.TemporaryDirectory()), branch='', executor=args.git_executor))
+
+        client = create_client(cache=MemoryCache(mirrors=mirrors), raw_events=args.raw)
+        await client._async_setup_hook() # The loop, without logging in
+
+        synthetic = SyntheticGuild(messages=args.messages, seed=args.seed)
+        synthetic.create(state=client._connection)
+
+        probe = Probe(client)
+        events = replayed(args.replay) if args.replay else Storm(synthetic, seed=args.seed).events(args.mix)
+        result = {
+            'options': {key: value for key, value in vars(args).items() if key != 'rates'},
+            'rates': {rate: await storm(client, probe, events, rate, args.seconds) for rate in args.rates},
+        }
+        await client.cache.close()
+        return result
+
+def main():
+    def mix(value: str) -> Dict[str, float]:
+        return {name: float(weight) for name, weight in map(lambda part: part.split('='), value.split(','))}
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rates', type=float, nargs='+', default=[100, 1_000, 10_000], help='Events per second')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--mix', type=mix, default=DEFAULT_MIX, help='Synthetic event weights, ex: MESSAGE_CREATE=5,MESSAGE_REACTION_ADD=3')
+    parser.add_argument('--replay', type=str, default=None, help='Replay recorded events instead')
+    parser.add_argument('--raw', action='store_true', help='Persist the raw gateway payloads (BOT_CACHE_RAW_EVENTS=1)')
+    parser.add_argument('--git', action='store_true', help='Also mirror to a GitCache in a temporary directory')
+    parser.add_argument('--git-executor', choices=('thread', 'process'), default=None, help='Write the GitCache through a pool (BOT_CACHE_GIT_EXECUTOR)')
+    parser.add_argument('--messages', type=int, default=10_000, help='Size of the synthetic guild')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    print(json.dumps(result, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import platform
+import tempfile
+import time
+from typing import Dict, Any, Callable, Awaitable, List
+
+from synthetic import SyntheticGuild, SyntheticHTTP, EMOJI
+
+from cache import MemoryCache, GitCache, CacheEntry, DiscordTraverser
+from Count import ReactionCounter
+from histogram import ReactionHistogram
+
+# Cache and traversal hot paths against a synthetic guild, prints JSON (per size, per benchmark: seconds, ops, us/op):
+#  - crawl: a full DiscordTraverser crawl of the guild (history pages, reactors of the tracked emoji) into a MemoryCache
+#  - push_entry: MemoryCache.push_entry of everything the crawl cached, into an empty cache
+#  - to_dict: CacheEntry.to_dict
+#  - header: ReactionCounter.header()
+#  - list: the `list` leaderboard chain (leaderboard, count, top entries and their messages)
+#  - git_push_entry: GitCache.push_entry into a temporary directory
+#
+# python3 ./bench/hotpaths.py [--sizes 10000 100000 1000000] [--latency 0.05] [--limit 5 --window 5] [--output results.json]
+
+def result(seconds: float, ops: int) -> Dict[str, Any]:
+    return dict(seconds=seconds, ops=ops, us_per_op=seconds / max(ops, 1) * 1_000_000)
+
+def timed(func: Callable[[], Any], ops: int, runs: int) -> Dict[str, Any]:
+    def once() -> float:
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    return result(min(once() for i in range(runs)), ops)
+
+async def timed_async(func: Callable[[], Awaitable[Any]], ops: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    await func()
+    return result(time.perf_counter() - start, ops)
+
+async def bench(size: int, args: argparse.Namespace) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+
+    start = time.perf_counter()
+    synthetic = SyntheticGuild(messages=size, seed=args.seed)
+    http = SyntheticHTTP(synthetic, latency=args.latency, limit=args.limit, window=args.window)
+    guild = synthetic.create(http)
+    results['generate'] = result(time.perf_counter() - start, size)
+
+    cache = MemoryCache(mirrors=[ReactionHistogram()])
+    traverser = DiscordTraverser(cache=cache, options=DiscordTraverser.Options(before=None, after=None, emojis=[EMOJI]))
+    async def crawl():
+        await traverser.push(guild)
+        await traverser.join()
+    results['crawl'] = dict(**await timed_async(crawl, size), requests=dict(http.requests), rate_limited=http.rate_limited, cached=cache.count())
+
+    entries: List[CacheEntry] = cache.entries()
+    async def push_entries():
+        target = MemoryCache()
+        for entry in entries: await target.push_entry(CacheEntry(current=entry.current))
+    results['push_entry'] = await timed_async(push_entries, len(entries))
+
+    sample = entries[:args.sample]
+    results['to_dict'] = timed(lambda: [entry.to_dict() for entry in sample], len(sample), args.runs)
+
+    counter = ReactionCounter(ctx=None, cache=cache, options=ReactionCounter.Options(emojis=[EMOJI], guilds=None, channels=None, before=None, after=None, skip_cache=False))
+    results['header'] = timed(counter.header, 1, args.runs)
+
+    def list_chain():
+        top = counter.leaderboard(group_by='message_id')
+        entries = list(top.current())[:3]
+        return top.count(), [counter.cache.messages.get(id=group.key) for group in entries]
+    results['list'] = timed(list_chain, 1, args.runs)
+
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        git = GitCache(repository='', directory=directory, branch='')
+        git_sample = entries[:args.git_sample]
+        async def git_push_entries():
+            for entry in git_sample: await git.push_entry(entry)
+        results['git_push_entry'] = await timed_async(git_push_entries, len(git_sample))
+
+    traverser.cancel()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--runs', type=int, default=3, help='Best of, for the synchronous benchmarks')
+    parser.add_argument('--sample', type=int, default=10_000, help='Entries for to_dict')
+    parser.add_argument('--git-sample', type=int, default=2_000, help='Entries written to the GitCache (disk)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds per simulated Discord request')
+    parser.add_argument('--limit', type=int, default=None, help='Simulated rate limit: requests per route + channel per window')
+    parser.add_argument('--window', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    output = json.dumps({
+        'python': platform.python_version(),
+        'options': {key: value for key, value in vars(args).items() if key not in ('sizes', 'output')},
+        'sizes': {size: asyncio.run(bench(size, args)) for size in args.sizes},
+    }, indent=2)
+
+    if args.output: open(args.output, 'w').write(output)
+    print(output)
+
+if __name__ == '__main__':
+    main()
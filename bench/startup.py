@@ -0,0 +1,57 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+# Startup benchmark, prints JSON:
+#  - import: seconds to import each module, each in a fresh interpreter
+#  - ready: seconds from Client.start to each phase (cache, login, connect, guild, guilds, ready) - needs DISCORD_TOKEN
+#
+# python3 ./bench/startup.py [--runs 5] [--ready]
+
+BOT_DIRECTORY = Path(__file__).resolve().parent.parent / 'bot'
+sys.path.insert(0, str(BOT_DIRECTORY))
+
+MODULES = ['discord', 'records', 'scheduler', 'cache', 'converters', 'Count', 'Client', 'oauth2_url']
+
+def import_time(module: str) -> float:
+    code = (f'import sys, time; sys.path.insert(0, {str(BOT_DIRECTORY)!r}); sys.argv = [""]; '
+            f'start = time.perf_counter(); import {module}; print(time.perf_counter() - start)')
+    env = dict(os.environ, DISCORD_CLIENT_ID=os.environ.get('DISCORD_CLIENT_ID', '0'))
+    return float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, env=env).stdout.strip().splitlines()[-1])
+
+async def ready_time() -> dict:
+    from Client import create_client, setup
+    from cache import MemoryCache
+
+    # Without BOT_CACHE_GIT_REPOSITORY this skips the clone/fetch of the GitCache
+    client = create_client(cache=None if "BOT_CACHE_GIT_REPOSITORY" in os.environ else MemoryCache())
+
+    async def close_when_ready():
+        await client.wait_until_ready()
+        await client.close()
+
+    async with client:
+        await setup(client)
+        await asyncio.gather(client.start(os.environ["DISCORD_TOKEN"]), close_when_ready())
+
+    return client.startup
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--ready', action='store_true', help='Also log in and measure until ready (needs DISCORD_TOKEN)')
+    args = parser.parse_args()
+
+    result = {
+        'import': {module: min(import_time(module) for i in range(args.runs)) for module in MODULES},
+    }
+    if args.ready: result['ready'] = asyncio.run(ready_time())
+
+    print(json.dumps(result, indent=2))
+
+if __name__ == '__main__':
+    main()
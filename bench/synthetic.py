@@ -0,0 +1,186 @@
+import asyncio
+import random
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Tuple
+
+BOT_DIRECTORY = Path(__file__).resolve().parent.parent / 'bot'
+sys.path.insert(0, str(BOT_DIRECTORY))
+
+from discord import Guild, Intents, PartialEmoji
+from discord.ext import commands
+from discord.state import ConnectionState
+from discord.utils import time_snowflake, snowflake_time
+
+# A fake guild, served to discord.py through a stand-in for its HTTPClient: channel.history(), reaction.users() and
+# archived_threads() run discord.py's own pagination against it. Message payloads aren't stored, they're generated
+# from their id, so a guild of 1M messages only costs its ids.
+#
+# from synthetic import SyntheticGuild
+# guild = SyntheticGuild(messages=100_000).create() # a discord.Guild, with the fake HTTPClient on its state
+
+END = datetime(2024, 1, 1, tzinfo=timezone.utc)
+EMOJI = PartialEmoji(name='semfcoin', id=1000)
+OTHER_EMOJIS = ('👍', '😂', '🔥')
+
+def iso(at: datetime) -> str: return at.isoformat()
+
+class SyntheticGuild:
+
+    def __init__(self, messages: int, channels: int = 16, threads: Optional[int] = None, members: Optional[int] = None, days: int = 365, seed: int = 0, reacted: float = 0.15):
+        self.seed = seed
+        self.reacted = reacted # Share of messages with the tracked emoji
+        self.rng = random.Random(seed)
+        self.id = time_snowflake(END - timedelta(days=days + 30))
+
+        self.members = [self.id + 1 + index for index in range(members or max(50, min(5_000, messages // 100)))]
+        self.channel_ids = [self.id + 10_000 + index for index in range(channels)]
+        # Threads live in the busier channels, half of them archived
+        self.threads: Dict[int, Tuple[int, bool]] = {
+            self.id + 20_000 + index: (self.channel_ids[min(int(self.rng.paretovariate(1.2)) - 1, channels - 1)], index % 2 == 1)
+            for index in range(channels * 2 if threads is None else threads)
+        }
+
+        # Zipf-like activity: a few channels (and threads) and a few members produce most messages
+        messageables = [*self.channel_ids, *self.threads]
+        weights = [1 / (rank + 1) for rank in range(len(messageables))]
+        start = END - timedelta(days=days)
+        times = sorted(self.rng.random() for i in range(messages))
+
+        self.messages: Dict[int, array] = {channel_id: array('Q') for channel_id in messageables}
+        for index, (at, channel_id) in enumerate(zip(times, self.rng.choices(messageables, weights=weights, k=messages))):
+            self.messages[channel_id].append(time_snowflake(start + timedelta(days=days * at)) + index % 4096)
+
+    def __len__(self) -> int: return sum(map(len, self.messages.values()))
+
+    # Payloads
+
+    def user(self, user_id: int) -> Dict[str, Any]:
+        return {'id': str(user_id), 'username': f'member{user_id - self.id}', 'discriminator': '0', 'global_name': None, 'avatar': None, 'bot': False}
+
+    def author(self, message_id: int) -> int:
+        return self.members[int(len(self.members) * random.Random(message_id).random() ** 3)]
+
+    def reactions(self, message_id: int) -> Dict[str, int]: # emoji -> count
+        rng = random.Random(message_id ^ self.seed)
+        reactions = {}
+        if rng.random() < self.reacted: reactions[str(EMOJI)] = min(len(self.members), 1 + int(rng.expovariate(0.4)))
+        for emoji in OTHER_EMOJIS:
+            if rng.random() < 0.05: reactions[emoji] = min(len(self.members), 1 + int(rng.expovariate(0.6)))
+        return reactions
+
+    def reactors(self, message_id: int, emoji: str) -> List[int]:
+        count = self.reactions(message_id).get(emoji, 0)
+        return sorted(random.Random(f'{message_id}:{emoji}').sample(self.members, count))
+
+    def message(self, channel_id: int, message_id: int) -> Dict[str, Any]:
+        rng = random.Random(message_id)
+
+        def reaction(emoji: str, count: int) -> Dict[str, Any]:
+            return {
+                'emoji': {'id': str(EMOJI.id), 'name': EMOJI.name, 'animated': False} if emoji == str(EMOJI) else {'id': None, 'name': emoji},
+                'count': count, 'count_details': {'burst': 0, 'normal': count}, 'me': False, 'me_burst': False, 'burst_colors': [],
+            }
+
+        return {
+            'id': str(message_id), 'channel_id': str(channel_id), 'author': self.user(self.author(message_id)),
+            'content': 'lorem ipsum ' * int(rng.lognormvariate(1.5, 1)), 'timestamp': iso(snowflake_time(message_id)), 'edited_timestamp': None,
+            'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0,
+            'reactions': [reaction(emoji, count) for emoji, count in self.reactions(message_id).items()],
+        }
+
+    def channel(self, channel_id: int) -> Dict[str, Any]:
+        return {
+            'id': str(channel_id), 'type': 0, 'name': f'channel-{channel_id - self.id}', 'guild_id': str(self.id), 'position': channel_id - self.id,
+            'permission_overwrites': [], 'parent_id': None, 'nsfw': False, 'topic': None, 'rate_limit_per_user': 0,
+            'last_message_id': str(self.messages[channel_id][-1]) if self.messages[channel_id] else None,
+        }
+
+    def thread(self, thread_id: int) -> Dict[str, Any]:
+        parent_id, archived = self.threads[thread_id]
+        return {
+            'id': str(thread_id), 'type': 11, 'name': f'thread-{thread_id - self.id}', 'guild_id': str(self.id), 'parent_id': str(parent_id),
+            'owner_id': str(self.members[0]), 'message_count': len(self.messages[thread_id]), 'member_count': 1, 'rate_limit_per_user': 0,
+            'thread_metadata': {'archived': archived, 'auto_archive_duration': 1440, 'archive_timestamp': iso(END), 'locked': False},
+            'last_message_id': str(self.messages[thread_id][-1]) if self.messages[thread_id] else None,
+        }
+
+    def payload(self) -> Dict[str, Any]:
+        return {
+            'id': str(self.id), 'name': 'Synthetic', 'owner_id': str(self.members[0]), 'unavailable': False, 'large': True, 'features': [],
+            'roles': [{'id': str(self.id), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False, 'flags': 0}],
+            'emojis': [{'id': str(EMOJI.id), 'name': EMOJI.name, 'roles': [], 'require_colons': True, 'managed': False, 'animated': False, 'available': True}],
+            'stickers': [], 'presences': [], 'voice_states': [], 'stage_instances': [], 'guild_scheduled_events': [],
+            'channels': list(map(self.channel, self.channel_ids)),
+            'threads': [self.thread(thread_id) for thread_id, (parent_id, archived) in self.threads.items() if not archived],
+            'members': [{'user': self.user(member), 'roles': [], 'joined_at': iso(snowflake_time(self.id)), 'deaf': False, 'mute': False, 'flags': 0} for member in self.members],
+            'member_count': len(self.members),
+        }
+
+    # Onto a client's state (for dispatching events into it), or a throwaway one
+    def create(self, http: Optional['SyntheticHTTP'] = None, state: Optional[ConnectionState] = None) -> Guild:
+        state = state or commands.Bot(command_prefix='$', intents=Intents.all())._connection
+        state.http = http or SyntheticHTTP(self)
+
+        guild = Guild(data=self.payload(), state=state)
+        state._add_guild(guild)
+        return guild
+
+# Stand-in for discord.HTTPClient, with a latency per request and Discord-like rate limits per route + channel
+# (a bucket of `limit` requests per `window` seconds; going over waits for the reset and counts as a 429)
+class SyntheticHTTP:
+
+    def __init__(self, guild: SyntheticGuild, latency: float = 0.0, limit: Optional[int] = None, window: float = 1.0):
+        self.guild = guild
+        self.latency = latency
+        self.limit = limit
+        self.window = window
+
+        self.requests: Counter = Counter()
+        self.rate_limited = 0
+        self.buckets: Dict[Tuple[str, int], Tuple[float, int]] = {} # -> (reset at, remaining)
+
+    async def request(self, route: str, channel_id: int) -> None:
+        self.requests[route] += 1
+
+        if self.limit is not None:
+            while True:
+                now = time.perf_counter()
+                reset_at, remaining = self.buckets.get((route, channel_id), (now + self.window, self.limit))
+                if now >= reset_at: reset_at, remaining = now + self.window, self.limit
+                if remaining > 0:
+                    self.buckets[(route, channel_id)] = (reset_at, remaining - 1)
+                    break
+
+                self.rate_limited += 1
+                await asyncio.sleep(reset_at - now)
+
+        if self.latency: await asyncio.sleep(self.latency)
+
+    async def logs_from(self, channel_id: int, limit: int, before: Optional[int] = None, after: Optional[int] = None, around: Optional[int] = None) -> List[Dict[str, Any]]:
+        await self.request('GET /channels/{channel_id}/messages', channel_id)
+        ids = self.guild.messages.get(int(channel_id), array('Q'))
+
+        end = len(ids) if before is None else bisect_left(ids, int(before))
+        start = 0 if after is None else bisect_right(ids, int(after))
+        page = ids[max(start, end - limit):end] if after is None else ids[start:min(end, start + limit)]
+        return [self.guild.message(channel_id, message_id) for message_id in reversed(page)] # newest first, like Discord
+
+    async def get_reaction_users(self, channel_id: int, message_id: int, emoji: str, limit: int, after: Optional[int] = None, type: Any = None) -> List[Dict[str, Any]]:
+        await self.request('GET /channels/{channel_id}/messages/{message_id}/reactions/{emoji}', channel_id)
+        emoji = str(EMOJI) if emoji == f'{EMOJI.name}:{EMOJI.id}' else emoji
+        users = [user_id for user_id in self.guild.reactors(int(message_id), emoji) if after is None or user_id > int(after)]
+        return list(map(self.guild.user, users[:limit]))
+
+    async def get_public_archived_threads(self, channel_id: int, before: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+        await self.request('GET /channels/{channel_id}/threads/archived/public', channel_id)
+        threads = [] if before is not None else [self.guild.thread(thread_id) for thread_id, (parent_id, archived) in self.guild.threads.items() if archived and parent_id == int(channel_id)]
+        return {'threads': threads, 'members': [], 'has_more': False}
+    async def get_private_archived_threads(self, channel_id: int, before: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+        await self.request('GET /channels/{channel_id}/threads/archived/private', channel_id)
+        return {'threads': [], 'members': [], 'has_more': False}
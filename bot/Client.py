@@ -1,71 +1,193 @@
+import asyncio
 import datetime
 import datetime
+import hashlib
+import json
 import logging.handlers
+import multiprocessing
 import os
-from typing import Union, Optional, Sequence
+import time
+from dataclasses import replace
+from pathlib import Path
+from typing import Union, Optional, Sequence, Dict, Tuple, Any, Callable, Set, List, Iterable
 
 import discord
+from aiohttp import web
 from discord import Permissions, Activity, Status, ActivityType, TextChannel, NotFound
 from discord.abc import Messageable
 from discord.ext import commands, tasks
-from discord.utils import oauth_url, get
+from discord.utils import get
 
-from Count import Count
-from cache import Cache, cached_event, MemoryCache, GitCache
+from Count import Count, LeaderboardPage
+from Stats import Stats
+from cache import Cache, CacheEntry, cached_event, MemoryCache, GitCache, RawEvent, Seen, Query, gateway_dispatch, duplicates
+from cache_service import CacheService, RemoteCache
+from api import start_api
+from backfill import Backfill
+from memory_profile import MemoryProfile
+import loop_monitor
+from metrics import instrument_http, start_exporters
+from histogram import ReactionHistogram
+from channel_index import ChannelIndex
+from records import ReactorsRecord, MessageRecord
 
 # TODO; All the environment variable gets are not secured/typed checked unless python provides it, just dumb string copying
 
 SEMFCOIN_EMOJI = discord.PartialEmoji(name=os.environ.get("SEMF_SEMFCOIN_EMOJI", 'semfcoin'))
 PRIMARY_GUILD = discord.Object(id=os.environ.get("DISCORD_GUILD_ID", 844566471501414463))
 
-# https://discordpy.readthedocs.io/en/latest/logging.html
-discord.utils.setup_logging(level=logging.INFO)
-
 # https://discordpy.readthedocs.io/en/latest/intents.html
-# intents = bot.Intents.default()
-intents = discord.Intents.all()
-# intents.message_content = True
-# intents.members = True
-# intents.reactions = True
-# intents.guilds = True
-# intents.messages = True
-# intents.emojis = True
-# intents.emojis_and_stickers = True
-# intents.moderation = True
-# intents.invites = True
-# intents.integrations = True
-# intents.webhooks = True
-# intents.guild_scheduled_events = True
-
-# https://discordpy.readthedocs.io/en/latest/api.html#permissions
-default_permissions = discord.Permissions.all()
+# Follow from the memory profile (BOT_MEMORY_PROFILE): "lean" only requests the intents for the handlers below and these
+# cache views, and leaves holding members/messages to our Cache. "full" is Intents.all() and discord.py's own caching.
+CACHE_VIEWS = ('messages', 'reactions', 'reactors', 'members', 'users', 'guilds', 'channels', 'threads', 'events')
+
+# Gateway dispatch types persisted as RawEvents in raw mode -> the cached_event handlers they replace
+# (https://discord.com/developers/docs/topics/gateway-events#receive-events)
+GATEWAY_EVENTS: Dict[str, Tuple[str, ...]] = {
+    'MESSAGE_CREATE': ('on_message',),
+    'MESSAGE_UPDATE': ('on_raw_message_edit',),
+    'MESSAGE_DELETE': ('on_raw_message_delete',),
+    'MESSAGE_DELETE_BULK': ('on_raw_bulk_message_delete',),
+    'MESSAGE_REACTION_ADD': ('on_raw_reaction_add',),
+    'MESSAGE_REACTION_REMOVE': ('on_raw_reaction_remove',),
+    'MESSAGE_REACTION_REMOVE_ALL': ('on_raw_reaction_clear',),
+    'MESSAGE_REACTION_REMOVE_EMOJI': ('on_raw_reaction_clear_emoji',),
+    'GUILD_MEMBER_ADD': ('on_member_join',),
+    'GUILD_MEMBER_REMOVE': ('on_raw_member_remove',),
+    'GUILD_MEMBER_UPDATE': ('on_member_update',),
+    'GUILD_BAN_ADD': ('on_member_ban',),
+    'GUILD_BAN_REMOVE': ('on_member_unban',),
+    'CHANNEL_CREATE': ('on_guild_channel_create',),
+    'CHANNEL_DELETE': ('on_guild_channel_delete',),
+    'CHANNEL_PINS_UPDATE': ('on_guild_channel_pins_update',),
+    'THREAD_CREATE': ('on_thread_create', 'on_thread_join'),
+    'THREAD_UPDATE': ('on_raw_thread_update',),
+    'THREAD_DELETE': ('on_raw_thread_delete',),
+    'THREAD_MEMBERS_UPDATE': ('on_thread_member_join', 'on_thread_member_remove', 'on_raw_thread_member_remove'),
+    'GUILD_ROLE_CREATE': ('on_guild_role_create',),
+    'GUILD_ROLE_DELETE': ('on_guild_role_delete',),
+    'GUILD_ROLE_UPDATE': ('on_guild_role_update',),
+}
 
 class Client(commands.Bot):
 
-    def __init__(self, cache: Cache, *args, **kwargs):
+    def __init__(self, cache: Cache, *args, raw_events: bool = False, memory_profile: Optional[MemoryProfile] = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.cache = cache
+        self.memory_profile = memory_profile
+        self.startup: Dict[str, float] = {} # phase -> seconds since start()
+        self.raw_handlers: Set[str] = set()
+        self.raw_tasks: Set[asyncio.Task] = set()
+        self.metrics_tasks: Sequence[asyncio.Task] = ()
+        self.api: Optional[web.AppRunner] = None
+        self.backfill: Optional[Backfill] = None
+
+        instrument_http(self.http)
+        self.hook_parsers(raw_events=raw_events)
+
+    # Every dispatch is parsed with its gateway identity in `gateway_dispatch` (events pushed from the handlers get it
+    # too), and with raw_events the gateway payloads are persisted before discord.py parses them into objects. (Same
+    # dicts as 'on_socket_raw_receive' would give, but without decoding the JSON a second time)
+    def hook_parsers(self, raw_events: bool) -> None:
+        parsers = self._connection.parsers
+
+        def hooked_parser(name: str, parse: Callable[[Dict[str, Any]], None], raw: bool) -> Callable[[Dict[str, Any]], None]:
+            def parser(data: Dict[str, Any]) -> None:
+                dispatch = self.dispatch_of(data)
+                if raw:
+                    # Recorded right away (not once the push task runs), so a replay arriving before then is caught too
+                    event = RawEvent.of(name, data, dispatch=dispatch)
+                    seen = self.cache.objects.seen
+                    if seen is not None and seen.duplicate(CacheEntry(current=event)): # The same dispatch again (replayed after a RESUME), already handled
+                        duplicates.inc(type='RawEvent')
+                        return
+
+                    task = asyncio.create_task(self.cache.events.push(event, checked=True))
+                    self.raw_tasks.add(task)
+                    task.add_done_callback(self.raw_tasks.discard)
+
+                token = gateway_dispatch.set(dispatch)
+                try:
+                    parse(data)
+                finally:
+                    gateway_dispatch.reset(token)
+
+            return parser
+
+        for name, parse in list(parsers.items()):
+            raw = raw_events and name in GATEWAY_EVENTS
+            parsers[name] = hooked_parser(name, parse, raw)
+            if raw: self.raw_handlers.update(GATEWAY_EVENTS[name])
+
+    # (session id, sequence) of the dispatch being parsed: the websocket that received it set it just before. That's the
+    # guild's shard, without a guild it's only known when this process runs a single shard.
+    def dispatch_of(self, data: Dict[str, Any]) -> Optional[Tuple[str, int]]:
+        try:
+            if data.get('guild_id'): ws = self._get_websocket(int(data['guild_id']))
+            elif isinstance(self, discord.AutoShardedClient): ws = self._get_websocket(shard_id=next(iter(self.shards))) if len(self.shards) == 1 else None
+            else: ws = self.ws
+        except (KeyError, AttributeError, TypeError):
+            return None
+        return None if ws is None or ws.sequence is None or ws.session_id is None else (ws.session_id, ws.sequence)
     async def setup_hook(self) -> None:
+        self.metrics_tasks = start_exporters()
+        loop_monitor.start_monitor()
+        self.api = await start_api(self.cache)
         if os.environ.get("DISCORD_SKIP_HOOK", "0") == "1": return
 
-        print(f'Setting up hook (Might take a bit)')
-
         # for extension in self.initial_extensions:
         #     await self.load_extension(extension)
 
         if PRIMARY_GUILD.id:
             self.tree.copy_global_to(guild=PRIMARY_GUILD)
+
+            # Only sync when the commands actually changed since the last sync, saves the app command rate limits on restarts
+            fingerprint = self.command_tree_fingerprint(guild=PRIMARY_GUILD)
+            fingerprint_file = Path(os.environ.get("DISCORD_COMMAND_TREE_FINGERPRINT", './.bot/command_tree.sha256'))
+            if os.environ.get("DISCORD_FORCE_SYNC", "0") != "1" and fingerprint_file.exists() and fingerprint_file.read_text() == fingerprint:
+                print(f'App commands unchanged, skipping sync')
+                return
+
+            print(f'Syncing app commands (Might take a bit)')
             await self.tree.sync(guild=PRIMARY_GUILD)
 
+            fingerprint_file.parent.mkdir(parents=True, exist_ok=True)
+            fingerprint_file.write_text(fingerprint)
+
+    def command_tree_fingerprint(self, guild: discord.abc.Snowflake) -> str:
+        commands = sorted(map(lambda command: command.to_dict(self.tree), self.tree.get_commands(guild=guild)), key=lambda command: (command['type'], command['name']))
+        return hashlib.sha256(json.dumps({'application': self.application_id, 'guild': guild.id, 'commands': commands}, sort_keys=True, default=str).encode()).hexdigest()
+
     # Client
     async def start(self, *args) -> None:
+        self.started_at = time.perf_counter()
+
         print(f'Initializing caches before starting Discord client')
         await self.cache.initialize()
+        self.mark('cache')
         print(f'Starting Discord client')
         await super().start(*args)
 
+    async def close(self) -> None:
+        if self.backfill is not None: self.backfill.cancel()
+        if loop_monitor.monitor is not None: loop_monitor.monitor.stop()
+        await super().close()
+        await self.cache.close() # Whatever mirrors still have queued (GitCache writes, ...)
+
+    async def login(self, *args) -> None:
+        await super().login(*args)
+        self.mark('login')
+
+    def mark(self, phase: str) -> None:
+        if phase not in self.startup: self.startup[phase] = time.perf_counter() - self.started_at
+
+    async def on_connect(self):
+        self.mark('connect')
+
     async def on_ready(self):
-        print(f'We have logged in as {self.user}')
+        self.mark('ready') # READY, and all guilds available (or timed out waiting on them)
+        print(f'We have logged in as {self.user} ({", ".join(f"{phase}: {seconds:.2f}s" for phase, seconds in self.startup.items())})')
+        if self.memory_profile: print(self.memory_profile.report(self))
 
         await self.change_presence(activity = Activity(
             type = ActivityType.custom,
@@ -76,6 +198,8 @@ class Client(commands.Bot):
     # Messages
     @cached_event
     async def on_message(self, message: discord.Message):
+        # Cached as it's posted, so that its reactions are counted by the events (and the ChannelIndex knows it's the newest)
+        if message.guild is not None: await self.cache.push(MessageRecord.of(message))
         # if message.author == self.user:
         #     return
         #
@@ -84,27 +208,53 @@ class Client(commands.Bot):
         pass
     @cached_event
     async def on_raw_message_edit(self, message: discord.RawMessageUpdateEvent):
-        pass
+        cached = self.cache.messages.get(id=message.message_id)
+        if cached is None: return
+
+        edited = MessageRecord.of(message.message)
+        if 'reactions' not in message.data: edited = replace(edited, reactions=cached.reactions) # Partial update
+        await self.cache.push(edited)
     @cached_event
     async def on_raw_message_delete(self, message: discord.RawMessageDeleteEvent):
-        pass
+        await self.remove_messages([message.message_id])
     @cached_event
     async def on_raw_bulk_message_delete(self, message: discord.RawBulkMessageDeleteEvent):
-        pass
+        await self.remove_messages(message.message_ids)
+
+    # The messages, and who reacted to them (also for emojis no longer on the cached message), as one batch
+    async def remove_messages(self, message_ids: Iterable[int]) -> None:
+        message_ids = list(message_ids)
+        await self.cache.remove([
+            *message_ids,
+            *(entry.id for message_id in message_ids for entry in self.cache.reactors.execute(Query(where=dict(message_id=message_id)))),
+        ])
+
+    # Reaction events on cached messages: their counts, and who reacted if we know that (delta None: cleared)
+    async def react(self, message_id: int, emoji: Optional[str], delta: Optional[int], user_id: Optional[int] = None) -> None:
+        message = self.cache.messages.get(id=message_id)
+        if message is None: return
+
+        for key in ([reaction.emoji for reaction in message.reactions] if emoji is None else [emoji]):
+            reactors = self.cache.reactors.get(id=ReactorsRecord.key(message_id, key))
+            if reactors is None: continue
+            if delta is None: await self.cache.push(replace(reactors, user_ids=()))
+            elif user_id is not None: await self.cache.push(reactors.add(user_id) if delta > 0 else reactors.remove(user_id))
+
+        await self.cache.push(message.react(emoji, delta))
 
     # Reactions
     @cached_event
     async def on_raw_reaction_add(self, reaction: discord.RawReactionActionEvent):
-        pass
+        await self.react(reaction.message_id, str(reaction.emoji), 1, user_id=None if reaction.burst else reaction.user_id) # .users() doesn't include super reactions
     @cached_event
     async def on_raw_reaction_remove(self, reaction: discord.RawReactionActionEvent):
-        pass
+        await self.react(reaction.message_id, str(reaction.emoji), -1, user_id=None if reaction.burst else reaction.user_id)
     @cached_event
     async def on_raw_reaction_clear(self, reaction: discord.RawReactionClearEvent):
-        pass
+        await self.react(reaction.message_id, None, None)
     @cached_event
     async def on_raw_reaction_clear_emoji(self, reaction: discord.RawReactionClearEmojiEvent):
-        pass
+        await self.react(reaction.message_id, str(reaction.emoji), None)
 
     # Members
     @cached_event
@@ -131,10 +281,11 @@ class Client(commands.Bot):
     # Channels
     @cached_event
     async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
-        pass
+        index = self.cache.mirror(ChannelIndex)
+        if index is not None: index.remove(channel.id)
     @cached_event
     async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
-        pass
+        await self.cache.channels.push(channel)
     @cached_event
     async def on_guild_channel_pins_update(self, channel: Union[discord.abc.GuildChannel, discord.Thread], last_pin: Optional[datetime.datetime]):
         pass
@@ -142,16 +293,22 @@ class Client(commands.Bot):
     # Threads
     @cached_event
     async def on_thread_create(self, thread: discord.Thread):
-        pass
+        await self.cache.threads.push(thread)
     @cached_event
     async def on_thread_join(self, thread: discord.Thread):
-        pass
+        await self.cache.threads.push(thread)
     @cached_event
     async def on_raw_thread_update(self, payload: discord.RawThreadUpdateEvent):
-        pass
+        if payload.thread is not None: await self.cache.threads.push(payload.thread); return
+
+        # Not in discord.py's cache (archived), just track whether it still is
+        index = self.cache.mirror(ChannelIndex)
+        thread = None if index is None else index.channels.get(payload.thread_id)
+        if thread is not None: index.update(replace(thread, archived=payload.data.get('thread_metadata', {}).get('archived', thread.archived)))
     @cached_event
     async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent):
-        pass
+        index = self.cache.mirror(ChannelIndex)
+        if index is not None: index.remove(payload.thread_id)
     @cached_event
     async def on_thread_member_join(self, member: discord.ThreadMember):
         pass
@@ -217,7 +374,8 @@ class Client(commands.Bot):
 
     # Guilds
     async def on_guild_available(self, guild: discord.Guild):
-        pass
+        self.mark('guild')
+        if all(map(lambda guild: not guild.unavailable, self.guilds)): self.mark('guilds')
     async def on_guild_unavailable(self, guild: discord.Guild):
         pass
     @cached_event
@@ -244,27 +402,89 @@ class Client(commands.Bot):
     async def on_invite_delete(self, invite: discord.Invite):
         pass
 
-async def oauth2_url(client: Client = Client(intents=intents, command_prefix='$', cache = MemoryCache()), permissions: Permissions = default_permissions) -> str:
-    # await client.login(os.environ["DISCORD_TOKEN"])
-
-    return oauth_url(os.environ["DISCORD_CLIENT_ID"], permissions = permissions, scopes = ['bot'])
+def memory_profile() -> MemoryProfile:
+    if os.environ.get("BOT_MEMORY_PROFILE", "lean") == "full": return MemoryProfile.full()
+    return MemoryProfile.lean(Client, views=CACHE_VIEWS)
 
-
-async def run(client: Client = Client(
-    intents=intents,
-    command_prefix='$',
-    cache = MemoryCache(mirrors=[
+def create_cache() -> Cache:
+    return MemoryCache(mirrors=[
         GitCache(
             repository=os.environ["BOT_CACHE_GIT_REPOSITORY"], # Don't put a default here for safety
             directory=os.environ.get("BOT_CACHE_GIT_DIRECTORY", './.bot/cache/git'),
-            branch=os.environ.get("BOT_CACHE_GIT_BRANCH", 'main')
-        )
-    ])
-)):
+            branch=os.environ.get("BOT_CACHE_GIT_BRANCH", 'main'),
+            fanout=tuple(map(int, os.environ["BOT_CACHE_GIT_FANOUT"].split(','))) if os.environ.get("BOT_CACHE_GIT_FANOUT") else None,
+            compress=os.environ.get("BOT_CACHE_GIT_COMPRESS", "0") == "1",
+            executor=os.environ.get("BOT_CACHE_GIT_EXECUTOR") or None,
+            workers=int(os.environ.get("BOT_CACHE_GIT_WORKERS", 4)),
+        ),
+        ReactionHistogram(),
+        ChannelIndex(path=os.environ.get("BOT_CHANNEL_INDEX", './.bot/channel_index.json'), restored=os.environ.get("BOT_CHANNEL_INDEX_RESTORED", "0") == "1"),
+    ], seen=Seen(capacity=int(os.environ.get("BOT_CACHE_SEEN", 100_000))))
+
+def create_client(cache: Optional[Cache] = None, client_class: type = Client, raw_events: Optional[bool] = None, **kwargs) -> Client:
+    profile = memory_profile()
+    return client_class(
+        **profile.kwargs(),
+        **kwargs,
+        memory_profile=profile,
+        command_prefix='$',
+        raw_events=os.environ.get("BOT_CACHE_RAW_EVENTS", "0") == "1" if raw_events is None else raw_events,
+        cache = cache or create_cache()
+    )
+
+async def setup(client: Client) -> None:
+    # Commands (https://discordpy.readthedocs.io/en/stable/ext/commands/cogs.html)
+    count = Count(client=client, cache=client.cache)
+    await client.add_cog(count)
+    await client.add_cog(count.reaction_command(SEMFCOIN_EMOJI.name, SEMFCOIN_EMOJI))
+    await client.add_cog(Stats())
+    client.add_dynamic_items(LeaderboardPage) # Leaderboard pages sent before a restart
+
+    client.backfill = Backfill.from_env(client, client.cache, emojis=[SEMFCOIN_EMOJI])
+    if client.backfill is not None: client.backfill.start()
+
+async def run(client: Optional[Client] = None):
+    # https://discordpy.readthedocs.io/en/latest/logging.html
+    discord.utils.setup_logging(level=logging.INFO)
+
+    if client is None and os.environ.get("BOT_SHARD_PROCESSES"): return await run_sharded(int(os.environ["BOT_SHARD_PROCESSES"]))
+
+    client = client or create_client()
     async with client:
-        # Commands (https://discordpy.readthedocs.io/en/stable/ext/commands/cogs.html)
-        count = Count(client=client, cache=client.cache)
-        await client.add_cog(count)
-        await client.add_cog(count.reaction_command(SEMFCOIN_EMOJI.name, SEMFCOIN_EMOJI))
+        await setup(client)
+        await client.start(os.environ["DISCORD_TOKEN"])
+
+# Sharded: this process serves the cache (BOT_CACHE_SERVICE_SOCKET), BOT_SHARD_PROCESSES processes each run their share
+# of the BOT_SHARD_COUNT shards with a replica of it. Only the first process syncs the app commands.
+class ShardedClient(Client, commands.AutoShardedBot):
+    pass
+
+async def run_sharded(processes: int) -> None:
+    shard_count = int(os.environ.get("BOT_SHARD_COUNT", processes))
+    path = os.environ.get("BOT_CACHE_SERVICE_SOCKET", './.bot/cache.sock')
+
+    cache = create_cache()
+    await cache.initialize()
+    await CacheService(cache, path).serve()
+    api = await start_api(cache) # Over the whole cache, the shards don't serve one
+
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(target=run_shard_process, args=(index, list(range(index, shard_count, processes)), shard_count, path), name=f'shards-{index}')
+        for index in range(processes)
+    ]
+    for worker in workers: worker.start()
+
+    await asyncio.gather(*(asyncio.to_thread(worker.join) for worker in workers))
+
+def run_shard_process(index: int, shard_ids: List[int], shard_count: int, path: str) -> None:
+    if index > 0: os.environ["DISCORD_SKIP_HOOK"] = "1"
+    for name in ("BOT_API_PORT", "BOT_API_SOCKET"): os.environ.pop(name, None)
+    # One metrics endpoint/dump per process
+    if os.environ.get("BOT_METRICS_PORT"): os.environ["BOT_METRICS_PORT"] = str(int(os.environ["BOT_METRICS_PORT"]) + index)
+    if os.environ.get("BOT_METRICS_FILE"): os.environ["BOT_METRICS_FILE"] = f'{os.environ["BOT_METRICS_FILE"]}.{index}'
 
-        await client.start(os.environ["DISCORD_TOKEN"])
\ No newline at end of file
+    discord.utils.setup_logging(level=logging.INFO)
+    print(f'Running shards {shard_ids} of {shard_count}')
+    channel_index = ChannelIndex(path=f'{os.environ.get("BOT_CHANNEL_INDEX", "./.bot/channel_index.json")}.{index}', restored=os.environ.get("BOT_CHANNEL_INDEX_RESTORED", "0") == "1") # Each process has its own guilds
+    asyncio.run(run(create_client(cache=RemoteCache(path, mirrors=[ReactionHistogram(), channel_index], seen=Seen(capacity=int(os.environ.get("BOT_CACHE_SEEN", 100_000)))), client_class=ShardedClient, shard_ids=shard_ids, shard_count=shard_count)))
@@ -3,7 +3,7 @@ from __future__ import annotations
 import os
 from asyncio import sleep
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
 from inspect import signature
 from itertools import islice
 from typing import Optional, List, Union, Callable, Any, Dict, Awaitable
@@ -16,8 +16,13 @@ from discord.ext import tasks
 from discord.ext.commands import Context, Greedy, hybrid_group, Cog
 from discord.utils import get
 
-from cache import DiscordTraverser, Cache, FunctionQueue, CacheEntry, MemoryCache
-from converters import DatetimeConverter, discord_timestamp, lookup_emoji, TimestampStyle
+from cache import DiscordTraverser, Cache, FunctionQueue, CacheEntry, MemoryCache, Aggregate, Group
+from converters import DatetimeConverter, discord_timestamp, lookup_emoji, TimestampStyle, aware
+from histogram import ReactionHistogram
+from channel_index import ChannelIndex
+from loop_monitor import span
+from metrics import registry
+from records import MessageRecord
 
 # TODO; Python 3.12 (https://stackoverflow.com/questions/8991506/iterate-an-iterator-by-chunks-of-n-in-python)
 def batched(iterable, n):
@@ -29,6 +34,104 @@ def batched(iterable, n):
     while (batch := tuple(islice(it, n))):
         yield batch
 
+# Reactions on messages (or authors, ...) by others than the author themselves, most first
+def leaderboard(cache: Cache, emoji: Union[PartialEmoji, Emoji, str], group_by: str, after: Optional[datetime] = None, before: Optional[datetime] = None) -> Cache[Group]:
+    return (
+        cache.reactors
+        .query(
+            where=dict(emoji=str(emoji)),
+            between=dict(created_at=(after, before)),
+            group_by=group_by,
+            aggregates=dict(count=Aggregate('sum', 'others')),
+            order_by='count', descending=True,
+        )
+        .filter(lambda grouped_entry: grouped_entry.current.aggregates['count'] > 0)
+    )
+
+# max embed size is currently 6000
+# max embed field value length is 1024 (currently)
+@span('render')
+def leaderboard_embed(cache: Cache, index: int, group: Group, content_length: int = 300) -> Embed:
+    message = cache.messages.get(id=group.key)
+    if message is None: # Deleted (or not cached) since it was counted: what its reactors know about it
+        reactors = next(iter(group.values.current()))
+        message = MessageRecord(id=reactors.message_id, channel_id=reactors.channel_id, guild_id=reactors.guild_id, author_id=reactors.author_id, content='')
+
+    def content() -> str:
+        if message.content.strip(): return f'{message.content[:content_length]}{"..." if len(message.content) > content_length else ""}'
+        if message.attachments: return message.attachments[0]
+        return ""
+
+    embed = Embed(
+        timestamp=None,
+        url=None,
+        type='rich',
+        color=Colour.orange(),
+        description=f'**'
+                    f'#{index + 1}: {" ".join([f"`+ {reactors.others:,}` {reactors.emoji}" for reactors in group.values.current()])}'
+                    f' - <@{message.author_id}> in {message.jump_url}'
+                    f'**',
+    )
+    embed.add_field(
+        name=f'{discord_timestamp(message.created_at)}',
+        value=f'{content()}'
+              f'\n\n{" ".join([f"`{reaction.count:,}` {str(reaction.emoji)}" for reaction in message.reactions])}',
+        inline=False
+    )
+
+    return embed
+
+# A page of the `list` leaderboard, only rendered when someone asks for it. All its state is in the custom_id, so the
+# buttons keep working across restarts (client.add_dynamic_items). Page 0 is the top on the message itself.
+class LeaderboardPage(ui.DynamicItem[ui.Button], template=r'leaderboard:(?P<page>\d+):(?P<after>\d*):(?P<before>\d*):(?P<emoji>.+)'):
+    TOP = 3
+    SIZE = 5 # Embeds per page, Discord allows 10 (and 6000 characters) per message
+
+    def __init__(self, emoji: str, page: int, after: Optional[datetime] = None, before: Optional[datetime] = None, label: str = 'More'):
+        def timestamp(date: Optional[datetime]) -> str: return '' if date is None else str(int(date.timestamp()))
+
+        self.emoji = emoji
+        self.page = page
+        self.after = after
+        self.before = before
+        super().__init__(ui.Button(label=label, style=ButtonStyle.secondary, custom_id=f'leaderboard:{page}:{timestamp(after)}:{timestamp(before)}:{emoji}'))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: ui.Button, match: Any) -> LeaderboardPage:
+        def date(value: str) -> Optional[datetime]: return datetime.fromtimestamp(int(value), tz=timezone.utc) if value else None
+        return cls(emoji=match['emoji'], page=int(match['page']), after=date(match['after']), before=date(match['before']), label=item.label)
+
+    @staticmethod
+    def view(emoji: str, page: int, entries: int, after: Optional[datetime] = None, before: Optional[datetime] = None) -> Optional[ui.View]:
+        pages = -(-max(0, entries - LeaderboardPage.TOP) // LeaderboardPage.SIZE)
+        if pages == 0: return None
+
+        view = ui.View(timeout=None)
+        if page > 1: view.add_item(LeaderboardPage(emoji, page - 1, after=after, before=before, label='◀'))
+        if page < pages: view.add_item(LeaderboardPage(emoji, page + 1, after=after, before=before, label='More' if page == 0 else '▶'))
+        return view
+
+    async def callback(self, interaction: Interaction) -> None:
+        cache = interaction.client.cache
+        top = leaderboard(cache, self.emoji, 'message_id', after=self.after, before=self.before)
+        start = LeaderboardPage.TOP + (self.page - 1) * LeaderboardPage.SIZE
+        groups = list(islice(top.current(), start, start + LeaderboardPage.SIZE))
+
+        kwargs = dict(
+            content=f'**#{start + 1} - #{start + len(groups)}** of {top.count():,}' if groups else 'Nothing (cached) on this page (anymore).',
+            embeds=[leaderboard_embed(cache, index, group) for index, group in enumerate(groups, start)],
+            view=LeaderboardPage.view(self.emoji, self.page, top.count(), after=self.after, before=self.before),
+            allowed_mentions=AllowedMentions(users=False, roles=False, everyone=False, replied_user=False),
+        )
+
+        # Paging within the ephemeral page edits it, from the public message it opens one
+        if interaction.message is not None and interaction.message.flags.ephemeral:
+            await interaction.response.edit_message(**kwargs)
+        else:
+            await interaction.response.send_message(**kwargs, ephemeral=True)
+
+dynamic_messages = registry.counter('bot_dynamic_messages_total', 'DynamicMessage sends and edits')
+
 class DynamicMessage: # TODO: Could make use of discord.DynamicItem
     message: Optional[Message] = None
 
@@ -50,6 +153,7 @@ class DynamicMessage: # TODO: Could make use of discord.DynamicItem
         await self.send() # after done, send one more time
 
     # TODO; these should support async
+    @span('render')
     def params(self, func) -> Dict[str, Any]:
         func_params = filter(lambda param: param[0] in self.kwargs, signature(func).parameters.items())
         return dict(map(lambda param: (param[0], self.kwargs.get(param[0], None)()), func_params))
@@ -57,11 +161,13 @@ class DynamicMessage: # TODO: Could make use of discord.DynamicItem
     async def send(self) -> Optional[Message]:
         async def _send() -> Optional[Message]:
             if self.message is None:
+                dynamic_messages.inc(action='send')
                 self.message = await self.ctx.send(**self.params(self.ctx.send))
                 return
 
             # if self.message.content == self.content(): return None
 
+            dynamic_messages.inc(action='edit')
             await self.message.edit(**self.params(self.message.edit))
 
         await _send()
@@ -95,7 +201,7 @@ class ReactionCounter(DiscordTraverser):
     message: Optional[Message] = None
 
     def __init__(self, ctx: Context, options: Options, cache: Cache):
-        super().__init__(cache = MemoryCache() if options.skip_cache else cache)
+        super().__init__(cache = MemoryCache() if options.skip_cache else cache, index = None if options.skip_cache else cache.mirror(ChannelIndex))
         self.ctx = ctx
         self.options = options
 
@@ -109,6 +215,12 @@ class ReactionCounter(DiscordTraverser):
 
         # Lookup emojis
         self.options.emojis = [await lookup_emoji(ctx=self.ctx, emoji=emoji) for emoji in self.options.emojis]
+        self.options.after, self.options.before = aware(self.options.after), aware(self.options.before)
+
+        # Already crawled in full by the backfill (and kept up-to-date by the events since)
+        backfill = getattr(self.ctx.bot, 'backfill', None)
+        guilds = self.options.guilds or list({getattr(channel, "guild", None) for channel in self.options.channels or []})
+        if not self.options.skip_cache and backfill is not None and guilds and all(backfill.covers(guild, self.options.emojis) for guild in guilds): return self
 
         await self.push(self.options.guilds)
         await self.push(self.options.channels)
@@ -135,9 +247,26 @@ class ReactionCounter(DiscordTraverser):
 
         return CountingView()
 
+    def leaderboard(self, group_by: str) -> Cache[Group]:
+        return leaderboard(self.cache, self.options.emojis[0], group_by, after=self.options.after, before=self.options.before) # TODO Multi-emoji for general cmds
+
+    # Reactions from after to before, through the prefix sums of the reaction histogram when the cache has one
+    def total(self, emoji: Union[PartialEmoji, Emoji, str]) -> int:
+        histogram = self.cache.mirror(ReactionHistogram)
+        if histogram is None:
+            return self.cache.reactions.query(where=dict(emoji=str(emoji)), between=dict(created_at=(self.options.after, self.options.before))).count()
+
+        if self.options.channels is None: return histogram.total(emoji, after=self.options.after, before=self.options.before)
+
+        # Including the threads in those channels
+        channel_ids = set(map(lambda channel: channel.id, self.options.channels))
+        channel_ids.update(thread.id for thread in self.cache.threads.current() if thread.parent_id in channel_ids)
+        return sum(histogram.total(emoji, after=self.options.after, before=self.options.before, channel_id=channel_id) for channel_id in channel_ids)
+
+    @span('render')
     def header(self) -> str:
         return (
-            f'**Counted {" ".join([f"`{self.cache.reactions.get_all(emoji=emoji).count():,}` {str(emoji)}" for emoji in self.options.emojis])} ...**'
+            f'**Counted {" ".join([f"`{self.total(emoji):,}` {str(emoji)}" for emoji in self.options.emojis])} ...**'
             f'\n*so far in'
             f' {self.cache.reactions.count():,} reactions'
             f', {self.cache.messages.count():,} messages'
@@ -233,64 +362,53 @@ class Count(Cog):
                     channels=channels,after=after,before=before,skip_cache=skip_cache
                 )
 
-            # @reaction_command_group.command()
-            # async def top(
-            #     self, ctx: Context,
-            #     channels: Greedy[Union[GuildChannel, Thread]] = None, after: Optional[DatetimeConverter] = None,
-            #     before: Optional[DatetimeConverter] = None, skip_cache: Optional[bool] = False,
-            # ):
-            #     if not cmd.client.is_ready(): return
-            #
-            #     channel = await cmd.client.fetch_channel(os.environ.get("SEMF_TOP_CONTRIBUTIONS_CHANNEL", 1207430024660262932))
-            #     if not isinstance(channel, TextChannel): return
-            #
-            #     message = None
-            #     last_message = True
-            #     async for m in channel.history(limit=100):
-            #         if message is not None: last_message = False
-            #
-            #         if m.author == cmd.client.user and ('Top Contributors' in m.content):
-            #             last_message = message
-            #
-            #     # TODO: Move this top thing elsewhere
-            #     counter = await ReactionCounter(
-            #         ctx=ctx, cache=cmd.global_cache,
-            #         options=ReactionCounter.Options(emojis=[emoji], channels=channels, skip_cache=skip_cache, after=after, before=before)
-            #     ).load_defaults()
-            #
-            #     top = (
-            #         counter.cache.reactions
-            #         .get_all(emoji=counter.options.emojis[0])  # TODO Multi-emoji for general cmds
-            #         .group_by(lambda reaction_entry: int(reaction_entry.current.message.author.id))
-            #         .filter(lambda grouped_entry: (
-            #               # Number of reactions
-            #               grouped_entry.current[1].count()
-            #               # - number of reactions by one-self TODO: could make optional
-            #               - grouped_entry.current[1].filter(
-            #               lambda reaction_entry: reaction_entry.current.me).count()
-            #           ) > 0)
-            #         .sort(lambda grouped_entry: -grouped_entry.current[1].count())
-            #     )
-            #
-            #     await counter.count()
-            #
-            #     if message is None or not last_message:  # TODO; Could be better check perhaps dynamicitem?
-            #         print('create it')
-            #         # await channel.send('test')
-            #         m = "\n".join([
-            #             f'**#{index + 1}: <@{author_entry.current}>: **'
-            #             f'{" ".join([f"`{reaction.count - reactions_cache.filter(lambda reaction_entry: reaction_entry.current.me).count():,}` {str(reaction.emoji)}" for reaction in reactions_cache.current()])}'
-            #
-            #             for index, (author_entry, reactions_cache) in enumerate(list(top.current())[:10])
-            #         ])
-            #         await channel.send(
-            #          allowed_mentions=lambda: AllowedMentions(users=False, roles=False, everyone=True,replied_user=True),
-            #             content=f'## **Top {counter.options.emojis[0]} Contributors**'
-            #                     f'\n{m}',
-            #         )
-            #         return
-            #
-            #     print('edit it')
+            @reaction_command_group.command()
+            @describe(before="ex: 2023-01-01", after="ex: 2023-01-01", skip_cache="Whether to skip the cache and actively search through channels")
+            async def top(
+                self, ctx: Context,
+                channels: Greedy[Union[GuildChannel, Thread]] = None, after: Optional[DatetimeConverter] = None, before: Optional[DatetimeConverter] = None, skip_cache: Optional[bool] = False,
+            ):
+                counter = await ReactionCounter(
+                    ctx=ctx, cache=cmd.global_cache,
+                    options=ReactionCounter.Options(emojis=[emoji], channels=channels, skip_cache=skip_cache, after=after, before=before)
+                ).load_defaults()
+
+                number_of_entries: int = 10
+                top = counter.leaderboard(group_by='author_id')
+
+                await counter.with_message(
+                    content=lambda:
+                        f'{counter.header()}'
+                        f'\n'
+                        f'## **Top {counter.options.emojis[0]} Contributors**'
+                        f'\n' + "\n".join([
+                            f'**#{index + 1}: <@{group.key}>: `{group.aggregates["count"]:,}` {counter.options.emojis[0]}**'
+                            f' (across `{group.values.count():,}` messages)'
+                            for index, group in enumerate(list(top.current())[:number_of_entries])
+                        ]),
+                    view=counter.view,
+                    allowed_mentions=lambda: AllowedMentions(users=False, roles=False, everyone=False, replied_user=True),
+                    ephemeral=lambda: True
+                )
+
+            # Straight from the reaction histogram, no traversal
+            @reaction_command_group.command()
+            @describe(weeks="Number of weeks, up to and including this one")
+            async def weekly(self, ctx: Context, weeks: Optional[int] = 8):
+                histogram = cmd.global_cache.mirror(ReactionHistogram)
+                if histogram is None:
+                    await ctx.send(content='No reaction histogram is kept for this cache.', ephemeral=True)
+                    return
+
+                resolved = await lookup_emoji(ctx=ctx, emoji=emoji)
+                await ctx.send(
+                    content=f'## **Weekly {resolved}**'
+                            f'\n' + "\n".join([
+                                f'- {discord_timestamp(start, style=TimestampStyle.D)}: `{total:,}` {resolved}'
+                                for start, total in histogram.weekly(resolved, max(1, min(weeks, 52)))
+                            ]),
+                    ephemeral=True
+                )
 
             @reaction_command_group.command()
             @describe(before="ex: 2023-01-01", after="ex: 2023-01-01", skip_cache="Whether to skip the cache and actively search through channels")
@@ -303,54 +421,13 @@ class Count(Cog):
                     options=ReactionCounter.Options(emojis=[emoji], channels=channels, skip_cache=skip_cache,after=after, before=before)
                 ).load_defaults()
 
-                # TODO DOUBLE CHECK SELFCOUNT
                 # TODO EXCLUDE PRIVATE
 
-                number_of_entries: int = 3
-                content_length = 300
-                # max embed size is currently 6000
-                # max embed field value length is 1024 (currently)
-
-                top = (
-                    counter.cache.reactions
-                    .get_all(emoji=counter.options.emojis[0]) # TODO Multi-emoji for general cmds
-                    .group_by(lambda reaction_entry: reaction_entry.current.message)
-                    .filter(lambda grouped_entry: (
-                        # Number of reactions
-                        grouped_entry.current[1].count()
-                        # - number of reactions by one-self TODO: could make optional
-                        - grouped_entry.current[1].filter(
-                        lambda reaction_entry: reaction_entry.current.me).count()
-                    ) > 0)
-                    .sort(lambda grouped_entry: -grouped_entry.current[1].count())
-                )
+                number_of_entries: int = LeaderboardPage.TOP
 
-                def embed(index: int, message_entry: CacheEntry[Message], reactions_cache: Cache[Reaction]) -> Embed:
-                    message = message_entry.current
-
-                    def content() -> str:
-                        if message.content.strip(): return f'{message.content[:content_length]}{"..." if len(message.content) > content_length else ""}'
-                        if message.attachments: return str(message.attachments[0])
-                        return ""
-
-                    embed = Embed(
-                        timestamp=None,
-                        url=None,
-                        type='rich',
-                        color=Colour.orange(),
-                        description=f'**'
-                                    f'#{index + 1}: {" ".join([f"`+ {reaction.count - reactions_cache.filter(lambda reaction_entry: reaction_entry.current.me).count():,}` {str(reaction.emoji)}" for reaction in reactions_cache.current()])}'
-                                    f' - {message.author.mention} in {message.jump_url}'
-                                    f'**',
-                    )
-                    embed.add_field(
-                        name=f'{discord_timestamp(message.created_at)}',
-                        value=f'{content()}'
-                              f'\n\n{" ".join([f"`{reaction.count:,}` {str(reaction.emoji)}" for reaction in message.reactions])}',
-                        inline=False
-                    )
-
-                    return embed
+                top = counter.leaderboard(group_by='message_id')
+
+                def embed(index: int, group: Group) -> Embed: return leaderboard_embed(counter.cache, index, group)
 
                 # Dynamic counter for the sender
                 await counter.with_message(
@@ -358,58 +435,28 @@ class Count(Cog):
                         f'{counter.header()}'
                         f'\n'
                         f'## **'
-                        f'A total of {" ".join([f"`{counter.cache.reactions.get_all(emoji=emoji).count():,}` {str(emoji)}" for emoji in counter.options.emojis])}'
+                        f'A total of {" ".join([f"`{counter.total(emoji):,}` {str(emoji)}" for emoji in counter.options.emojis])}'
                         f' awarded across {top.count():,} messages from'
                         f' {discord_timestamp(counter.options.after, style=TimestampStyle.D, default="Infinity")}'
                         f' to {discord_timestamp(counter.options.before, style=TimestampStyle.D, default="Beyond")}'
                         f'**',
                     view=counter.view,
-                    embeds=lambda: [embed(index, message_entry, reactions_cache) for index, (message_entry, reactions_cache) in enumerate(list(top.current())[:number_of_entries])],
+                    embeds=lambda: [embed(index, group) for index, group in enumerate(list(top.current())[:number_of_entries])],
                     allowed_mentions=lambda: AllowedMentions(users=False, roles=False, everyone=False,replied_user=True),
                     ephemeral=lambda: True
                 )
 
-                # To a message & thread
-                async def on_send(ctx: Context, message: Message):
-                    entries_to_thread = list(top.current())[number_of_entries:]
-                    if not entries_to_thread: return
-
-                    max_embeds = 10 # max set by discord
-
-                    thread = await message.create_thread(
-                        name=f'A total of {" ".join([f"{counter.cache.reactions.get_all(emoji=emoji).count():,} {emoji.name}" for emoji in counter.options.emojis])}'
-                             f' awarded across {top.count():,} messages'
-                    )
-
-                    last_message: Optional[Message] = None
-                    index = number_of_entries
-                    for batch in batched(entries_to_thread, max_embeds):
-                        start_index = index
-                        index += len(batch)
-
-                        last_message = await thread.send(
-                            reference=last_message, # Does the reply
-                            content=f'**#{start_index + 1} - #{index}**',
-                            embeds=[embed(start_index + batch_index, message_entry, reactions_cache) for
-                                    batch_index, (message_entry, reactions_cache) in
-                                    enumerate(batch)],
-                            allowed_mentions=AllowedMentions(users=False, roles=False, everyone=False, replied_user=True),
-                        )
-
                 await counter.send(
                     content=lambda:
                         f'## **'
-                        f'@everyone A total of {" ".join([f"`{counter.cache.reactions.get_all(emoji=emoji).count():,}` {str(emoji)}" for emoji in counter.options.emojis])}'
+                        f'@everyone A total of {" ".join([f"`{counter.total(emoji):,}` {str(emoji)}" for emoji in counter.options.emojis])}'
                         f' awarded across {top.count():,} messages from'
                         f' {discord_timestamp(counter.options.after, style=TimestampStyle.D, default="Infinity")}'
                         f' to {discord_timestamp(counter.options.before, style=TimestampStyle.D, default="Beyond")}'
                         f'**',
-                    view=counter.view,
-                    embeds=lambda: [embed(index, message_entry, reactions_cache) for
-                                    index, (message_entry, reactions_cache) in
-                                    enumerate(list(top.current())[:number_of_entries])],
+                    view=lambda: LeaderboardPage.view(str(counter.options.emojis[0]), 0, top.count(), after=counter.options.after, before=counter.options.before),
+                    embeds=lambda: [embed(index, group) for index, group in enumerate(list(top.current())[:number_of_entries])],
                     allowed_mentions=lambda: AllowedMentions(users=False, roles=False, everyone=True,replied_user=True),
-                    on_send=on_send
                 )
 
 
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from typing import List, Optional
+
+from discord.ext.commands import Context, Cog, command, is_owner
+
+import loop_monitor
+from memory_profile import MemoryAccounting
+from metrics import registry, discord_requests, HISTORY_PATH
+
+# Discord's message limit is 2000 characters
+async def send_lines(ctx: Context, lines: List[str]) -> None:
+    message = ''
+    for line in lines:
+        if len(message) + len(line) > 1900:
+            await ctx.send(f'```\n{message}```')
+            message = ''
+        message += f'{line[:1900]}\n'
+    if message: await ctx.send(f'```\n{message}```')
+
+class Stats(Cog):
+
+    def __init__(self):
+        self.accounting = MemoryAccounting()
+
+    # Owner-only, prefix-only (not an app command): $stats
+    @command()
+    @is_owner()
+    async def stats(self, ctx: Context):
+        uptime = max(registry.uptime(), 1)
+        pages = sum(value for labels, value in discord_requests.values.items() if dict(labels).get('path') == HISTORY_PATH)
+        await send_lines(ctx, [f'history pages: {pages:,.0f} ({pages / uptime:,.2f}/s)', *registry.summary()])
+
+    # Owner-only, prefix-only: $lag, what stalled the event loop recently (with BOT_LOOP_MONITOR=1)
+    @command()
+    @is_owner()
+    async def lag(self, ctx: Context):
+        if loop_monitor.monitor is None:
+            await ctx.send('The event loop monitor is off (BOT_LOOP_MONITOR=1)')
+            return
+        await send_lines(ctx, loop_monitor.monitor.report())
+
+    # Owner-only, prefix-only: $memory, what each cache partition, mirror and discord.py's state take, and their growth
+    # since the last $memory. The first one also starts tracemalloc (slows down allocations), $memory off stops it.
+    @command()
+    @is_owner()
+    async def memory(self, ctx: Context, tracing: Optional[str] = None):
+        if tracing == 'off':
+            self.accounting.stop_tracing()
+            await ctx.send('Stopped tracemalloc')
+            return
+        await send_lines(ctx, await self.accounting.report(ctx.bot, ctx.bot.cache))
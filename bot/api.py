@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from datetime import datetime
+from itertools import islice
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web # discord.py's own dependency
+
+from cache import Cache, CacheEntry, Query
+from converters import aware
+from Count import leaderboard
+from export import KINDS, Filters, row
+from histogram import ReactionHistogram
+from metrics import registry
+from records import Record
+
+# Read-only query endpoint over the cache, for local tools (dashboards, the Library, ...) instead of them crawling
+# Discord or parsing the GitCache tree. Served on localhost (BOT_API_PORT) or a Unix socket (BOT_API_SOCKET), never
+# publicly. Pages are streamed as JSON lines (CacheEntry.to_dict), the last line being {"next": <cursor or null>}.
+#
+# GET /objects/{id}
+# GET /{view}?<attr>=<value>&after=<iso>&before=<iso>&limit=100&cursor=0 (view: messages, members, reactors, threads, ...)
+# GET /leaderboard?emoji=<emoji>&group_by=message_id|author_id&after=&before=&limit=&cursor=
+# GET /total?emoji=<emoji>&after=&before=&channel_id=
+# GET /export/{kind}?guild_id=&channel_id=&after=&before=&cursor= (kind: message, reactors, member, ..., see export.py)
+#     Everything from the cursor on, in chunks (never a copy of the whole cache), each line with its "cursor"
+#
+# View and export cursors are positions in insertion order, which stay valid between pages: new objects come after them,
+# deletes leave them where they are. Pages are read from the cursor on until they're full, not from the whole result.
+# Leaderboard cursors are offsets into the ranking (by count).
+
+VIEWS = (
+    'objects', 'events', 'users', 'members', 'reactions', 'reactors', 'messages', 'guilds', 'channels', 'categories',
+    'forums', 'stages', 'voice_channels', 'text_channels', 'threads', 'messageables',
+)
+RESERVED = ('after', 'before', 'limit', 'cursor')
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1_000
+
+requests_total = registry.counter('bot_api_requests_total', 'Requests to the query endpoint, by route and status')
+request_seconds = registry.histogram('bot_api_request_seconds', 'Time to serve a query endpoint request, by route')
+
+# Query string values are strings, snowflakes/booleans/null are what the records hold
+def value_of(value: str) -> Any:
+    if value.lstrip('-').isdigit(): return int(value)
+    if value in ('true', 'false'): return value == 'true'
+    if value == 'null': return None
+    return value
+
+def date_of(request: web.Request, name: str) -> Optional[datetime]:
+    if name not in request.query: return None
+    try:
+        return aware(datetime.fromisoformat(request.query[name]))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f'"{request.query[name]}" is not an ISO date')
+
+def page_of(request: web.Request) -> Tuple[int, int]:
+    try:
+        return max(0, int(request.query.get('cursor', 0))), min(MAX_LIMIT, max(1, int(request.query.get('limit', DEFAULT_LIMIT))))
+    except ValueError:
+        raise web.HTTPBadRequest(text='cursor and limit are integers')
+
+async def stream(request: web.Request, lines: List[Dict[str, Any]], next_cursor: Optional[int], total: Optional[int] = None) -> web.StreamResponse:
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    if next_cursor is not None: response.headers['X-Next-Cursor'] = str(next_cursor)
+    await response.prepare(request)
+
+    for index in range(0, len(lines), 100):
+        await response.write(''.join(json.dumps(line, sort_keys=True, default=str) + '\n' for line in lines[index:index + 100]).encode())
+    await response.write((json.dumps({'next': next_cursor} | ({} if total is None else {'total': total})) + '\n').encode())
+    await response.write_eof()
+    return response
+
+class Api:
+
+    def __init__(self, cache: Cache):
+        self.cache = cache
+
+        self.app = web.Application(middlewares=[self.measure])
+        self.app.router.add_get('/objects/{id}', self.object)
+        self.app.router.add_get('/leaderboard', self.leaderboard)
+        self.app.router.add_get('/total', self.total)
+        self.app.router.add_get('/export/{kind}', self.export)
+        self.app.router.add_get('/{view}', self.view)
+
+    @web.middleware
+    async def measure(self, request: web.Request, handler) -> web.StreamResponse:
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else 'unknown'
+        with request_seconds.time(route=route):
+            try:
+                response = await handler(request)
+            except web.HTTPException as exception:
+                requests_total.inc(route=route, status=exception.status)
+                raise
+            requests_total.inc(route=route, status=response.status)
+            return response
+
+    async def object(self, request: web.Request) -> web.Response:
+        entries = self.cache.objects.execute(Query(where=dict(id=value_of(request.match_info['id'])), limit=1))
+        if not entries: raise web.HTTPNotFound()
+        return web.json_response(entries[0].to_dict(), dumps=lambda obj: json.dumps(obj, sort_keys=True, default=str))
+
+    async def view(self, request: web.Request) -> web.StreamResponse:
+        if request.match_info['view'] not in VIEWS: raise web.HTTPNotFound()
+        view: Cache = getattr(self.cache, request.match_info['view'])
+
+        after, before = date_of(request, 'after'), date_of(request, 'before')
+        query = Query(
+            where={attr: value_of(value) for attr, value in request.query.items() if attr not in RESERVED},
+            between=dict(created_at=(after, before)) if after or before else {},
+        )
+        cursor, limit = page_of(request)
+        if 'id' in query.where: return await stream(request, [entry.to_dict() for entry in view.execute(query)], None) # Index lookup
+
+        # One past the page, to know whether there's a next one
+        matches = ((position, entry) for entries in view.scan(start=cursor, chunk=1_000) for position, entry in entries if query.matches(entry))
+        page: List[Tuple[int, CacheEntry]] = list(islice(matches, limit + 1))
+        return await stream(request, [entry.to_dict() for position, entry in page[:limit]], page[limit - 1][0] if len(page) > limit else None)
+
+    async def leaderboard(self, request: web.Request) -> web.StreamResponse:
+        if 'emoji' not in request.query: raise web.HTTPBadRequest(text='emoji is required')
+        group_by = request.query.get('group_by', 'message_id')
+        if group_by not in ('message_id', 'author_id', 'channel_id'): raise web.HTTPBadRequest(text='group_by is one of message_id, author_id, channel_id')
+
+        cursor, limit = page_of(request)
+        groups = leaderboard(self.cache, request.query['emoji'], group_by, after=date_of(request, 'after'), before=date_of(request, 'before')).entries()
+        lines = [{'rank': cursor + index + 1, group_by: entry.current.key, 'count': entry.current.aggregates['count']} for index, entry in enumerate(groups[cursor:cursor + limit])]
+        return await stream(request, lines, cursor + len(lines) if cursor + len(lines) < len(groups) else None, len(groups))
+
+    async def total(self, request: web.Request) -> web.Response:
+        if 'emoji' not in request.query: raise web.HTTPBadRequest(text='emoji is required')
+        histogram = self.cache.mirror(ReactionHistogram)
+        if histogram is None: raise web.HTTPNotFound(text='No reaction histogram on this cache')
+
+        channel_id = value_of(request.query['channel_id']) if 'channel_id' in request.query else None
+        return web.json_response({'emoji': request.query['emoji'], 'total': histogram.total(request.query['emoji'], after=date_of(request, 'after'), before=date_of(request, 'before'), channel_id=channel_id)})
+
+    async def export(self, request: web.Request) -> web.StreamResponse:
+        kind = request.match_info['kind']
+        if kind not in KINDS: raise web.HTTPNotFound()
+        try:
+            filters = Filters(
+                guild_id=int(request.query['guild_id']) if 'guild_id' in request.query else None, channel_id=int(request.query['channel_id']) if 'channel_id' in request.query else None,
+                after=date_of(request, 'after'), before=date_of(request, 'before'),
+            )
+            cursor = int(request.query.get('cursor', 0))
+        except ValueError:
+            raise web.HTTPBadRequest(text='guild_id, channel_id and cursor are integers')
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+
+        # Yields once per scanned chunk, also when a narrow filter matched nothing in it
+        for entries in self.cache.objects.scan(start=cursor, chunk=1_000):
+            lines = [
+                json.dumps(dict(row(entry.current), cursor=position), sort_keys=True, default=str) + '\n'
+                for position, entry in entries if isinstance(entry.current, Record) and filters.kind_of(entry, (kind,)) is not None
+            ]
+            cursor = entries[-1][0]
+            if lines: await response.write(''.join(lines).encode()) # Backpressure: waits for a slow reader
+            else: await asyncio.sleep(0)
+
+        await response.write((json.dumps({'next': cursor}) + '\n').encode())
+        await response.write_eof()
+        return response
+
+    async def serve(self, port: Optional[int] = None, path: Optional[str] = None) -> web.AppRunner:
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+
+        if path is not None:
+            if os.path.exists(path): os.remove(path)
+            await web.UnixSite(runner, path=path).start()
+            os.chmod(path, 0o600)
+            print(f'Serving the cache API on {path}')
+        if port is not None:
+            await web.TCPSite(runner, host='127.0.0.1', port=port).start()
+            print(f'Serving the cache API on http://127.0.0.1:{port}')
+
+        return runner
+
+async def start_api(cache: Cache) -> Optional[web.AppRunner]:
+    port, path = os.environ.get("BOT_API_PORT"), os.environ.get("BOT_API_SOCKET")
+    if not port and not path: return None
+    return await Api(cache).serve(port=int(port) if port else None, path=path)
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+import traceback
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+import discord
+from discord import Guild, Thread
+from discord.abc import GuildChannel
+from discord.http import HTTPClient, Route
+
+from cache import Cache, DiscordTraverser
+from channel_index import ChannelIndex
+from metrics import registry
+from scheduler import Priority, Scheduler, scheduler, current_priority
+
+# Crawls every guild continuously in the background (channels by latest activity, newest messages first, archived
+# threads included), so that /count doesn't have to: once a guild has been crawled in full, counts for the backfilled
+# emojis are served from the cache, which the gateway events keep up-to-date from there on.
+#
+# Background traversals only get the Scheduler's background workers, and at the HTTP client their requests wait while
+# any interactive traversal is queued or running, and spend at most a share (BOT_BACKFILL_BUDGET) of the global rate limit.
+
+GLOBAL_RATE_LIMIT = 50 # requests/s, https://discord.com/developers/docs/topics/rate-limits#global-rate-limit
+
+backfill_requests = registry.counter('bot_backfill_requests_total', 'Discord requests made by background traversals')
+backfill_waits = registry.histogram('bot_backfill_wait_seconds', 'Time background requests waited on interactive work and the budget')
+backfill_passes = registry.counter('bot_backfill_passes_total', 'Completed backfills of a guild')
+backfill_seconds = registry.histogram('bot_backfill_pass_seconds', 'Duration of a backfill of a guild', buckets=(60, 300, 900, 3600, 4 * 3600, 12 * 3600, 24 * 3600, float('inf')))
+
+# Token bucket: `rate` requests/s on average, bursts of at most `burst`
+class Budget:
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock: # First come first served
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def throttle_http(http: HTTPClient, budget: Budget, scheduler: Scheduler = scheduler) -> None:
+    request = http.request
+
+    async def throttled(route: Route, **kwargs: Any) -> Any:
+        if current_priority.get() == Priority.BACKGROUND:
+            start = time.perf_counter()
+            await scheduler.interactive_idle.wait()
+            await budget.acquire()
+            backfill_waits.observe(time.perf_counter() - start)
+            backfill_requests.inc(path=route.path)
+
+        return await request(route, **kwargs)
+
+    http.request = throttled
+
+def newest_first(channels: Sequence[GuildChannel | Thread]) -> List[GuildChannel | Thread]:
+    return sorted(channels, key=lambda channel: getattr(channel, 'last_message_id', None) or 0, reverse=True)
+
+class Backfill:
+
+    def __init__(self, client: discord.Client, cache: Cache, emojis: Sequence[Any], interval: float, budget: Budget):
+        self.client = client
+        self.cache = cache
+        self.emojis = list(emojis)
+        self.interval = interval # Seconds between passes over all guilds
+        self.budget = budget
+
+        self.caught_up: Dict[int, datetime] = {} # guild id -> when its last full pass started
+        self.traverser: Optional[DiscordTraverser] = None
+        self.task: Optional[asyncio.Task] = None
+
+    # Whether counting these emojis in this guild can skip crawling: the cache has all of it (up to the gateway events)
+    def covers(self, guild: Optional[Guild], emojis: Sequence[Any]) -> bool:
+        return guild is not None and guild.id in self.caught_up and set(map(str, emojis)) <= set(map(str, self.emojis))
+
+    def start(self) -> asyncio.Task:
+        throttle_http(self.client.http, self.budget)
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def run(self) -> None:
+        await self.client.wait_until_ready()
+
+        while not self.client.is_closed():
+            for guild in list(self.client.guilds):
+                try:
+                    await self.backfill(guild)
+                except Exception:
+                    print(traceback.format_exc())
+
+            await asyncio.sleep(self.interval)
+
+    async def backfill(self, guild: Guild) -> None:
+        started_at, start = datetime.now(timezone.utc), time.perf_counter()
+        print(f'Backfilling {guild.name} ({guild.id})')
+
+        self.traverser = DiscordTraverser(cache=self.cache, options=DiscordTraverser.Options(before=None, after=None, emojis=self.emojis), priority=Priority.BACKGROUND, index=self.cache.mirror(ChannelIndex))
+        try:
+            await self.cache.guilds.push(guild)
+            for channel in newest_first(guild.channels): await self.traverser.push_channel(channel) # Which also finds its archived threads
+            for thread in newest_first(guild.threads): await self.traverser.push_thread(thread)
+            await self.traverser.join()
+        finally:
+            self.traverser.cancel()
+
+        self.caught_up[guild.id] = started_at
+        backfill_passes.inc()
+        backfill_seconds.observe(time.perf_counter() - start)
+        print(f'Backfilled {guild.name} ({guild.id}) in {time.perf_counter() - start:.0f}s')
+
+    def cancel(self) -> None:
+        if self.traverser is not None: self.traverser.cancel()
+        if self.task is not None: self.task.cancel()
+
+    @staticmethod
+    def from_env(client: discord.Client, cache: Cache, emojis: Sequence[Any]) -> Optional[Backfill]:
+        if os.environ.get("BOT_BACKFILL", "0") != "1": return None
+
+        share = float(os.environ.get("BOT_BACKFILL_BUDGET", 0.2))
+        return Backfill(
+            client, cache,
+            emojis=[*emojis, *filter(None, os.environ.get("BOT_BACKFILL_EMOJIS", "").split(','))],
+            interval=float(os.environ.get("BOT_BACKFILL_INTERVAL", 6 * 3600)),
+            budget=Budget(rate=GLOBAL_RATE_LIMIT * share, burst=GLOBAL_RATE_LIMIT * share),
+        )
@@ -1,28 +1,45 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import functools
+import gzip
+import hashlib
 import json
 import os
 import subprocess
+import sys
+import time
 import traceback
-from asyncio import Queue, create_task
-from collections import deque
-from dataclasses import dataclass
+from asyncio import create_task, Semaphore, gather, Task, wait
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from contextvars import ContextVar
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
 from datetime import datetime, timezone
 from inspect import isclass
-from itertools import groupby, chain
+from itertools import groupby, chain, islice
+from operator import attrgetter
 from pathlib import Path
 from textwrap import wrap
 from typing import Optional, AsyncIterator, Iterable, Generic, TypeVar, Callable, Any, Deque, List, Awaitable, Dict, \
-    Tuple
+    Tuple, NamedTuple, Set, FrozenSet, Type, Iterator, TYPE_CHECKING
 
 from discord import Message, Guild, Thread, User, Reaction, CategoryChannel, StageChannel, ForumChannel, VoiceChannel, \
-    TextChannel, Member
+    TextChannel, Member, Client, PartialEmoji, Object, NotFound
 from discord.abc import Messageable, GuildChannel
 from discord.mixins import Hashable
 from discord.utils import get, find
 
+from metrics import registry
+from loop_monitor import span
+from scheduler import Priority, Scheduler, scheduler, log_failure, task_seconds, task_failures, current_priority
+from records import Record, record, UserRecord, MemberRecord, ReactionRecord, MessageRecord, GuildRecord, ChannelRecord, \
+    ReactorsRecord
+
+if TYPE_CHECKING:
+    from channel_index import ChannelIndex
 
 def queue(method):
     async def _queue(self, *args, **kwargs) -> None:
@@ -30,8 +47,8 @@ def queue(method):
 
     return _queue
 
-# TODO Python must have better ways of doing this
-class FunctionQueue(Queue):
+# A single request (a ReactionCounter, a backfill, ...) on the process-wide scheduler
+class FunctionQueue:
 
     def add_dynamic_worker(self, func: Callable[[], Awaitable[Any]]):
         async def task():
@@ -39,53 +56,74 @@ class FunctionQueue(Queue):
                 while True:
                     await func()
             except Exception as e:
+                task_failures.inc(error=type(e).__name__)
                 print(f"Task failed with error: {e}")
                 print(traceback.format_exc())
                 raise
 
         self.workers.append(create_task(task()))
-    def add_worker(self):
-        async def do_task():
-            try:
-                func = await self.get()
-                await func()
-
-                self.task_done()
-            except Exception as e:
-                print(f"Task failed with error: {e}")
-                print(traceback.format_exc())
-
-        self.add_dynamic_worker(do_task)
-
-    def __init__(self):
-        super().__init__()
-        self.workers = deque()
-        self.exec = None
 
+    def __init__(self, priority: Priority = Priority.INTERACTIVE, scheduler: Scheduler = scheduler):
+        self.priority = priority
+        self.scheduler = scheduler
+        self.pending: Deque[Callable[[], Awaitable[Any]]] = deque()
+        self.running: Set[Task] = set()
+        self.workers = deque() # dynamic workers, live as long as the request
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.cancelled = False
+
+    def put_nowait(self, func: Callable[[], Awaitable[Any]]) -> None:
+        if self.cancelled: return
+
+        self.pending.append(func)
+        self.idle.clear()
+        self.scheduler.submit(self)
+
+    async def run(self, func: Callable[[], Awaitable[Any]]) -> None:
+        current_priority.set(self.priority) # Copied into the task's context
+        task = create_task(func())
+        self.running.add(task)
+
+        with task_seconds.time(priority=self.priority.name.lower()):
+            await wait({task}) # Doesn't raise when just this request is cancelled
+        self.running.discard(task)
+        log_failure(task)
+
+        if not self.pending and not self.running: self.idle.set()
+
+    async def join(self) -> None:
+        await self.idle.wait()
     async def dump_exec(self):
-        for i in range(3):
-            self.add_worker()
-
-        self.exec = create_task(self.join())
-        await self.exec
-
+        await self.join()
         self.cancel()
 
+    def empty(self) -> bool:
+        return not self.pending and not self.running
     def done(self) -> bool:
         return len(self.workers) == 0 and self.empty()
     def cancel(self) -> None:
-        for worker in self.workers:
-            worker.cancel()
+        self.cancelled = True
+        self.scheduler.cancel(self)
+        self.pending.clear()
 
-        if self.exec is not None: self.exec.cancel()
+        for task in chain(self.workers, self.running):
+            task.cancel()
 
-        self.exec = None
         self.workers.clear()
-        self._init(0) # clears the queue
+        self.running.clear()
+        self.idle.set()
 
 
+push_seconds = registry.histogram('bot_cache_push_seconds', 'Cache.push, including the mirrors')
+git_write_seconds = registry.histogram('bot_git_cache_write_seconds', 'Writing one entry to the GitCache directory')
+git_writes = registry.counter('bot_git_cache_writes_total', 'GitCache pushes, written, skipped as unchanged, removed or failed')
+duplicates = registry.counter('bot_cache_duplicates_total', 'Pushes dropped as already cached (gateway replays, overlapping crawls)')
+traversed = registry.counter('bot_traversed_total', 'Objects pushed by DiscordTraversers')
+
 TObject = TypeVar('TObject')
 TTarget = TypeVar('TTarget')
+TMirror = TypeVar('TMirror')
 
 
 # TODO; No tuple unpacking (lambda (message, reactions):
@@ -97,8 +135,9 @@ class CacheEntry(Generic[TObject]):
         #     self.current = CachedReaction(reaction=current) # Proxied reaction for additional functionality
         # else:
 
-    async def live(self) -> TObject:
-        raise NotImplementedError
+    async def live(self, client: Client) -> TObject:
+        if isinstance(self.current, Record): return await self.current.live(client)
+        return self.current
 
     # TODO: Just this for now until we have a better idea of what to do with an offline mirror\
     @property
@@ -111,21 +150,25 @@ class CacheEntry(Generic[TObject]):
         return self.id == CacheEntry(current=other).id  # TODO Might need to check object type here, but probably not
     
     # TODO: Just isolate to this until we know what to do
-    def is_event(self) -> bool: return isinstance(self.current, Event)
-    def is_user(self) -> bool: return isinstance(self.current, User)
-    def is_member(self) -> bool: return isinstance(self.current, Member)
-    def is_reaction(self) -> bool: return isinstance(self.current, Reaction)
-    def is_message(self) -> bool: return isinstance(self.current, Message)
-    def is_guild(self) -> bool: return isinstance(self.current, Guild)
-    def is_channel(self) -> bool: return isinstance(self.current, GuildChannel)
-    def is_category(self) -> bool: return isinstance(self.current, CategoryChannel)
-    def is_forum(self) -> bool: return isinstance(self.current, ForumChannel)
-    def is_stage(self) -> bool: return isinstance(self.current, StageChannel)
-    def is_voice_channel(self) -> bool: return isinstance(self.current, VoiceChannel)
-    def is_text_channel(self) -> bool: return isinstance(self.current, TextChannel)
-    def is_thread(self) -> bool: return isinstance(self.current, Thread)
-    def is_messageable(self) -> bool: return isinstance(self.current, Messageable)
-
+    def is_event(self) -> bool: return isinstance(self.current, (Event, RawEvent))
+    def is_user(self) -> bool: return isinstance(self.current, (User, UserRecord))
+    def is_member(self) -> bool: return isinstance(self.current, (Member, MemberRecord))
+    def is_reaction(self) -> bool: return isinstance(self.current, (Reaction, ReactionRecord))
+    def is_reactors(self) -> bool: return isinstance(self.current, ReactorsRecord)
+    def is_message(self) -> bool: return isinstance(self.current, (Message, MessageRecord))
+    def is_guild(self) -> bool: return isinstance(self.current, (Guild, GuildRecord))
+    def is_channel(self) -> bool: return isinstance(self.current, GuildChannel) or (self.is_channel_record() and self.current.type_name != 'Thread')
+    def is_category(self) -> bool: return isinstance(self.current, CategoryChannel) or self.is_channel_record('CategoryChannel')
+    def is_forum(self) -> bool: return isinstance(self.current, ForumChannel) or self.is_channel_record('ForumChannel')
+    def is_stage(self) -> bool: return isinstance(self.current, StageChannel) or self.is_channel_record('StageChannel')
+    def is_voice_channel(self) -> bool: return isinstance(self.current, VoiceChannel) or self.is_channel_record('VoiceChannel')
+    def is_text_channel(self) -> bool: return isinstance(self.current, TextChannel) or self.is_channel_record('TextChannel')
+    def is_thread(self) -> bool: return isinstance(self.current, Thread) or self.is_channel_record('Thread')
+    def is_messageable(self) -> bool: return isinstance(self.current, Messageable) or (self.is_channel_record() and self.current.messageable)
+    def is_channel_record(self, type_name: Optional[str] = None) -> bool:
+        return isinstance(self.current, ChannelRecord) and (type_name is None or self.current.type_name == type_name)
+
+    @span('serialization')
     def to_dict(self) -> Dict[str, Any]:
         dump_handled_ids = []
         def quick_dump_compiler(source) -> Any:
@@ -137,7 +180,7 @@ class CacheEntry(Generic[TObject]):
         def quick_dumb_dict_compiler(source: CacheEntry) -> Dict[str, Any]:
             if not hasattr(source.current, '__slots__'): raise Exception(f'cannot compile {type(source.current)}')
 
-            target = {'__type': quick_dump_compiler(source.current.__class__.__name__)} # __type is a bit ugly I suppose
+            target = {'__type': quick_dump_compiler(getattr(source.current, 'type_name', source.current.__class__.__name__))} # __type is a bit ugly I suppose
             if hasattr(source.current, 'id'):
                 target['id'] = source.current.id
                 target['id_b64'] = base64.b64encode(str(source.current.id).encode()).decode()
@@ -172,16 +215,24 @@ class CacheEntry(Generic[TObject]):
 #     def time_window(self) -> [datetime, datetime]:
 #         pass
 
+# (session id, sequence number) of the gateway dispatch being parsed. Set around discord.py's parsers, the handler tasks
+# they create inherit it, so that events know which dispatch they came from (replayed after a RESUME: the same one).
+gateway_dispatch: ContextVar[Optional[Tuple[str, int]]] = ContextVar('gateway_dispatch', default=None)
+
 @dataclass
 class Event:
     name: str
     dispatched_at: datetime
     args: Tuple[Any, ...]
     kwargs: Dict[str, Any]
-    __slots__ = ("name", "dispatched_at", "args", "kwargs")
+    session_id: Optional[str]
+    sequence: Optional[int]
+    __slots__ = ("name", "dispatched_at", "args", "kwargs", "session_id", "sequence")
 
     @property
     def id(self) -> str:
+        if self.sequence is not None: return f'{self.session_id}:{self.sequence}:{self.name}'
+
         def arg_id(arg) -> str:
             entry = CacheEntry(current=arg).to_dict()
             return entry["id"] if "id" in entry else ""
@@ -210,51 +261,226 @@ class Event:
     #
     #     return quick_dumb_compile(self)
 
+# The gateway JSON as received, instead of the discord.py objects reflected back into dicts. Only the fields we query
+# on are pulled out of `data`, the payload itself is persisted as-is.
+@dataclass
+class RawEvent:
+    name: str # gateway dispatch type, ex: MESSAGE_REACTION_ADD
+    dispatched_at: datetime
+    data: Dict[str, Any]
+    guild_id: Optional[int]
+    channel_id: Optional[int]
+    message_id: Optional[int]
+    user_id: Optional[int]
+    emoji: Optional[str]
+    session_id: Optional[str]
+    sequence: Optional[int]
+    __slots__ = ("name", "dispatched_at", "data", "guild_id", "channel_id", "message_id", "user_id", "emoji", "session_id", "sequence")
+
+    @staticmethod
+    def of(name: str, data: Dict[str, Any], dispatch: Optional[Tuple[str, int]] = None) -> RawEvent:
+        def snowflake(value: Optional[str]) -> Optional[int]: return None if value is None else int(value)
+
+        message_id = data.get('message_id', data.get('id') if name.startswith('MESSAGE_') else None)
+        user_id = data.get('user_id', (data.get('author') or data.get('user') or {}).get('id'))
+        emoji = data.get('emoji')
+
+        return RawEvent(
+            name=sys.intern(name),
+            dispatched_at=datetime.now(timezone.utc),
+            data=data,
+            guild_id=snowflake(data.get('guild_id')),
+            channel_id=snowflake(data.get('channel_id')),
+            message_id=snowflake(message_id),
+            user_id=snowflake(user_id),
+            emoji=None if emoji is None else sys.intern(str(PartialEmoji.from_dict(emoji))),
+            session_id=dispatch and dispatch[0],
+            sequence=dispatch and dispatch[1],
+        )
+
+    @property
+    def id(self) -> str:
+        if self.sequence is not None: return f'{self.session_id}:{self.sequence}:{self.name}'
+        return (f':{self.dispatched_at.timestamp()}'
+                f'{self.name}'
+                f':{":".join(str(getattr(self, attr) or "") for attr in ("guild_id", "channel_id", "message_id", "user_id", "emoji"))}'
+                )
+
+# Entries hold Records instead of the live discord.py objects, also for the arguments of events
+def snapshot(obj: Any) -> Any:
+    if isinstance(obj, Event): return replace(obj, args=tuple(map(record, obj.args)), kwargs={key: record(value) for key, value in obj.kwargs.items()})
+    return record(obj)
+
+_MISSING = object()
+
+def attribute(obj: Any, path: str) -> Any:
+    # Same nesting convention as discord.utils.get: 'message__author__id'
+    try:
+        return attrgetter(path.replace('__', '.'))(obj)
+    except AttributeError:
+        return _MISSING
+
+@dataclass
+class Aggregate:
+    func: str # 'count' | 'sum' | 'min' | 'max'
+    attr: Optional[str] = None
+
+    def apply(self, objects: List[Any]) -> Any:
+        if self.func == 'count': return len(objects)
+
+        values = [value for value in map(lambda obj: attribute(obj, self.attr), objects) if value is not _MISSING]
+        if self.func == 'sum': return sum(values)
+        if self.func == 'min': return min(values, default=None)
+        if self.func == 'max': return max(values, default=None)
+        raise NotImplementedError(self.func)
+
+class Group(NamedTuple):
+    key: Any
+    values: Cache
+    aggregates: Dict[str, Any]
+
+# Declarative version of the get_all/filter/group_by/sort chains, so that a backend can compile it down (index lookups,
+# SQL, ...) instead of running lambdas over every entry. Anything not overriding Cache.execute evaluates it in-process.
+@dataclass
+class Query:
+    kind: Optional[str] = None # Matches CacheEntry.is_<kind>, set by the typed views (cache.messages, ...)
+    where: Dict[str, Any] = field(default_factory=dict) # attribute equality
+    between: Dict[str, Tuple[Optional[Any], Optional[Any]]] = field(default_factory=dict) # attribute -> [low, high)
+    group_by: Optional[str] = None
+    aggregates: Dict[str, Aggregate] = field(default_factory=dict) # only used with group_by
+    order_by: Optional[str] = None # attribute, or aggregate name when grouped
+    descending: bool = False
+    limit: Optional[int] = None
+
+    def matches(self, entry: CacheEntry) -> bool:
+        if self.kind is not None and not getattr(entry, f'is_{self.kind}')(): return False
+
+        for attr, value in self.where.items():
+            if attribute(entry.current, attr) != value: return False
+        for attr, (low, high) in self.between.items():
+            value = attribute(entry.current, attr)
+            if value is _MISSING or value is None: return False
+            if low is not None and value < low: return False
+            if high is not None and value >= high: return False
+
+        return True
+
+    def order_key(self, entry: CacheEntry) -> Any:
+        if isinstance(entry.current, Group): return entry.current.aggregates[self.order_by]
+        return attribute(entry.current, self.order_by)
+
+    @span('cache query')
+    def evaluate(self, entries: Iterable[CacheEntry]) -> List[CacheEntry]:
+        result = [entry for entry in entries if self.matches(entry)]
+
+        if self.group_by is not None:
+            groups: Dict[Any, List[CacheEntry]] = {}
+            for entry in result: groups.setdefault(attribute(entry.current, self.group_by), []).append(entry)
+
+            result = [CacheEntry(current=Group(
+                key=key,
+                values=MemoryCache(entries=values),
+                aggregates={name: aggregate.apply([entry.current for entry in values]) for name, aggregate in self.aggregates.items()}
+            )) for key, values in groups.items()]
+
+        if self.order_by is not None: result.sort(key=self.order_key, reverse=self.descending)
+        if self.limit is not None: result = result[:self.limit]
+
+        return result
+
 # Note: run.py doesn't have a way of hooking into its caching mechanism (state.py), just implement it separately
 # TODO: Can probably be a lot cleaner - but just to isolate the functionality for now to forward to a db at somepoint
+# What was pushed last, so that pushing it again (a dispatch replayed after a RESUME, a message read again by an
+# overlapping crawl, ...) is dropped before the storage and mirrors. Objects are known by their id and a hash of the
+# snapshot as their version (an object changing back to an earlier state is still pushed), events by their gateway
+# dispatch. Holds at most `capacity` (id hash, version hash) pairs, the least recently pushed are forgotten first:
+# those are just pushed through again.
+class Seen:
+
+    def __init__(self, capacity: int = 100_000):
+        self.capacity = capacity
+        self.versions: OrderedDict[int, int] = OrderedDict()
+
+    @staticmethod
+    def key(entry: CacheEntry) -> Optional[Tuple[int, int]]:
+        current = entry.current
+        if isinstance(current, (Event, RawEvent)):
+            return None if current.sequence is None else (hash(entry.id), 0) # Otherwise unique anyway (dispatched_at)
+        if not isinstance(current, Record): return None # discord.py objects hash by their id alone
+        try:
+            return hash((getattr(current, 'type_name', type(current).__name__), entry.id)), hash(current)
+        except TypeError: # Unhashable
+            return None
+
+    def duplicate(self, entry: CacheEntry) -> bool:
+        key = Seen.key(entry)
+        if key is None: return False
+
+        id, version = key
+        seen = self.versions.get(id) == version
+        self.versions[id] = version
+        self.versions.move_to_end(id)
+        if len(self.versions) > self.capacity: self.versions.popitem(last=False)
+        return seen
+
+    def forget(self, entries: Iterable[CacheEntry]) -> None:
+        for entry in entries:
+            key = Seen.key(entry)
+            if key is not None: self.versions.pop(key[0], None)
+
 class Cache(Generic[TObject]):
 
-    def __init__(self, parent: Optional[Cache] = None, mirrors: Optional[Iterable[Cache]] = None):
+    def __init__(self, parent: Optional[Cache] = None, mirrors: Optional[Iterable[Cache]] = None, seen: Optional[Seen] = None):
         self.parent = parent
         self.mirrors = mirrors
+        self.seen = seen # Only on the root cache, which pushes go through
 
     async def initialize(self):
         if self.mirrors:
             for mirror in self.mirrors: await mirror.initialize()
+    async def close(self):
+        if self.mirrors:
+            for mirror in self.mirrors: await mirror.close()
 
     @functools.cached_property
     def objects(self) -> Cache[Hashable]:
         return self if self.parent is None else self.parent.objects
 
+    # Mirrors also serve as derived views (histograms, ...), find one by its type
+    def mirror(self, type: Type[TMirror]) -> Optional[TMirror]:
+        return next(filter(lambda mirror: isinstance(mirror, type), self.objects.mirrors or []), None)
+
     # TODO: Could use channel.type here
     @functools.cached_property
-    def events(self) -> Cache[Event]: return self.objects.filter(lambda o: o.is_event())
+    def events(self) -> Cache[Event]: return self.objects.filter(lambda o: o.is_event(), kind='event')
     @functools.cached_property
-    def users(self) -> Cache[User]: return self.objects.filter(lambda o: o.is_user())
+    def users(self) -> Cache[User]: return self.objects.filter(lambda o: o.is_user(), kind='user')
     @functools.cached_property
-    def members(self) -> Cache[Member]: return self.objects.filter(lambda o: o.is_member())
+    def members(self) -> Cache[Member]: return self.objects.filter(lambda o: o.is_member(), kind='member')
     @functools.cached_property
     def reactions(self) -> Cache[Reaction]: return self.messages.flat_map(lambda message: message.current.reactions)
     @functools.cached_property
-    def messages(self) -> Cache[Message]: return self.objects.filter(lambda o: o.is_message())
+    def reactors(self) -> Cache[ReactorsRecord]: return self.objects.filter(lambda o: o.is_reactors(), kind='reactors')
     @functools.cached_property
-    def guilds(self) -> Cache[Guild]: return self.objects.filter(lambda o: o.is_guild())
+    def messages(self) -> Cache[Message]: return self.objects.filter(lambda o: o.is_message(), kind='message')
     @functools.cached_property
-    def channels(self) -> Cache[GuildChannel]: return self.objects.filter(lambda o: o.is_channel())
+    def guilds(self) -> Cache[Guild]: return self.objects.filter(lambda o: o.is_guild(), kind='guild')
     @functools.cached_property
-    def categories(self) -> Cache[CategoryChannel]: return self.objects.filter(lambda o: o.is_category())
+    def channels(self) -> Cache[GuildChannel]: return self.objects.filter(lambda o: o.is_channel(), kind='channel')
     @functools.cached_property
-    def forums(self) -> Cache[ForumChannel]: return self.objects.filter(lambda o: o.is_forum())
+    def categories(self) -> Cache[CategoryChannel]: return self.objects.filter(lambda o: o.is_category(), kind='category')
     @functools.cached_property
-    def stages(self) -> Cache[StageChannel]: return self.objects.filter(lambda o: o.is_stage())
+    def forums(self) -> Cache[ForumChannel]: return self.objects.filter(lambda o: o.is_forum(), kind='forum')
     @functools.cached_property
-    def voice_channels(self) -> Cache[VoiceChannel]: return self.objects.filter(lambda o: o.is_voice_channel())
+    def stages(self) -> Cache[StageChannel]: return self.objects.filter(lambda o: o.is_stage(), kind='stage')
     @functools.cached_property
-    def text_channels(self) -> Cache[TextChannel]: return self.objects.filter(lambda o: o.is_text_channel())
+    def voice_channels(self) -> Cache[VoiceChannel]: return self.objects.filter(lambda o: o.is_voice_channel(), kind='voice_channel')
     @functools.cached_property
-    def threads(self) -> Cache[Thread]: return self.objects.filter(lambda o: o.is_thread())
+    def text_channels(self) -> Cache[TextChannel]: return self.objects.filter(lambda o: o.is_text_channel(), kind='text_channel')
     @functools.cached_property
-    def messageables(self) -> Cache[Messageable]: return self.objects.filter(lambda o: o.is_messageable())
+    def threads(self) -> Cache[Thread]: return self.objects.filter(lambda o: o.is_thread(), kind='thread')
+    @functools.cached_property
+    def messageables(self) -> Cache[Messageable]: return self.objects.filter(lambda o: o.is_messageable(), kind='messageable')
 
     def count(self) -> int:
         entries = self.entries()
@@ -272,31 +498,81 @@ class Cache(Generic[TObject]):
     def entries(self) -> List[CacheEntry[TObject]]: # todo iterable
         raise NotImplementedError
     def current(self) -> Iterable[TObject]: return map(lambda entry: entry.current, self.entries())
+    # Entries from a cursor on, a chunk at a time as (cursor to resume after the entry, entry), for going over large
+    # caches without holding a copy of all of them. Cursors are in insertion order; by default they're positions.
+    def scan(self, start: int = 0, chunk: int = 10_000) -> Iterator[List[Tuple[int, CacheEntry[TObject]]]]:
+        entries = self.entries()
+        for position in range(start, len(entries), chunk): yield list(enumerate(entries[position:position + chunk], position + 1))
 
-    async def push(self, object: TObject) -> None:
-        if self.parent: return await self.parent.push(object)
+    # Whether it was pushed, False when it was dropped as a duplicate. checked: the caller already recorded it in `seen`
+    @span('cache push')
+    async def push(self, object: TObject, checked: bool = False) -> bool:
+        if self.parent: return await self.parent.push(object, checked=checked)
 
-        entry = CacheEntry(current=object)
+        entry = CacheEntry(current=snapshot(object))
+        if self.seen is not None and not checked and self.seen.duplicate(entry):
+            duplicates.inc(type=getattr(entry.current, 'type_name', type(entry.current).__name__))
+            return False
 
-        await self.push_entry(entry)
-        if self.mirrors:
-            for mirror in self.mirrors: await mirror.push_entry(entry)
+        with push_seconds.time(type=getattr(entry.current, 'type_name', type(entry.current).__name__)):
+            try:
+                await self.push_entry(entry)
+                if self.mirrors:
+                    for mirror in self.mirrors: await mirror.push_entry(entry)
+            except BaseException:
+                if self.seen is not None: self.seen.forget([entry]) # Pushing it again isn't a duplicate
+                raise
+        return True
     async def push_entry(self, entry: CacheEntry):
         raise NotImplementedError
 
+    # Deletes (message deletes, ...), in one batch for the storage and each mirror
+    async def remove(self, ids: Iterable[int | str]) -> None:
+        if self.parent: return await self.parent.remove(ids)
+
+        entries = [entry for id in set(ids) for entry in self.execute(Query(where=dict(id=id), limit=1))]
+        if not entries: return
+        if self.seen is not None: self.seen.forget(entries)
+
+        await self.remove_entries(entries)
+        if self.mirrors:
+            for mirror in self.mirrors: await mirror.remove_entries(entries)
+    async def remove_entries(self, entries: List[CacheEntry]) -> None:
+        pass # Nothing to forget by default (derived views that only add up, ...)
+
+    # Backends override this to compile the query down, by default it's evaluated in-process
+    def execute(self, query: Query) -> List[CacheEntry[TObject]]:
+        return query.evaluate(self.entries())
+    def query(self, **kwargs: Any) -> Cache[TObject]:
+        query = Query(**kwargs)
+
+        class QueryCache(Cache):
+            def entries(self) -> List[CacheEntry[TObject]]:
+                return self.parent.execute(query)
+
+        return QueryCache(parent=self)
+
     # Helper functions
     def get(self, **attrs: Any) -> Optional[TObject]:
-        return get(self.current(), **attrs)
+        entry = next(iter(self.execute(Query(where=attrs, limit=1))), None)
+        return None if entry is None else entry.current
     def get_all(self, **attrs: Any) -> Cache[TObject]:
-        return self.filter(lambda entry: get([entry.current], **attrs) is not None)
+        return self.query(where=attrs)
     def find(self, predicate: Callable[[TObject], bool]) -> Optional[TObject]:
         return find(predicate, self.current())
 
     # TODO ; These just temps
-    def filter(self, predicate: Callable[[CacheEntry[TObject]], bool]) -> Cache[TObject]:
+    def filter(self, predicate: Callable[[CacheEntry[TObject]], bool], kind: Optional[str] = None) -> Cache[TObject]:
         class FilteredCache(Cache):
             def entries(self) -> List[CacheEntry[TObject]]:
                 return list(filter(predicate, self.parent.entries()))
+            def scan(self, start: int = 0, chunk: int = 10_000) -> Iterator[List[Tuple[int, CacheEntry[TObject]]]]:
+                for entries in self.parent.scan(start=start, chunk=chunk):
+                    if matched := [(cursor, entry) for cursor, entry in entries if predicate(entry)]: yield matched
+            def execute(self, query: Query) -> List[CacheEntry[TObject]]:
+                # Typed views are just a kind filter, which lets the query through to the backend
+                if kind is None or query.kind is not None: return super().execute(query)
+                return self.parent.execute(replace(query, kind=kind))
 
         return FilteredCache(parent=self)
     def map(self, func) -> Cache[TTarget]:
@@ -328,29 +604,171 @@ class Cache(Generic[TObject]):
     def first(self) -> Optional[CacheEntry[TObject]]: return None if self.empty() else self.entries()[0]
     def last(self) -> Optional[CacheEntry[TObject]]: return None if self.empty() else self.entries()[-1]
 
+# Entries are numbered in insertion order (their sequence), which is what scan cursors are: removing an entry only
+# leaves a hole (None) in its slot, so later cursors stay valid, and the holes are compacted away once they're half.
 class MemoryCache(Cache):
-    _entries: Deque[CacheEntry[TObject]] # TODO DOESNT WORK WITH MAP/FILTER YET
+    _entries: List[Optional[CacheEntry[TObject]]] # TODO DOESNT WORK WITH MAP/FILTER YET
+    _sequences: List[int] # Of each slot, ascending
+
+    _index: Dict[int | str, CacheEntry[TObject]]
+    _sequence_of: Dict[int | str, int]
+    _by_message: Dict[int, Set[int | str]] # message id -> ids of its reactions/reactors
 
     def __init__(self, entries: Optional[Iterable[TObject]] = None, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._entries = deque(entries or [])
+        self._entries = list(entries or [])
+        self._sequences = list(range(len(self._entries)))
+        self._next = len(self._entries)
+        self._removed = 0
+
+        self._index, self._sequence_of, self._by_message = {}, {}, {}
+        for sequence, entry in enumerate(self._entries):
+            if hasattr(entry.current, 'id'): self.indexed(entry, sequence)
+
+    def indexed(self, entry: CacheEntry, sequence: int) -> None:
+        self._index[entry.id] = entry
+        self._sequence_of[entry.id] = sequence
+        if isinstance(entry.current, Record) and (message_id := getattr(entry.current, 'message_id', None)) is not None:
+            self._by_message.setdefault(message_id, set()).add(entry.id)
 
     def entries(self) -> List[CacheEntry[TObject]]:
-        return list(self._entries)
+        return [entry for entry in self._entries if entry is not None]
+    def scan(self, start: int = 0, chunk: int = 10_000) -> Iterator[List[Tuple[int, CacheEntry[TObject]]]]:
+        # Looked up again for every chunk: pushes and removals in between are fine
+        while (position := bisect_left(self._sequences, start)) < len(self._entries):
+            sequences, entries = self._sequences[position:position + chunk], self._entries[position:position + chunk]
+            start = sequences[-1] + 1
+            if chunk_entries := [(sequence + 1, entry) for sequence, entry in zip(sequences, entries) if entry is not None]: yield chunk_entries
+    @span('cache query')
+    def execute(self, query: Query) -> List[CacheEntry[TObject]]:
+        # Point lookups go through the indexes instead of a scan
+        if 'id' in query.where:
+            entry = self._index.get(query.where['id'])
+            return query.evaluate([] if entry is None else [entry])
+        if 'message_id' in query.where:
+            return query.evaluate([self._index[id] for id in self._by_message.get(query.where['message_id'], ())])
+
+        return super().execute(query)
+    async def remove_entries(self, entries: List[CacheEntry]) -> None:
+        for entry in entries:
+            if self._index.pop(entry.id, None) is None: continue
+
+            self._entries[bisect_left(self._sequences, self._sequence_of.pop(entry.id))] = None
+            self._removed += 1
+            if isinstance(entry.current, Record) and (ids := self._by_message.get(getattr(entry.current, 'message_id', None))) is not None:
+                ids.discard(entry.id)
+                if not ids: del self._by_message[entry.current.message_id]
+
+        if self._removed > len(self._entries) // 2: self.compact()
+    def compact(self) -> None:
+        live = [(sequence, entry) for sequence, entry in zip(self._sequences, self._entries) if entry is not None]
+        self._sequences, self._entries = [sequence for sequence, entry in live], [entry for sequence, entry in live]
+        self._removed = 0
+    @span('cache push')
     async def push_entry(self, entry: CacheEntry):
-        cached_entry = get(self.entries(), id=entry.id)
+        cached_entry = self._index.get(entry.id)
         if cached_entry is not None:
             cached_entry.current = entry.current # TODO; Now it's just last found, this will probably have to be different
             return
 
         self._entries.append(entry)
+        self._sequences.append(self._next)
+        self.indexed(entry, self._next)
+        self._next += 1
+class GitLayout(NamedTuple):
+    directory: str
+    # None is the original layout (<type>/<id_b64[:2]>/<id_b64[2:4]>/<id_b64[4:]>/<id_b64>.json), which puts nearly
+    # everything under the same few directories since ids share their leading digits. Otherwise the number of hex
+    # characters of a hash of the id per directory level, ex: (2, 2) -> <type>/ab/cd/<id_b64>.json
+    fanout: Optional[Tuple[int, ...]] = None
+    compress: bool = False # gzip, stored as <id_b64>.json.gz
+
+    def path(self, type_name: str, id_b64: str) -> Path:
+        if self.fanout is None:
+            dir = f'{self.directory}/{type_name}/{"/".join(wrap(id_b64[:4], 2))}/{id_b64[4:]}' # git-like object store
+        else:
+            digest = hashlib.sha1(id_b64.encode()).hexdigest()
+            levels, start = [], 0
+            for width in self.fanout:
+                levels.append(digest[start:start + width])
+                start += width
+            dir = f'{self.directory}/{type_name}/{"/".join(levels)}'
+
+        return Path(f'{dir}/{id_b64}.json{".gz" if self.compress else ""}')
+
+# A removed object, for write_objects
+class Tombstone(NamedTuple):
+    type_name: str
+    id: int | str
+
+    @staticmethod
+    def of(entry: CacheEntry) -> Tombstone:
+        return Tombstone(type_name=getattr(entry.current, 'type_name', type(entry.current).__name__), id=entry.id)
+
+# What's on disk is per type: a User and a Member, or a guild and its #general, share an id
+GitKey = Tuple[str, int | str]
+def git_key(current: Any, id: int | str) -> GitKey:
+    return (current.type_name, current.id) if isinstance(current, Tombstone) else (getattr(current, 'type_name', type(current).__name__), id)
+
+WRITE_ONCE = ('Event', 'RawEvent') # Unique per dispatch, no need to remember their hashes
+
+# Serializes and writes a batch of (snapshotted) objects, given the hash of what's known to be on disk for each:
+# -> (key, hash of the content, path when it actually wrote (or removed: empty hash)). Touches no shared state, so it runs on the loop or in a
+# worker thread/process alike.
+@span('mirror write')
+def write_objects(layout: GitLayout, objects: List[Tuple[Any, Optional[bytes]]]) -> List[Tuple[GitKey, bytes, Optional[Path]]]:
+    written = []
+    for current, known in objects:
+        if isinstance(current, Tombstone):
+            path = layout.path(current.type_name, base64.b64encode(str(current.id).encode()).decode())
+            path.unlink(missing_ok=True)
+            written.append((git_key(current, current.id), b'', path))
+            continue
+
+        obj = CacheEntry(current=current).to_dict()
+        path = layout.path(obj["__type"], obj['id_b64'])
+
+        # https://stackoverflow.com/a/36142844/22730673
+        content = (json.dumps(obj, indent=2, sort_keys=True, default=str) + '\n').encode()
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+
+        # After a restart, what's already on disk (from the clone) counts as written
+        if known is None and path.exists():
+            existing = path.read_bytes()
+            known = hashlib.blake2b(gzip.decompress(existing) if layout.compress else existing, digest_size=16).digest()
+        if known == digest:
+            written.append((git_key(current, obj['id']), digest, None))
+            continue
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(gzip.compress(content, mtime=0) if layout.compress else content) # mtime=0: same content, same bytes
+        written.append((git_key(current, obj['id']), digest, path))
+
+    return written
+
 class GitCache(Cache):
 
-    def __init__(self, repository: str, directory: str, branch: str, *args, **kwargs):
+    # executor: None writes inline on the loop, 'thread' or 'process' hands batches to a pool of `workers`. Objects are
+    # spread over that many lanes by (type, id), each writing one batch at a time, so the writes for an object stay in
+    # push order (and one pushed again before its batch went out only gets its last state written). A batch that fails
+    # goes back in its lane and is retried.
+    def __init__(self, repository: str, directory: str, branch: str, *args, fanout: Optional[Tuple[int, ...]] = None, compress: bool = False, executor: Optional[str] = None, workers: int = 4, batch: int = 256, **kwargs):
         super().__init__(*args, **kwargs)
         self.repository = repository
         self.directory = directory
         self.branch = branch
+        self.layout = GitLayout(directory=directory, fanout=fanout, compress=compress)
+        self.hashes: Dict[GitKey, bytes] = {} # (type, id) -> hash of what's on disk, writes of the same content are skipped
+
+        self.pool: Optional[Executor] = None
+        if executor == 'thread': self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='git-cache')
+        elif executor == 'process': self.pool = ProcessPoolExecutor(max_workers=workers)
+        elif executor is not None: raise ValueError(f'Unknown executor "{executor}", expected "thread" or "process"')
+        self.batch = batch
+        self.lanes: List[Dict[GitKey, Any]] = [{} for i in range(workers if self.pool else 0)] # (type, id) -> latest state, not yet handed out
+        self.flushing: List[Optional[Task]] = [None] * len(self.lanes)
+        self.drained = asyncio.Event()
+        self.drained.set()
 
     async def clone(self):
         # note that it doesn't support dynamic changes to self.directory
@@ -365,32 +783,103 @@ class GitCache(Cache):
     async def initialize(self):
         await self.clone()
 
+    @span('mirror write')
     async def push_entry(self, entry: CacheEntry):
-        obj = entry.to_dict()
-        id = obj['id_b64']
-        dir = (f'{self.directory}'
-               f'/{obj["__type"]}'
-               f'/{"/".join(wrap(id[:4], 2))}/{id[4:]}') # git-like object store
-
-        def to_markdown(self) -> str: return self.to_obsidian()
-        def to_obsidian(self) -> str:
-            raise NotImplementedError
-        def to_json() -> str:
-            # https://stackoverflow.com/a/36142844/22730673
-            return json.dumps(obj, indent=2, sort_keys=True, default=str)
-
-        Path(dir).mkdir(parents=True, exist_ok=True)
-        print(to_json(), file=open(f'{dir}/{id}.json', 'w'))
-        print(f'{dir}/{id}.json')
-        # raise NotImplementedError
-        pass
+        if self.pool is None:
+            with git_write_seconds.time():
+                git_writes.inc(result='written' if self.write(entry) else 'unchanged')
+            return
+
+        # Backpressure: a crawl outpacing the disk waits here instead of queueing everything in memory
+        while self.pending() >= self.limit():
+            self.drained.clear()
+            await self.drained.wait()
+
+        key = git_key(entry.current, entry.id)
+        index = hash(key) % len(self.lanes)
+        lane = self.lanes[index]
+        lane.pop(key, None) # Re-pushed: to the back, with its latest state
+        lane[key] = entry.current
+        if self.flushing[index] is None or self.flushing[index].done():
+            self.flushing[index] = create_task(self.flush_lane(index))
+
+    async def remove_entries(self, entries: List[CacheEntry]) -> None:
+        if self.pool is None:
+            self.written(write_objects(self.layout, [(Tombstone.of(entry), None) for entry in entries]))
+            return
+
+        # Through the lanes, after whatever's still queued for these ids
+        for entry in entries: await self.push_entry(CacheEntry(current=Tombstone.of(entry)))
+
+    def pending(self) -> int: return sum(map(len, self.lanes))
+    def limit(self) -> int: return self.batch * len(self.lanes) * 4
+
+    async def flush_lane(self, index: int) -> None:
+        lane, loop = self.lanes[index], asyncio.get_running_loop()
+        while lane:
+            keys = list(islice(lane, self.batch))
+            objects = [(lane.pop(key), self.hashes.get(key)) for key in keys]
+            if self.pending() < self.limit(): self.drained.set()
+
+            start = time.perf_counter()
+            try:
+                written = await loop.run_in_executor(self.pool, write_objects, self.layout, objects)
+            except Exception:
+                print(traceback.format_exc())
+                git_writes.inc(len(objects), result='failed')
+
+                # Back in front of the lane, unless pushed again meanwhile (then the newer state goes out)
+                requeued = {key: current for key, (current, known) in zip(keys, objects) if key not in lane}
+                requeued.update(lane)
+                lane.clear()
+                lane.update(requeued)
+                await asyncio.sleep(1)
+                continue
+            git_write_seconds.observe((time.perf_counter() - start) / len(objects))
+
+            self.written(written)
+
+        if self.pending() < self.limit(): self.drained.set()
+
+    def written(self, written: List[Tuple[GitKey, bytes, Optional[Path]]]) -> None:
+        for key, digest, path in written:
+            if not digest:
+                self.hashes.pop(key, None)
+                git_writes.inc(result='removed')
+                print(f'removed {path}')
+                continue
+
+            if key[0] not in WRITE_ONCE: self.hashes[key] = digest
+            git_writes.inc(result='unchanged' if path is None else 'written')
+            if path is not None: print(path)
+
+    # Waits for everything pushed so far to be on disk
+    async def join(self) -> None:
+        while any(task is not None and not task.done() for task in self.flushing):
+            await gather(*(task for task in self.flushing if task is not None))
+    async def close(self) -> None:
+        await super().close()
+        await self.join()
+        if self.pool is not None: self.pool.shutdown()
+
+    def path(self, type_name: str, id_b64: str) -> Path: return self.layout.path(type_name, id_b64)
+
+    # Whether it actually wrote
+    @span('mirror write')
+    def write(self, entry: CacheEntry) -> bool:
+        written = write_objects(self.layout, [(entry.current, self.hashes.get(git_key(entry.current, entry.id)))])
+        self.written(written)
+        return written[0][2] is not None
 
 def cached_event(func: Callable):
     @functools.wraps(func)
     async def method(self, *args, **kwargs):
-        event = Event(name=func.__name__, dispatched_at=datetime.now(timezone.utc), args=args, kwargs=kwargs)
+        # Already persisted as a RawEvent from the gateway payload (duplicates of those aren't parsed at all)
+        if func.__name__ not in getattr(self, 'raw_handlers', ()):
+            dispatch = gateway_dispatch.get()
+            event = Event(name=func.__name__, dispatched_at=datetime.now(timezone.utc), args=args, kwargs=kwargs, session_id=dispatch and dispatch[0], sequence=dispatch and dispatch[1])
+            if not await self.cache.events.push(event): return None # The same dispatch again (replayed after a RESUME), already handled
 
-        await self.cache.events.push(event)
         return await func(self, *args, **kwargs)
 
     return method
@@ -399,6 +888,7 @@ def cached_traversal(cache: Callable[[Cache], Cache]):
     def decorator(func):
         @functools.wraps(func)
         async def method(self, entry, *args, **kwargs):
+            traversed.inc(function=func.__name__)
             await cache(self.cache).push(entry)
             return await func(self, entry, *args, **kwargs)
 
@@ -406,6 +896,19 @@ def cached_traversal(cache: Callable[[Cache], Cache]):
 
     return decorator
 
+# Discord rate limits per route + major parameter (the channel for message routes), bound concurrency on the same. Per
+# priority: background requests wait (at the HTTP client, see backfill.py) while interactive work runs, holding a
+# semaphore it needs would deadlock them.
+class RouteLimiter:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphores: Dict[Tuple[Any, ...], Semaphore] = {}
+
+    def __call__(self, *route: Any) -> Semaphore:
+        return self.semaphores.setdefault(route, Semaphore(self.limit))
+
+route_limiter = RouteLimiter(limit=int(os.environ.get("DISCORD_ROUTE_CONCURRENCY", 2)))
+
 class DiscordTraverser(FunctionQueue):
     cache: Cache
 
@@ -413,16 +916,42 @@ class DiscordTraverser(FunctionQueue):
     class Options:
         before: Optional[datetime] = None,
         after: Optional[datetime] = None,
+        emojis: Optional[List[Any]] = None # Fetches who reacted with these
 
-    def __init__(self, cache: Cache, options: Options = None):
-        super().__init__()
+    # index: plans the crawl (skips what's unchanged since the last full crawl, see ChannelIndex), only used for full
+    # crawls (no before/after)
+    def __init__(self, cache: Cache, options: Options = None, priority: Priority = Priority.INTERACTIVE, index: Optional[ChannelIndex] = None):
+        super().__init__(priority=priority)
         self.cache = cache
         self.options = options
+        self.planner = index
+        self.crawled: Dict[int, int] = {} # Handed to the index once everything is done
+        self.listed: Set[int] = set()
+
+    # From the options as they are when crawling (subclasses set/resolve them after __init__)
+    @property
+    def index(self) -> Optional[ChannelIndex]:
+        if self.options is not None and (self.options.before is not None or self.options.after is not None): return None
+        return self.planner
+    @property
+    def emojis(self) -> FrozenSet[str]: return frozenset(map(str, self.options.emojis or [])) if self.options is not None else frozenset()
+
+    async def join(self) -> None:
+        await super().join()
+        if self.index is not None and not self.cancelled: self.index.complete(self.crawled, self.listed, self.emojis)
+
+    async def push_reaction(self, reaction: Reaction):
+        count = getattr(reaction, 'normal_count', reaction.count) # .users() doesn't include super reactions
+        reactors = self.cache.reactors.get(id=ReactorsRecord.key(reaction.message.id, reaction.emoji))
+        if reactors is not None and reactors.count == count: return # Unchanged, the reaction events keep it up-to-date
 
-    # @cached_traversal(lambda cache: cache.reactions)
-    # async def push_reaction(self, reaction: Reaction):
-        # await self.push(reaction.users())
-        # pass
+        async with route_limiter(current_priority.get(), 'reactions', reaction.message.channel.id):
+            user_ids = [user.id async for user in reaction.users(limit=None)]
+
+        await self.cache.reactors.push(ReactorsRecord.of(reaction, user_ids))
+    @queue
+    async def push_reactions(self, reactions: List[Reaction]):
+        await gather(*map(self.push_reaction, reactions))
     @cached_traversal(lambda cache: cache.users)
     async def push_user(self, user: User):
         pass
@@ -432,18 +961,32 @@ class DiscordTraverser(FunctionQueue):
 
     @cached_traversal(lambda cache: cache.messages)
     async def push_message(self, message: Message):
-        # await self.push(message.reactions)
+        emojis = self.emojis
+        reactions = [reaction for reaction in message.reactions if str(reaction.emoji) in emojis]
+
+        if reactions: await self.push_reactions(reactions)
         # await self.push(message.author)
-        pass
 
     @queue
     @cached_traversal(lambda cache: cache.messageables)
     async def push_messageable(self, channel: Messageable):
-        await self.push(channel.history(
-            before=self.options.before,
-            after=self.options.after,
-            around=None, oldest_first=False, limit=None
-        ))
+        if self.index is None:
+            await self.push(channel.history(
+                before=self.options.before,
+                after=self.options.after,
+                around=None, oldest_first=False, limit=None
+            ))
+            return
+
+        crawl, after = self.index.plan(channel.id, self.emojis)
+        if crawl: await self.push_history(channel, after)
+    @queue
+    async def push_history(self, channel: Messageable, after: Optional[int]):
+        newest = after or 0
+        async for message in channel.history(after=Object(id=after) if after else None, around=None, oldest_first=False, limit=None):
+            newest = max(newest, message.id)
+            await self.push(message)
+        self.crawled[channel.id] = newest # 0: crawled, but no messages
 
     @queue
     @cached_traversal(lambda cache: cache.threads)
@@ -459,10 +1002,28 @@ class DiscordTraverser(FunctionQueue):
 
             # Note: guild/channel.threads is only active (last 30ish days), also include older ones
             # TODO: This can probably also be achieved through 'push_message' by checking if it's a thread
-            if isinstance(channel, ForumChannel):
-                await self.push(channel.archived_threads(limit = None, before = self.options.before))
-            if isinstance(channel, TextChannel):
-                await self.push(channel.archived_threads(limit = None, before = self.options.before, joined = False, private = False))
+            if self.index is not None and channel.id in self.index.listed:
+                # Known from this session's listing and the events since, only fetch the ones with uncrawled messages
+                for thread in self.index.archived(channel.id):
+                    if self.index.plan(thread.id, self.emojis)[0]: await self.push_archived_thread(channel.guild, thread.id)
+            else:
+                await self.push_archived_threads(channel)
+
+    @queue
+    async def push_archived_threads(self, channel: ForumChannel | TextChannel):
+        if isinstance(channel, ForumChannel): threads = channel.archived_threads(limit = None, before = self.options.before)
+        else: threads = channel.archived_threads(limit = None, before = self.options.before, joined = False, private = False)
+
+        async for thread in threads: await self.push_thread(thread)
+        self.listed.add(channel.id)
+    @queue
+    async def push_archived_thread(self, guild: Guild, thread_id: int):
+        try:
+            thread = await guild.fetch_channel(thread_id)
+        except NotFound:
+            self.index.remove(thread_id)
+            return
+        await self.push_thread(thread)
 
     @queue
     @cached_traversal(lambda cache: cache.guilds)
@@ -484,7 +1045,7 @@ class DiscordTraverser(FunctionQueue):
         if isinstance(source, GuildChannel): await self.push_channel(source); return
         if isinstance(source, Message): await self.push_message(source); return
         if isinstance(source, Guild): await self.push_guild(source); return
-        # if isinstance(source, Reaction): await self.push_reaction(source); return
+        if isinstance(source, Reaction): await self.push_reactions([source]); return
         if isinstance(source, User): await self.push_user(source); return
         if isinstance(source, Member): await self.push_member(source); return
 
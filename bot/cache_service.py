@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import pickle
+import struct
+import traceback
+from dataclasses import replace
+from typing import Optional, Any, Set, Tuple, List, Iterable, Iterator
+
+from cache import Cache, CacheEntry, MemoryCache, Event, Query
+from loop_monitor import span
+
+# Sharded deployment: one process owns the cache (the GitCache, derived views, ...) and serves it over a Unix socket.
+# Shard processes push to it and keep a replica, fed by the service in push order, so reads stay local (and synchronous)
+# while every shard sees what all shards cached.
+#
+# Frames are pickles behind a 4-byte length. Pickle is only safe between processes that trust each other, hence the
+# Unix socket, only accessible to the bot's own user.
+
+HEADER = struct.Struct('>I')
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Tuple[Any, ...]]:
+    try:
+        length, = HEADER.unpack(await reader.readexactly(HEADER.size))
+        return pickle.loads(await reader.readexactly(length))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+@span('serialization')
+def frame(message: Tuple[Any, ...]) -> bytes:
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+# Records are plain data, but event arguments can still be live discord.py objects (holding the connection state)
+@span('serialization')
+def portable(object: Any) -> Any:
+    def argument(arg: Any) -> Any:
+        try:
+            pickle.dumps(arg)
+            return arg
+        except Exception:
+            return CacheEntry(current=arg).to_dict() if hasattr(arg, '__slots__') else repr(arg)
+
+    if isinstance(object, Event): return replace(object, args=tuple(map(argument, object.args)), kwargs={key: argument(value) for key, value in object.kwargs.items()})
+    return object
+
+# Mirror of the service's cache: every entry it stores goes out to the subscribed shards
+class CacheService(Cache):
+
+    def __init__(self, cache: Cache, path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+        self.path = path
+        self.subscribers: Set[asyncio.StreamWriter] = set()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+        cache.mirrors = [*(cache.mirrors or []), self]
+
+    async def push_entry(self, entry: CacheEntry):
+        data = frame(('entry', entry.current))
+        for writer in list(self.subscribers):
+            writer.write(data)
+            await writer.drain() # A slow shard holds up pushes rather than growing unbounded buffers
+
+    async def remove_entries(self, entries: List[CacheEntry]):
+        data = frame(('remove', [entry.id for entry in entries]))
+        for writer in list(self.subscribers):
+            writer.write(data)
+            await writer.drain()
+
+    async def serve(self) -> None:
+        if os.path.exists(self.path): os.remove(self.path)
+
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        print(f'Serving the cache to shards on {self.path}')
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while (message := await read_frame(reader)) is not None:
+                kind, *args = message
+                if kind == 'push':
+                    await self.cache.push(args[0])
+                elif kind == 'remove':
+                    await self.cache.remove(args[0])
+                elif kind == 'subscribe':
+                    # Subscribed before the first await, so pushes from here on reach it too (in between the snapshot's
+                    # chunks, each read as it's sent: removed objects aren't sent again, updated ones with their latest state)
+                    self.subscribers.add(writer)
+                    for entries in self.cache.scan(chunk=1_000):
+                        writer.write(b''.join(frame(('entry', entry.current)) for cursor, entry in entries))
+                        await writer.drain() # A chunk of the snapshot buffered at a time
+                    writer.write(frame(('synced',)))
+                    await writer.drain()
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+# A shard's view of the service: pushes go to the service (and straight into the replica, so a shard reads its own
+# writes), the replica follows everything the service stores. Duplicates (with `seen`) are dropped before they're sent,
+# and pushing the same record twice is a no-op for the MemoryCache and its mirrors anyway. Once the service is lost the
+# replica no longer follows it, so from then on pushes and reads raise instead of serving stale data.
+class RemoteCache(MemoryCache):
+
+    def __init__(self, path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.lost = False
+
+    async def initialize(self):
+        await super().initialize()
+        reader, self.writer = await asyncio.open_unix_connection(path=self.path)
+        self.writer.write(frame(('subscribe',)))
+
+        synced = asyncio.get_running_loop().create_future()
+        self.reader_task = asyncio.create_task(self.follow(reader, synced))
+        await synced
+        print(f'Replicated {self.count():,} objects from {self.path}')
+
+    async def follow(self, reader: asyncio.StreamReader, synced: asyncio.Future) -> None:
+        while (message := await read_frame(reader)) is not None:
+            kind, *args = message
+            if kind == 'synced':
+                synced.set_result(None)
+                continue
+
+            if kind == 'remove': await self.unreplicate(args[0])
+            else: await self.replicate(CacheEntry(current=args[0]))
+
+        self.lost = True
+        self.writer.close()
+        if not synced.done(): synced.set_exception(ConnectionError(f'Cache service at {self.path} closed the connection'))
+        print(f'Lost the cache service at {self.path}')
+
+    def connected(self) -> None:
+        if self.lost: raise ConnectionError(f'Lost the cache service at {self.path}, the replica is stale')
+
+    def entries(self) -> List[CacheEntry]:
+        self.connected()
+        return super().entries()
+    def scan(self, start: int = 0, chunk: int = 10_000) -> Iterator[List[Tuple[int, CacheEntry]]]:
+        self.connected()
+        return super().scan(start=start, chunk=chunk)
+    def execute(self, query: Query) -> List[CacheEntry]:
+        self.connected()
+        return super().execute(query)
+
+    async def replicate(self, entry: CacheEntry) -> None:
+        await MemoryCache.push_entry(self, entry) # Not back to the service
+        if self.mirrors:
+            for mirror in self.mirrors: await mirror.push_entry(entry)
+
+    async def unreplicate(self, ids: List[int | str]) -> None:
+        await Cache.remove(self, ids) # Only the replica and its mirrors, the service already removed them
+
+    async def push_entry(self, entry: CacheEntry) -> None:
+        self.connected()
+        self.writer.write(frame(('push', portable(entry.current))))
+        await super().push_entry(entry)
+        await self.writer.drain()
+
+    async def remove(self, ids: Iterable[int | str]) -> None:
+        self.connected()
+        ids = list(ids)
+        self.writer.write(frame(('remove', ids)))
+        await super().remove(ids)
+        await self.writer.drain()
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import json
+from dataclasses import replace
+from pathlib import Path
+from typing import Dict, Optional, Set, FrozenSet, List, Tuple
+
+from cache import Cache, CacheEntry
+from loop_monitor import span
+from records import ChannelRecord, MessageRecord
+
+# Every channel and thread (archived ones included) with the newest message id in it, kept up-to-date as a mirror of the
+# cache (channel records pushed by traversals) and by the channel/thread/message events. Traversals use it to plan:
+#  - a messageable whose history was crawled in full up to its newest message is skipped, one with new messages is only
+#    crawled after what was crawled before
+#  - archived threads are only listed (archived_threads() pagination) once per session, after that the events keep
+#    track of threads being archived
+#
+# A crawl only skips what was crawled for (at least) the same emojis, reactors for others are fetched by crawling it all.
+#
+# What was crawled is persisted (path), the rest is rebuilt each session from the guilds (READY) and the traversals.
+# What was crawled is only skipped if it's in the cache, so the persisted state is only used when the cache was restored
+# (restored), a cache starting out empty crawls everything again. Reactions added to older messages while the bot was
+# offline aren't picked up by skipped channels, /count with skip_cache does a full crawl.
+class ChannelIndex(Cache):
+
+    def __init__(self, path: Optional[str] = None, *args, restored: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self.restored = restored
+        self.channels: Dict[int, ChannelRecord] = {}
+        self.crawled: Dict[int, Tuple[int, FrozenSet[str]]] = {} # messageable id -> (newest message id its history was crawled in full up to, for which emojis)
+        self.listed: Set[int] = set() # channels whose archived threads were listed this session
+
+    async def initialize(self):
+        if self.restored and self.path is not None and Path(self.path).exists():
+            self.crawled = {
+                int(id): (crawled, frozenset()) if isinstance(crawled, int) else (crawled['message_id'], frozenset(crawled['emojis'])) # Before emojis were kept
+                for id, crawled in json.loads(Path(self.path).read_text()).items()
+            }
+
+    @span('mirror write')
+    async def push_entry(self, entry: CacheEntry):
+        if isinstance(entry.current, ChannelRecord): self.update(entry.current)
+        elif isinstance(entry.current, MessageRecord): self.message(entry.current.channel_id, entry.current.id)
+
+    def update(self, channel: ChannelRecord) -> None:
+        current = self.channels.get(channel.id)
+        if current is not None and (current.last_message_id or 0) > (channel.last_message_id or 0):
+            channel = replace(channel, last_message_id=current.last_message_id) # Records from older snapshots
+        self.channels[channel.id] = channel
+
+    def message(self, channel_id: int, message_id: int) -> None:
+        channel = self.channels.get(channel_id)
+        if channel is not None and (channel.last_message_id or 0) < message_id: self.channels[channel_id] = replace(channel, last_message_id=message_id)
+
+    def remove(self, channel_id: int) -> None:
+        self.channels.pop(channel_id, None)
+        self.crawled.pop(channel_id, None)
+        self.listed.discard(channel_id)
+
+    def archived(self, channel_id: int) -> List[ChannelRecord]:
+        return [channel for channel in self.channels.values() if channel.parent_id == channel_id and channel.type_name == 'Thread' and channel.archived]
+
+    # (whether its history needs crawling, after which message id) - only for full crawls, not a date range
+    def plan(self, channel_id: int, emojis: FrozenSet[str] = frozenset()) -> Tuple[bool, Optional[int]]:
+        crawled = self.crawled.get(channel_id)
+        channel = self.channels.get(channel_id)
+        if crawled is None or channel is None or not emojis <= crawled[1]: return True, None
+        message_id = crawled[0]
+        if channel.last_message_id is None or channel.last_message_id <= message_id: return False, message_id
+        return True, message_id
+
+    # Called once a traversal finished (wasn't cancelled): everything it pushed is in the cache, along with the reactors
+    # for its emojis, which adds to what the channel was covered for
+    def complete(self, crawled: Dict[int, int], listed: Set[int], emojis: FrozenSet[str] = frozenset()) -> None:
+        for channel_id, message_id in crawled.items():
+            previous_id, previous_emojis = self.crawled.get(channel_id, (0, frozenset()))
+            self.crawled[channel_id] = (max(message_id, previous_id), previous_emojis | emojis)
+        self.listed.update(listed)
+        self.save()
+
+    def save(self) -> None:
+        if self.path is None: return
+
+        file = Path(self.path)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        temporary = file.with_suffix(f'{file.suffix}.tmp')
+        temporary.write_text(json.dumps({id: {'message_id': message_id, 'emojis': sorted(emojis)} for id, (message_id, emojis) in self.crawled.items()}, sort_keys=True))
+        temporary.replace(file)
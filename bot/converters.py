@@ -16,6 +16,11 @@ class DatetimeConverter(Converter):
         except:
             raise BadArgument(f'"{argument}" could not be parsed to a date')
 
+# Parsed dates without a timezone are in local time (like discord.py assumes), compare them to snowflake times as such
+def aware(date: Optional[datetime]) -> Optional[datetime]:
+    if date is None or date.tzinfo is not None: return date
+    return date.astimezone()
+
 # https://discord.com/developers/docs/reference#message-formatting-timestamp-styles
 class TimestampStyle(Enum): t = 't'; T = 'T'; d = 'd'; D = 'D'; f = 'f'; F = 'F'; R = 'R'
 def discord_timestamp(date: Optional[datetime], style: TimestampStyle = TimestampStyle.f, default = "") -> str:
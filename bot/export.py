@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cache import Cache, CacheEntry, Query
+from converters import aware
+from records import Record, from_dict
+
+# Bulk export for analytics: streams records by kind into chunked JSON lines (.ndjson), column-per-array JSON
+# (.columns.json) or Parquet (.parquet, needs `pip install pyarrow`), filtered by guild, channel and time range.
+# At most a chunk of rows is held at once. From the GitCache tree (offline, files are read as they're walked) or, in
+# the bot, from the cache itself.
+#
+# python3 ./bot/export.py ./.bot/cache/git ./export [--kinds message reactors member] [--format parquet] [--guild-id ..] [--channel-id ..] [--after 2024-01-01] [--before ..] [--chunk 100000]
+#
+# Progress is kept in <output>/manifest.json after every chunk (the cursor: the last file exported, or the position in
+# the cache), running it again resumes from there. Remove the output directory to start over.
+
+KINDS = ('message', 'reactors', 'member', 'user', 'guild', 'channel', 'thread') # CacheEntry.is_<kind>
+FORMATS = ('ndjson', 'columns', 'parquet')
+TIMES = {'member': 'joined_at'} # What the time range applies to, created_at otherwise
+
+@dataclass
+class Filters:
+    guild_id: Optional[int] = None
+    channel_id: Optional[int] = None
+    after: Optional[datetime] = None
+    before: Optional[datetime] = None
+
+    def query(self, kind: str) -> Query:
+        where = {key: value for key, value in (('guild_id', self.guild_id), ('channel_id', self.channel_id)) if value is not None}
+        if kind in ('channel', 'thread') and 'channel_id' in where: where['id'] = where.pop('channel_id')
+        if kind == 'guild' and 'guild_id' in where: where['id'] = where.pop('guild_id')
+        return Query(kind=kind, where=where, between={TIMES.get(kind, 'created_at'): (self.after, self.before)} if self.after or self.before else {})
+
+    def kind_of(self, entry: CacheEntry, kinds: Tuple[str, ...]) -> Optional[str]:
+        return next((kind for kind in kinds if self.query(kind).matches(entry)), None)
+
+def row(record: Record) -> Dict[str, Any]:
+    data = CacheEntry(current=record).to_dict()
+    data.pop('id_b64', None)
+    if hasattr(record, 'created_at'): data['created_at'] = record.created_at
+    return data
+
+# Sources: (cursor after the record, record)
+
+def git_records(directory: str, cursor: Optional[str] = None) -> Iterator[Tuple[str, Record]]:
+    # Walked in sorted order (by path parts), skipping whole directories before the cursor
+    after = tuple(cursor.split('/')) if cursor else ()
+
+    def walk(path: Path, parts: Tuple[str, ...]) -> Iterator[Tuple[str, Record]]:
+        for child in sorted(os.scandir(path), key=lambda child: child.name):
+            child_parts = (*parts, child.name)
+            if child.is_dir():
+                if child.name == '.git' or child_parts < after[:len(child_parts)]: continue
+                yield from walk(Path(child.path), child_parts)
+            elif child.name.endswith(('.json', '.json.gz')) and child_parts > after:
+                try:
+                    content = Path(child.path).read_bytes()
+                    record = from_dict(json.loads(gzip.decompress(content) if child.name.endswith('.gz') else content))
+                except (OSError, ValueError):
+                    print(f'Skipping unreadable {child.path}')
+                    continue
+                if record is not None: yield '/'.join(child_parts), record
+
+    yield from walk(Path(directory), ())
+
+def cache_records(cache: Cache, cursor: Optional[int] = None, chunk: int = 10_000) -> Iterator[Tuple[int, Record]]:
+    for entries in cache.objects.scan(start=cursor or 0, chunk=chunk):
+        for position, entry in entries:
+            if isinstance(entry.current, Record): yield position, entry.current
+
+# Writers: one file per chunk
+
+def columns(rows: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    names = sorted({name for row in rows for name in row})
+    def cell(value: Any) -> Any:
+        if isinstance(value, (list, dict)): return json.dumps(value, sort_keys=True, default=str) # Nested (reactions, ...) as JSON text
+        if isinstance(value, datetime): return value.isoformat()
+        return value
+    return {name: [cell(row.get(name)) for row in rows] for name in names}
+
+def write_chunk(path: Path, format: str, rows: List[Dict[str, Any]]) -> Path:
+    temporary = path.with_name(f'{path.name}.tmp')
+
+    if format == 'ndjson':
+        with open(temporary, 'w') as file:
+            for data in rows: file.write(json.dumps(data, sort_keys=True, default=str) + '\n')
+    elif format == 'columns':
+        temporary.write_text(json.dumps(columns(rows), default=str))
+    elif format == 'parquet':
+        import pyarrow, pyarrow.parquet # Optional, only for this format
+        pyarrow.parquet.write_table(pyarrow.table(columns(rows)), temporary)
+    else:
+        raise NotImplementedError(format)
+
+    temporary.replace(path)
+    return path
+
+@dataclass
+class Manifest:
+    path: Path
+    cursor: Any = None
+    chunks: Dict[str, int] = field(default_factory=dict) # kind -> chunks written
+    rows: Dict[str, int] = field(default_factory=dict)
+
+    @staticmethod
+    def load(directory: Path) -> Manifest:
+        path = directory / 'manifest.json'
+        if not path.exists(): return Manifest(path=path)
+        data = json.loads(path.read_text())
+        return Manifest(path=path, cursor=data['cursor'], chunks=data['chunks'], rows=data['rows'])
+
+    def save(self) -> None:
+        temporary = self.path.with_name('manifest.json.tmp')
+        temporary.write_text(json.dumps({'cursor': self.cursor, 'chunks': self.chunks, 'rows': self.rows}, indent=2))
+        temporary.replace(self.path)
+
+# Buffers per kind are all flushed together, so that everything before the saved cursor is on disk
+async def export(records: Iterator[Tuple[Any, Record]], directory: str, kinds: Tuple[str, ...] = KINDS, format: str = 'ndjson', filters: Optional[Filters] = None, chunk: int = 100_000) -> Manifest:
+    output = Path(directory)
+    output.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest.load(output)
+    filters = filters or Filters()
+    extension = {'ndjson': 'ndjson', 'columns': 'columns.json', 'parquet': 'parquet'}[format]
+
+    buffers: Dict[str, List[Dict[str, Any]]] = {kind: [] for kind in kinds}
+    buffered = 0
+    cursor = manifest.cursor
+
+    def flush() -> None:
+        nonlocal buffered
+        for kind, rows in buffers.items():
+            if not rows: continue
+            index = manifest.chunks.get(kind, 0)
+            write_chunk(output / f'{kind}-{index:06d}.{extension}', format, rows)
+            manifest.chunks[kind], manifest.rows[kind] = index + 1, manifest.rows.get(kind, 0) + len(rows)
+            rows.clear()
+        buffered = 0
+        manifest.cursor = cursor
+        manifest.save()
+
+    for cursor, record in records:
+        kind = filters.kind_of(CacheEntry(current=record), kinds)
+        if kind is None: continue
+
+        buffers[kind].append(row(record))
+        buffered += 1
+        if buffered >= chunk:
+            flush()
+            await asyncio.sleep(0) # When exporting from inside the bot, let it handle events in between
+
+    flush()
+    return manifest
+
+def main():
+    def date(value: str) -> datetime: return aware(datetime.fromisoformat(value))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', nargs='?', default=os.environ.get("BOT_CACHE_GIT_DIRECTORY", './.bot/cache/git'))
+    parser.add_argument('output', nargs='?', default='./export')
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS))
+    parser.add_argument('--format', choices=FORMATS, default='ndjson')
+    parser.add_argument('--guild-id', type=int, default=None)
+    parser.add_argument('--channel-id', type=int, default=None)
+    parser.add_argument('--after', type=date, default=None)
+    parser.add_argument('--before', type=date, default=None)
+    parser.add_argument('--chunk', type=int, default=100_000, help='Rows per file')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    cursor = Manifest.load(Path(args.output)).cursor
+    if cursor is not None: print(f'Resuming after {cursor}')
+
+    manifest = asyncio.run(export(
+        git_records(args.directory, cursor=cursor), args.output, kinds=tuple(args.kinds), format=args.format,
+        filters=Filters(guild_id=args.guild_id, channel_id=args.channel_id, after=args.after, before=args.before), chunk=args.chunk,
+    ))
+    print(f'Exported {args.directory} to {args.output} in {time.perf_counter() - start:.2f}s: {", ".join(f"{rows:,} {kind}" for kind, rows in manifest.rows.items())}')
+
+if __name__ == '__main__':
+    main()
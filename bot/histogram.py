@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Tuple, Optional, List, Set, Any, Iterable
+
+from discord.utils import snowflake_time
+
+from cache import Cache, CacheEntry
+from loop_monitor import span
+from records import MessageRecord
+
+DAY = 24 * 60 * 60
+
+def day(at: datetime) -> int: return int(at.timestamp() // DAY)
+def week(day: int) -> int: return (day + 3) // 7 # weeks start on monday (day 0 is a thursday)
+def start_of_day(day: int) -> datetime: return datetime.fromtimestamp(day * DAY, tz=timezone.utc)
+def start_of_week(week: int) -> datetime: return start_of_day(week * 7 - 3)
+
+# Totals per bucket, with prefix sums over the buckets for range queries (rebuilt lazily after updates)
+class Buckets:
+
+    def __init__(self):
+        self.totals: Dict[int, int] = defaultdict(int)
+        self.keys: List[int] = []
+        self.prefix: List[int] = [0]
+        self.dirty = False
+
+    def add(self, bucket: int, delta: int) -> None:
+        self.totals[bucket] += delta
+        self.dirty = True
+
+    def sum(self, start: Optional[int] = None, end: Optional[int] = None) -> int: # buckets [start, end)
+        if self.dirty:
+            self.keys = sorted(self.totals)
+            self.prefix = [0]
+            for key in self.keys: self.prefix.append(self.prefix[-1] + self.totals[key])
+            self.dirty = False
+
+        start_index = 0 if start is None else bisect_left(self.keys, start)
+        end_index = len(self.keys) if end is None else bisect_left(self.keys, end)
+        return self.prefix[max(start_index, end_index)] - self.prefix[start_index]
+
+# Reaction totals per emoji, per (emoji, channel) and per (emoji, author), in day and week buckets. Kept up-to-date as a
+# mirror of the cache: messages pushed with their reactions (the reaction events update the cached messages), and
+# forgotten again when they're deleted.
+class ReactionHistogram(Cache):
+    Key = Tuple[str, Optional[str], Optional[int]] # (emoji, None | 'channel' | 'author', id)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.days: Dict[ReactionHistogram.Key, Buckets] = defaultdict(Buckets)
+        self.weeks: Dict[ReactionHistogram.Key, Buckets] = defaultdict(Buckets)
+        # What's been counted per message, for deltas and the exact edges of a range
+        self.messages: Dict[int, Tuple[int, int, Dict[str, int]]] = {} # message_id -> (channel_id, author_id, {emoji: count})
+        self.messages_by_day: Dict[int, Set[int]] = defaultdict(set)
+
+    @staticmethod
+    def keys(emoji: str, channel_id: int, author_id: int) -> Iterable[ReactionHistogram.Key]:
+        return (emoji, None, None), (emoji, 'channel', channel_id), (emoji, 'author', author_id)
+
+    def apply(self, message_id: int, emoji: str, delta: int) -> None:
+        if delta == 0: return
+        channel_id, author_id, counts = self.messages[message_id]
+        counts[emoji] = counts.get(emoji, 0) + delta
+
+        message_day = day(snowflake_time(message_id))
+        for key in ReactionHistogram.keys(emoji, channel_id, author_id):
+            self.days[key].add(message_day, delta)
+            self.weeks[key].add(week(message_day), delta)
+
+    @span('mirror write')
+    async def push_entry(self, entry: CacheEntry):
+        message = entry.current
+        if not isinstance(message, MessageRecord): return
+
+        if message.id not in self.messages:
+            self.messages[message.id] = (message.channel_id, message.author_id, {})
+            self.messages_by_day[day(message.created_at)].add(message.id)
+
+        counts = dict(self.messages[message.id][2])
+        current = {reaction.emoji: reaction.count for reaction in message.reactions}
+        for emoji in {*counts, *current}: self.apply(message.id, emoji, current.get(emoji, 0) - counts.get(emoji, 0))
+
+    @span('mirror write')
+    async def remove_entries(self, entries: List[CacheEntry]) -> None:
+        for entry in entries:
+            if not isinstance(entry.current, MessageRecord) or entry.current.id not in self.messages: continue
+
+            message_id = entry.current.id
+            for emoji, count in list(self.messages[message_id][2].items()): self.apply(message_id, emoji, -count)
+            del self.messages[message_id]
+            self.messages_by_day[day(entry.current.created_at)].discard(message_id)
+
+    def total(self, emoji: Any, after: Optional[datetime] = None, before: Optional[datetime] = None, channel_id: Optional[int] = None, author_id: Optional[int] = None) -> int:
+        emoji = str(emoji)
+        key = (emoji, 'channel', channel_id) if channel_id is not None else (emoji, 'author', author_id) if author_id is not None else (emoji, None, None)
+        days = self.days[key]
+
+        if after is None and before is None: return days.sum()
+
+        # Full days through the prefix sums, the partial days at the edges exactly from their messages
+        first = None if after is None else day(after) + (start_of_day(day(after)) < after)
+        last = None if before is None else day(before)
+        if first is not None and last is not None and first >= last:
+            return self.exact(key, after, before, range(day(after), last + 1))
+
+        edges = ([day(after)] if after is not None and first != day(after) else []) + ([last] if last is not None else [])
+        return days.sum(first, last) + self.exact(key, after, before, edges)
+
+    def exact(self, key: ReactionHistogram.Key, after: Optional[datetime], before: Optional[datetime], days: Iterable[int]) -> int:
+        emoji, dimension, id = key
+        total = 0
+        for message_day in days:
+            for message_id in self.messages_by_day.get(message_day, ()):
+                created_at = snowflake_time(message_id)
+                if (after is not None and created_at < after) or (before is not None and created_at >= before): continue
+
+                channel_id, author_id, counts = self.messages[message_id]
+                if dimension == 'channel' and channel_id != id: continue
+                if dimension == 'author' and author_id != id: continue
+                total += counts.get(emoji, 0)
+
+        return total
+
+    # (start of the week, total) for the last `number` weeks
+    def weekly(self, emoji: Any, number: int, channel_id: Optional[int] = None) -> List[Tuple[datetime, int]]:
+        key = (str(emoji), 'channel', channel_id) if channel_id is not None else (str(emoji), None, None)
+        current = week(day(datetime.now(timezone.utc)))
+        return [(start_of_week(index), self.weeks[key].sum(index, index + 1)) for index in range(current - number + 1, current + 1)]
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter as Tally, deque
+from dataclasses import dataclass
+from types import CodeType, FrameType
+from typing import Dict, Tuple, Optional, List, Deque, Callable
+
+from discord.http import HTTPClient
+
+from metrics import registry
+
+# Event-loop lag, and what the loop was doing when it stalled. A heartbeat on the loop measures how late it wakes up,
+# while a watchdog thread samples the loop thread's stack whenever the heartbeat is overdue by more than the threshold.
+# Samples are attributed to the innermost named span on the stack: functions marked with @span (cache push, cache
+# query, serialization, mirror write, render, discord http), otherwise 'discord.py' or 'other'. Nothing is measured
+# per call, spans are looked up by code object only when sampling, so it can stay on in production.
+#
+# BOT_LOOP_MONITOR=1 [BOT_LOOP_MONITOR_THRESHOLD=0.1] [BOT_LOOP_MONITOR_WINDOW=3600], report with $lag
+
+SPANS: Dict[CodeType, str] = {}
+STACK_DEPTH = 6 # Frames kept per sample, innermost first
+
+loop_lag_seconds = registry.histogram('bot_loop_lag_seconds', 'How late the event loop heartbeat woke up')
+loop_stalls = registry.counter('bot_loop_stalls_total', 'Heartbeats overdue by more than the threshold')
+loop_stall_seconds = registry.counter('bot_loop_stall_seconds_total', 'Time the event loop was stalled, attributed to spans by sampled stacks')
+
+def span(name: str) -> Callable[[Callable], Callable]:
+    def decorator(func: Callable) -> Callable:
+        SPANS[func.__code__] = name
+        return func
+
+    return decorator
+
+span('discord http')(HTTPClient.request)
+
+Stack = Tuple[str, ...]
+
+def sample(frame: Optional[FrameType]) -> Tuple[str, Stack]:
+    name, stack, depth = None, [], 0
+    while frame is not None and depth < 64:
+        code = frame.f_code
+        if len(stack) < STACK_DEPTH: stack.append(f'{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}')
+        if name is None: name = SPANS.get(code)
+        if name is None and f'{os.sep}discord{os.sep}' in code.co_filename: name = 'discord.py'
+        frame, depth = frame.f_back, depth + 1
+
+    return name or 'other', tuple(stack)
+
+@dataclass
+class Stall:
+    at: float # time.time()
+    seconds: float
+    samples: Tally # (span, stack) -> samples
+
+    def spans(self) -> Dict[str, float]:
+        total = sum(self.samples.values())
+        if total == 0: return {'unsampled': self.seconds}
+
+        seconds: Dict[str, float] = {}
+        for (name, stack), count in self.samples.items(): seconds[name] = seconds.get(name, 0) + self.seconds * count / total
+        return seconds
+
+class LoopMonitor:
+
+    def __init__(self, threshold: float = 0.1, window: float = 3600):
+        self.threshold = threshold
+        self.interval = threshold / 2 # Heartbeat, and how often the watchdog checks on it
+        self.window = window # Of the report
+
+        self.beat = time.monotonic()
+        self.samples: Deque[Tuple[str, Stack]] = deque() # Taken by the watchdog during the current stall
+        self.stalls: Deque[Stall] = deque(maxlen=10_000)
+        self.loop_thread: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stopped = threading.Event()
+
+    def start(self) -> asyncio.Task:
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        threading.Thread(target=self.watch, name='loop-monitor', daemon=True).start()
+        self.task = asyncio.create_task(self.heartbeat())
+        return self.task
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.task is not None: self.task.cancel()
+
+    async def heartbeat(self) -> None:
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - self.beat - self.interval)
+            loop_lag_seconds.observe(lag)
+
+            samples, self.samples = self.samples, deque()
+            if lag < self.threshold: continue
+
+            stall = Stall(at=time.time() - lag, seconds=lag, samples=Tally(samples))
+            self.stalls.append(stall)
+            loop_stalls.inc()
+            for name, seconds in stall.spans().items(): loop_stall_seconds.inc(seconds, span=name)
+
+    # Watchdog thread: only touches the loop thread's frames and the samples deque (appends are thread-safe)
+    def watch(self) -> None:
+        while not self.stopped.wait(self.interval if not self.stalled() else self.threshold / 10):
+            if not self.stalled(): continue
+
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None: self.samples.append(sample(frame))
+            del frame
+
+    def stalled(self) -> bool: return time.monotonic() - self.beat > self.interval + self.threshold
+
+    def report(self) -> List[str]:
+        since = time.time() - self.window
+        stalls = [stall for stall in self.stalls if stall.at >= since]
+
+        def milliseconds(value: Optional[float]) -> str: return '-' if value is None else '>max' if value == float('inf') else f'<{value * 1000:,.0f}ms'
+        lines = [
+            f'loop lag: p50 {milliseconds(loop_lag_seconds.quantile(0.5))}, p99 {milliseconds(loop_lag_seconds.quantile(0.99))} (threshold {self.threshold * 1000:,.0f}ms)',
+            f'stalls in the last {self.window / 60:,.0f}min: {len(stalls):,}, {sum(stall.seconds for stall in stalls):,.2f}s, longest {max((stall.seconds for stall in stalls), default=0):,.2f}s',
+        ]
+
+        seconds: Dict[str, float] = {}
+        stacks: Dict[str, Tally] = {}
+        for stall in stalls:
+            for name, value in stall.spans().items(): seconds[name] = seconds.get(name, 0) + value
+            for (name, stack), count in stall.samples.items(): stacks.setdefault(name, Tally())[stack] += count
+
+        for name, value in sorted(seconds.items(), key=lambda item: item[1], reverse=True):
+            lines.append(f'{name}: {value:,.2f}s')
+            for stack, count in stacks.get(name, Tally()).most_common(3):
+                lines.append(f'  {count}x {" < ".join(stack)}')
+        return lines
+
+monitor: Optional[LoopMonitor] = None
+
+def start_monitor() -> Optional[LoopMonitor]:
+    global monitor
+    if os.environ.get("BOT_LOOP_MONITOR", "0") != "1" or monitor is not None: return monitor
+
+    monitor = LoopMonitor(threshold=float(os.environ.get("BOT_LOOP_MONITOR_THRESHOLD", 0.1)), window=float(os.environ.get("BOT_LOOP_MONITOR_WINDOW", 3600)))
+    monitor.start()
+    print(f'Monitoring event loop lag (threshold {monitor.threshold * 1000:,.0f}ms)')
+    return monitor
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import deque
+from concurrent.futures import Executor
+from itertools import islice
+from dataclasses import dataclass
+from types import ModuleType, FunctionType
+from typing import Dict, Tuple, Optional, Any, Iterable, Set, List, Sequence, Callable
+
+from discord import Intents, MemberCacheFlags, Client, Guild, Member, Message
+from discord.state import ConnectionState
+
+from cache import Cache
+
+# Which gateway intents each event handler needs (https://discordpy.readthedocs.io/en/latest/api.html#discord.Intents)
+EVENT_INTENTS: Dict[str, Tuple[str, ...]] = {
+    'on_message': ('guild_messages', 'dm_messages'),
+    'on_raw_message_edit': ('guild_messages', 'dm_messages'),
+    'on_raw_message_delete': ('guild_messages', 'dm_messages'),
+    'on_raw_bulk_message_delete': ('guild_messages',),
+    'on_raw_reaction_add': ('guild_reactions', 'dm_reactions'),
+    'on_raw_reaction_remove': ('guild_reactions', 'dm_reactions'),
+    'on_raw_reaction_clear': ('guild_reactions', 'dm_reactions'),
+    'on_raw_reaction_clear_emoji': ('guild_reactions', 'dm_reactions'),
+    'on_member_join': ('members',),
+    'on_raw_member_remove': ('members',),
+    'on_member_update': ('members',),
+    'on_user_update': ('members',),
+    'on_member_ban': ('moderation',),
+    'on_member_unban': ('moderation',),
+    'on_audit_log_entry_create': ('moderation',),
+    'on_presence_update': ('presences',),
+    'on_thread_member_join': ('members',),
+    'on_thread_member_remove': ('members',),
+    'on_raw_thread_member_remove': ('members',),
+    'on_integration_create': ('integrations',),
+    'on_integration_update': ('integrations',),
+    'on_guild_integrations_update': ('integrations',),
+    'on_raw_integration_delete': ('integrations',),
+    'on_webhooks_update': ('webhooks',),
+    'on_scheduled_event_create': ('guild_scheduled_events',),
+    'on_scheduled_event_delete': ('guild_scheduled_events',),
+    'on_scheduled_event_update': ('guild_scheduled_events',),
+    'on_scheduled_event_user_add': ('guild_scheduled_events',),
+    'on_scheduled_event_user_remove': ('guild_scheduled_events',),
+    'on_guild_emojis_update': ('emojis_and_stickers',),
+    'on_guild_stickers_update': ('emojis_and_stickers',),
+    'on_invite_create': ('invites',),
+    'on_invite_delete': ('invites',),
+    'on_voice_state_update': ('voice_states',),
+    'on_typing': ('guild_typing', 'dm_typing'),
+    # Channels, threads, roles, stages and the guild events themselves only need 'guilds', which is always on
+}
+
+# Which intents keep a cache view (cache.members, ...) up-to-date
+VIEW_INTENTS: Dict[str, Tuple[str, ...]] = {
+    'messages': ('guild_messages', 'message_content'),
+    'reactions': ('guild_reactions',),
+    'reactors': ('guild_reactions',),
+    'members': ('members',),
+    'users': ('members',),
+}
+
+# Handlers discord.py only dispatches for members it has cached (a GUILD_MEMBER_UPDATE/PRESENCE_UPDATE for one it doesn't
+# hold is dropped), with any of these its member cache stays on, filled by chunking at startup
+MEMBER_CACHE_HANDLERS: Tuple[str, ...] = ('on_member_update', 'on_user_update', 'on_presence_update')
+
+# Commands: '$' prefix (message content), and emoji lookups through the guild's emojis
+COMMAND_INTENTS: Tuple[str, ...] = ('guilds', 'guild_messages', 'message_content', 'emojis_and_stickers')
+
+# What discord.py caches itself, next to our Cache
+@dataclass
+class MemoryProfile:
+    name: str
+    intents: Intents
+    member_cache_flags: MemberCacheFlags
+    chunk_guilds_at_startup: bool
+    max_messages: Optional[int]
+
+    def kwargs(self) -> Dict[str, Any]:
+        return dict(intents=self.intents, member_cache_flags=self.member_cache_flags, chunk_guilds_at_startup=self.chunk_guilds_at_startup, max_messages=self.max_messages)
+
+    # discord.py's defaults
+    @staticmethod
+    def full() -> MemoryProfile:
+        intents = Intents.all()
+        return MemoryProfile(name='full', intents=intents, member_cache_flags=MemberCacheFlags.from_intents(intents), chunk_guilds_at_startup=intents.members, max_messages=1000)
+
+    # Only the intents the handlers/views need, and our Cache is the only one holding messages (and members, unless a
+    # handler needs discord.py's member cache)
+    @staticmethod
+    def lean(client_class: type, views: Iterable[str]) -> MemoryProfile:
+        handlers = [name for name in EVENT_INTENTS if name in vars(client_class)]
+        flags = {*COMMAND_INTENTS, *(flag for handler in handlers for flag in EVENT_INTENTS[handler]), *(flag for view in views for flag in VIEW_INTENTS.get(view, ()))}
+        intents = Intents(**{flag: True for flag in flags})
+        members = any(handler in MEMBER_CACHE_HANDLERS for handler in handlers)
+
+        return MemoryProfile(
+            name='lean', intents=intents,
+            member_cache_flags=MemberCacheFlags.from_intents(intents) if members else MemberCacheFlags.none(), chunk_guilds_at_startup=members and intents.members,
+            max_messages=None,
+        )
+
+    def report(self, client: Client) -> str:
+        full = MemoryProfile.full()
+        guilds = [guild for guild in client.guilds if not guild.unavailable]
+        members = sum(map(lambda guild: guild.member_count or 0, guilds))
+        cached_members = sum(map(lambda guild: len(guild.members), guilds))
+        cached_messages = len(client.cached_messages)
+
+        member_size, message_size = sample_sizes(client, next(iter(guilds), None))
+        saved_members = 0 if self.member_cache_flags.joined else max(0, members - cached_members)
+        saved_messages = max(0, full.max_messages - (self.max_messages or 0))
+        disabled = ", ".join(sorted(flag for flag, enabled in full.intents if enabled and not getattr(self.intents, flag)))
+
+        return (
+            f'Memory profile "{self.name}":'
+            f' discord.py holds {cached_members:,}/{members:,} members and {cached_messages:,} messages'
+            f', saving ~{(saved_members * member_size + saved_messages * message_size) / 1024 / 1024:,.1f}MB'
+            f' ({saved_members:,} members * {member_size:,}B, {saved_messages:,} messages * {message_size:,}B)'
+            f' compared to "{full.name}"'
+            f'{f" (intents off: {disabled})" if disabled else ""}'
+        )
+
+# Objects shared across everything, a deep size shouldn't include these (nor what they lead to: the loop, pools, ...)
+SHARED = (ConnectionState, Client, Guild, ModuleType, type, FunctionType, asyncio.AbstractEventLoop, asyncio.Event, asyncio.Future, Executor) # Tasks are futures
+
+def deep_size(obj: Any, seen: Optional[Set[int]] = None) -> int:
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, SHARED): return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict): return size + sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset, deque)): return size + sum(deep_size(item, seen) for item in obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None: return size
+
+    if hasattr(obj, '__dict__'): size += deep_size(vars(obj), seen)
+    for cls in type(obj).__mro__:
+        for attr in getattr(cls, '__slots__', ()):
+            if hasattr(obj, attr): size += deep_size(getattr(obj, attr), seen)
+
+    return size
+
+# Bytes for one (minimal) member/message as discord.py would cache them
+def sample_sizes(client: Client, guild: Optional[Guild]) -> Tuple[int, int]:
+    if guild is None: return 0, 0
+
+    user = {'id': '0', 'username': '', 'discriminator': '0', 'avatar': None}
+    member = Member(data={'user': user, 'roles': [], 'joined_at': None, 'deaf': False, 'mute': False, 'flags': 0}, guild=guild, state=client._connection)
+    channel = next(iter(guild.text_channels), None)
+    if channel is None: return deep_size(member), 0
+
+    message = Message(state=client._connection, channel=channel, data={
+        'id': '0', 'channel_id': str(channel.id), 'author': user, 'content': '', 'timestamp': '2015-01-01T00:00:00+00:00', 'edited_timestamp': None,
+        'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0,
+    })
+    return deep_size(member), deep_size(message)
+
+# Per-entity memory accounting, for $memory: deep sizes sampled per partition of the cache (by type: Message, Reactors,
+# Event, RawEvent, Member, ...), per mirror, and of discord.py's own state, extrapolated to their counts. Also diffs
+# tracemalloc snapshots by allocation site (tracing starts with the first report, the next ones show the growth since).
+# Measured in a background thread: it only copies (atomic) lists of references off the structures the loop mutates, a
+# partition that changed size while being walked anyway is skipped for that report.
+
+SAMPLE = 200 # Objects deep-sized per partition
+
+@dataclass
+class Partition:
+    name: str
+    entries: int
+    bytes: int
+
+    @property
+    def per_entry(self) -> float: return self.bytes / self.entries if self.entries else 0
+
+def sampled_size(objects: Sequence[Any], sample: int = SAMPLE) -> int:
+    if not objects: return 0
+    sampled = objects if len(objects) <= sample else random.sample(objects, sample)
+    return int(sum(deep_size(obj, set()) for obj in sampled) / len(sampled) * len(objects))
+
+# Large containers from a sample of their items
+def estimate_size(obj: Any, sample: int = SAMPLE) -> int:
+    if isinstance(obj, dict) and len(obj) > sample: return sys.getsizeof(obj) + sampled_size(list(obj.items()), sample)
+    if isinstance(obj, (list, tuple, set, frozenset, deque)) and len(obj) > sample: return sys.getsizeof(obj) + sampled_size(list(obj), sample)
+    return deep_size(obj)
+
+# Measurements by name, each run (and skipped when what it walks changed meanwhile) on its own
+Measurement = Tuple[str, Callable[[], List[Partition]]]
+
+def cache_partitions(cache: Cache, sample: int = SAMPLE) -> List[Measurement]:
+    def types() -> List[Partition]:
+        counts: Dict[str, int] = {}
+        samples: Dict[str, List[Any]] = {}
+        for entry in cache.objects.entries(): # Reservoir sample per type
+            name = getattr(entry.current, 'type_name', type(entry.current).__name__)
+            count = counts[name] = counts.get(name, 0) + 1
+            if count <= sample: samples.setdefault(name, []).append(entry)
+            elif (index := random.randrange(count)) < sample: samples[name][index] = entry
+
+        return [Partition(f'cache {name}', count, int(sum(deep_size(entry, set()) for entry in samples[name]) / len(samples[name]) * count)) for name, count in counts.items()]
+
+    # The storage itself (MemoryCache: the slots, their sequences and the indexes), and what's remembered for deduplication
+    def storage() -> List[Partition]:
+        storage = [getattr(cache.objects, attr) for attr in ('_entries', '_sequences', '_index', '_sequence_of', '_by_message') if hasattr(cache.objects, attr)]
+        return [Partition('cache storage', len(getattr(cache.objects, '_index', ())), sum(map(sys.getsizeof, storage)))] if storage else []
+    def seen() -> List[Partition]:
+        return [] if cache.objects.seen is None else [Partition('cache seen', len(cache.objects.seen.versions), estimate_size(cache.objects.seen.versions, sample))]
+
+    def mirror(mirror: Cache) -> Measurement:
+        def measure() -> List[Partition]:
+            values = [value for value in list(vars(mirror).values()) if not isinstance(value, Cache)] # Not the cache it serves
+            return [Partition(f'mirror {type(mirror).__name__}', max((len(value) for value in values if isinstance(value, (dict, list, set, deque))), default=0), sum(estimate_size(value, sample) for value in values))]
+        return f'mirror {type(mirror).__name__}', measure
+
+    return [('cache', types), ('cache storage', storage), ('cache seen', seen), *map(mirror, cache.objects.mirrors or [])]
+
+def discord_partitions(client: Client, sample: int = SAMPLE) -> List[Measurement]:
+    state = client._connection
+    objects = {
+        'users': lambda: list(state._users.values()),
+        'members': lambda: [member for guild in list(state._guilds.values()) for member in list(guild._members.values())],
+        'messages': lambda: list(state._messages or ()),
+        'channels': lambda: [channel for guild in list(state._guilds.values()) for channel in (*guild._channels.values(), *guild._threads.values())],
+        'emojis': lambda: list(state._emojis.values()),
+    }
+
+    def measurement(name: str, values: Callable[[], List[Any]]) -> Measurement:
+        def measure() -> List[Partition]:
+            listed = values()
+            return [Partition(f'discord.py {name}', len(listed), sampled_size(listed, sample))]
+        return f'discord.py {name}', measure
+
+    return [measurement(name, values) for name, values in objects.items()]
+
+class MemoryAccounting:
+
+    def __init__(self, sample: int = SAMPLE, frames: int = 1):
+        self.sample = sample
+        self.frames = frames # Of the allocation sites tracemalloc keeps
+        self.previous: Optional[Tuple[float, Dict[str, Partition]]] = None
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.lock = asyncio.Lock()
+
+    async def report(self, client: Client, cache: Cache) -> List[str]:
+        async with self.lock:
+            return await asyncio.to_thread(self.measure, client, cache)
+
+    def stop_tracing(self) -> None:
+        tracemalloc.stop()
+        self.snapshot = None
+
+    def measure(self, client: Client, cache: Cache) -> List[str]:
+        def megabytes(value: float) -> str: return f'{value / 1024 / 1024:,.1f}MB'
+
+        start, at = time.perf_counter(), time.monotonic()
+        partitions: List[Partition] = []
+        skipped: List[str] = []
+        for name, measure in (*cache_partitions(cache, self.sample), *discord_partitions(client, self.sample)):
+            try:
+                partitions.extend(measure())
+            except RuntimeError: # Changed size during iteration
+                skipped.append(name)
+
+        previous_at, previous = self.previous or (at, {})
+        self.previous = at, {partition.name: partition for partition in partitions}
+
+        lines = [f'estimated total: {megabytes(sum(partition.bytes for partition in partitions))}']
+        if skipped: lines.append(f'skipped (changed while measuring): {", ".join(skipped)}')
+        for partition in sorted(partitions, key=lambda partition: partition.bytes, reverse=True):
+            growth = f', {(partition.bytes - previous[partition.name].bytes) / (at - previous_at) / 1024:+,.1f}KB/s' if partition.name in previous and at > previous_at else ''
+            lines.append(f'{partition.name}: {partition.entries:,} entries, {megabytes(partition.bytes)}, {partition.per_entry:,.0f}B/entry{growth}')
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.snapshot = tracemalloc.take_snapshot() # Baseline: (next to) nothing traced yet
+            lines.append('tracemalloc: started, allocation growth from the next report on ($memory off stops it)')
+        else:
+            snapshot = tracemalloc.take_snapshot() # Holds the GIL while it copies the traces, the rest doesn't
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f'tracemalloc: {megabytes(current)} traced, peak {megabytes(peak)}')
+            if self.snapshot is not None:
+                stats = (stat for stat in snapshot.compare_to(self.snapshot, 'lineno') if stat.traceback[0].filename != tracemalloc.__file__) # Filtering the traces first is much slower
+                for stat in islice(stats, 10):
+                    frame = stat.traceback[0]
+                    lines.append(f'  {os.path.basename(frame.filename)}:{frame.lineno}: {stat.size_diff / 1024:+,.1f}KB ({stat.count_diff:+,} blocks), {stat.size / 1024:,.1f}KB')
+            self.snapshot = snapshot
+
+        lines.append(f'measured in {time.perf_counter() - start:,.2f}s')
+        return lines
@@ -0,0 +1,259 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Tuple, Callable, Optional, List, Iterator, Any
+
+from discord import HTTPException
+from discord.http import HTTPClient, Route
+
+# Process-wide counters, gauges and latency histograms. Hot paths record into the module `registry`, which is exported
+# as Prometheus text on localhost (BOT_METRICS_PORT), as a periodic JSON dump (BOT_METRICS_FILE), and through $stats.
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def labels_of(labels: Dict[str, Any]) -> Labels: return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def format_labels(labels: Labels) -> str:
+    def escape(value: str) -> str: return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    if not labels: return ''
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        raise NotImplementedError
+    def to_dict(self) -> Dict[str, Any]:
+        return {format_labels(labels) or '{}': value for name, labels, value in self.samples()}
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = labels_of(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+    def get(self, **labels: Any) -> float: return self.values.get(labels_of(labels), 0)
+    def total(self) -> float: return sum(self.values.values())
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for labels, value in self.values.items(): yield self.name, labels, value
+
+# Either set directly, or tracked: read from a function whenever it's exported
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Labels, float] = {}
+        self.functions: Dict[Labels, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: Any) -> None: self.values[labels_of(labels)] = value
+    def track(self, func: Callable[[], float], **labels: Any) -> None: self.functions[labels_of(labels)] = func
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for labels, value in self.values.items(): yield self.name, labels, value
+        for labels, func in self.functions.items(): yield self.name, labels, func()
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    class Series:
+        def __init__(self, buckets: int):
+            self.counts = [0] * (buckets + 1) # Last one is +Inf
+            self.sum = 0.0
+            self.count = 0
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        self.series: Dict[Labels, Histogram.Series] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = labels_of(labels)
+        series = self.series.get(key) or self.series.setdefault(key, Histogram.Series(len(self.buckets)))
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # Upper bound of the bucket the q-th observation falls in, across all label sets when none are given
+    def quantile(self, q: float, **labels: Any) -> Optional[float]:
+        series = [self.series[labels_of(labels)]] if labels else list(self.series.values())
+        counts = [sum(values) for values in zip(*map(lambda series: series.counts, series))] if series else []
+        total = sum(counts)
+        if total == 0: return None
+
+        seen = 0
+        for bound, count in zip((*self.buckets, float('inf')), counts):
+            seen += count
+            if seen >= q * total: return bound
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), series.counts):
+                cumulative += count
+                yield f'{self.name}_bucket', (*labels, ('le', str(bound))), cumulative
+            yield f'{self.name}_sum', labels, series.sum
+            yield f'{self.name}_count', labels, series.count
+    def to_dict(self) -> Dict[str, Any]:
+        return {format_labels(labels) or '{}': dict(count=series.count, sum=series.sum, p50=self.quantile(0.5, **dict(labels)), p99=self.quantile(0.99, **dict(labels))) for labels, series in self.series.items()}
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.started_at = time.time()
+
+    def register(self, metric: Metric) -> Any:
+        return self.metrics.setdefault(metric.name, metric)
+    def counter(self, name: str, help: str) -> Counter: return self.register(Counter(name, help))
+    def gauge(self, name: str, help: str) -> Gauge: return self.register(Gauge(name, help))
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram: return self.register(Histogram(name, help, buckets=buckets))
+
+    def uptime(self) -> float: return time.time() - self.started_at
+
+    # https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+    def prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(f'{name}{format_labels(labels)} {value}' for name, labels, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(timestamp=time.time(), uptime=self.uptime(), metrics={metric.name: metric.to_dict() for metric in self.metrics.values()})
+
+    # Human-readable, for $stats
+    def summary(self) -> List[str]:
+        def number(value: float) -> str: return f'{value:,.0f}' if float(value).is_integer() else f'{value:,.2f}'
+        def milliseconds(value: Optional[float]) -> str: return '-' if value is None else '>max' if value == float('inf') else f'<{value * 1000:,.0f}ms'
+
+        lines = [f'uptime: {self.uptime():,.0f}s']
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                for labels, series in metric.series.items():
+                    lines.append(f'{metric.name}{format_labels(labels)}: {series.count:,}x, avg {series.sum / series.count * 1000:,.1f}ms, p50 {milliseconds(metric.quantile(0.5, **dict(labels)))}, p99 {milliseconds(metric.quantile(0.99, **dict(labels)))}')
+                continue
+
+            lines.extend(f'{name}{format_labels(labels)}: {number(value)}' for name, labels, value in metric.samples())
+        return lines
+
+registry = Registry()
+
+# Discord I/O
+discord_requests = registry.counter('discord_requests_total', 'Discord HTTP requests by route and status')
+discord_request_seconds = registry.histogram('discord_request_seconds', 'Discord HTTP request latency, including rate limit waits')
+discord_rate_limits = registry.counter('discord_rate_limits_total', '429s received from Discord (discord.py retries these)')
+
+HISTORY_PATH = '/channels/{channel_id}/messages' # GET on it is one page of channel.history()
+
+# Every route goes through HTTPClient.request, so wrapping it sees all Discord I/O, history pages included
+def instrument_http(http: HTTPClient) -> None:
+    request = http.request
+
+    async def instrumented(route: Route, **kwargs: Any) -> Any:
+        status = '2xx'
+        try:
+            with discord_request_seconds.time(method=route.method, path=route.path):
+                return await request(route, **kwargs)
+        except HTTPException as e:
+            status = e.status
+            raise
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        except BaseException:
+            status = 'error' # Connection errors, timeouts, ...
+            raise
+        finally:
+            discord_requests.inc(method=route.method, path=route.path, status=status)
+
+    http.request = instrumented
+
+# discord.py handles 429s itself and only logs them. A global one is logged twice in a row ("responded with 429", then
+# "Global rate limit"), so a 429 is only counted once the loop moves on, with the scope it turned out to have.
+class RateLimitHandler(logging.Handler):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending: Optional[str] = None
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = record.getMessage()
+        if 'responded with 429' in message:
+            self.flush_pending()
+            self.pending = 'route'
+            try:
+                asyncio.get_running_loop().call_soon(self.flush_pending)
+            except RuntimeError: # Not logged from the loop
+                self.flush_pending()
+        elif 'Global rate limit' in message:
+            if self.pending is None: discord_rate_limits.inc(scope='global')
+            else: self.pending = 'global'
+
+    def flush_pending(self) -> None:
+        if self.pending is not None: discord_rate_limits.inc(scope=self.pending)
+        self.pending = None
+
+def instrument_rate_limits() -> None:
+    logger = logging.getLogger('discord.http')
+    if not any(isinstance(handler, RateLimitHandler) for handler in logger.handlers): logger.addHandler(RateLimitHandler(level=logging.WARNING))
+
+# Exporters
+async def serve(port: int, host: str = '127.0.0.1') -> None:
+    from aiohttp import web # discord.py's own dependency
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(body=registry.prometheus().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    print(f'Serving metrics on http://{host}:{port}/metrics')
+
+async def dump(path: str, interval: float) -> None:
+    file = Path(path)
+    file.parent.mkdir(parents=True, exist_ok=True)
+
+    while True:
+        await asyncio.sleep(interval)
+        temporary = file.with_suffix(f'{file.suffix}.tmp')
+        temporary.write_text(json.dumps(registry.to_dict(), indent=2, default=str))
+        temporary.replace(file) # Readers never see a half-written dump
+
+def start_exporters() -> List[asyncio.Task]:
+    instrument_rate_limits()
+
+    tasks = []
+    if os.environ.get("BOT_METRICS_PORT"): tasks.append(asyncio.create_task(serve(int(os.environ["BOT_METRICS_PORT"]))))
+    if os.environ.get("BOT_METRICS_FILE"): tasks.append(asyncio.create_task(dump(os.environ["BOT_METRICS_FILE"], float(os.environ.get("BOT_METRICS_INTERVAL", 60)))))
+    return tasks
@@ -1,8 +1,14 @@
-import asyncio
+import os
 
-from Client import oauth2_url
+# Only needs a URL, so don't import (and construct) the Client for it
+from discord import Permissions
+from discord.utils import oauth_url
 
-async def generate():
-    print(await oauth2_url())
+# https://discordpy.readthedocs.io/en/latest/api.html#permissions
+default_permissions = Permissions.all()
 
-asyncio.run(generate())
\ No newline at end of file
+def oauth2_url(permissions: Permissions = default_permissions) -> str:
+    return oauth_url(os.environ["DISCORD_CLIENT_ID"], permissions = permissions, scopes = ['bot'])
+
+if __name__ == '__main__':
+    print(oauth2_url())
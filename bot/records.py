@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import sys
+from dataclasses import dataclass, replace, fields
+from datetime import datetime
+from typing import Optional, Tuple, Any, ClassVar, FrozenSet, Iterable, Dict
+
+from discord import Message, Guild, Thread, Member, Reaction, Client
+from discord.abc import GuildChannel
+from discord.user import BaseUser
+from discord.utils import snowflake_time, get
+
+# Compact, immutable snapshots of what we cache. Unlike the live discord.py objects these don't hold on to ._state,
+# .guild, .channel, ... (which pins large parts of discord.py's own caches), foreign keys are just ids.
+# Use `await record.live(client)` (or CacheEntry.live) when an API call needs the actual object.
+
+def intern(value: Optional[str]) -> Optional[str]:
+    return None if value is None else sys.intern(value)
+
+class Record:
+    __slots__ = ()
+    type_name: ClassVar[str]
+
+    @property
+    def created_at(self) -> datetime: return snowflake_time(self.id)
+
+    async def live(self, client: Client) -> Any:
+        raise NotImplementedError
+
+@dataclass(frozen=True, slots=True)
+class GuildRecord(Record):
+    type_name: ClassVar[str] = 'Guild'
+    id: int
+    name: str
+
+    @staticmethod
+    def of(guild: Guild) -> GuildRecord:
+        return GuildRecord(id=guild.id, name=guild.name)
+
+    async def live(self, client: Client) -> Guild:
+        return client.get_guild(self.id) or await client.fetch_guild(self.id)
+
+# Channels, categories, forums and threads; type_name is the discord.py class name (TextChannel, Thread, ...)
+@dataclass(frozen=True, slots=True)
+class ChannelRecord(Record):
+    MESSAGEABLE: ClassVar[FrozenSet[str]] = frozenset({'TextChannel', 'VoiceChannel', 'StageChannel', 'Thread'})
+
+    id: int
+    type_name: str
+    guild_id: Optional[int]
+    name: str
+    parent_id: Optional[int] = None # category, or the channel a thread lives in
+    archived: bool = False
+    last_message_id: Optional[int] = None
+
+    @property
+    def messageable(self) -> bool: return self.type_name in ChannelRecord.MESSAGEABLE
+    @property
+    def mention(self) -> str: return f'<#{self.id}>'
+
+    @staticmethod
+    def of(channel: GuildChannel | Thread) -> ChannelRecord:
+        return ChannelRecord(
+            id=channel.id,
+            type_name=intern(type(channel).__name__),
+            guild_id=channel.guild.id if channel.guild else None,
+            name=channel.name,
+            parent_id=getattr(channel, 'parent_id', None) if isinstance(channel, Thread) else getattr(channel, 'category_id', None),
+            archived=getattr(channel, 'archived', False),
+            last_message_id=getattr(channel, 'last_message_id', None),
+        )
+
+    async def live(self, client: Client) -> GuildChannel | Thread:
+        return client.get_channel(self.id) or await client.fetch_channel(self.id)
+
+@dataclass(frozen=True, slots=True)
+class UserRecord(Record):
+    type_name: ClassVar[str] = 'User'
+    id: int
+    name: str
+    bot: bool
+
+    @property
+    def mention(self) -> str: return f'<@{self.id}>'
+
+    @staticmethod
+    def of(user: BaseUser) -> UserRecord:
+        return UserRecord(id=user.id, name=user.name, bot=user.bot)
+
+    async def live(self, client: Client) -> BaseUser:
+        return client.get_user(self.id) or await client.fetch_user(self.id)
+
+@dataclass(frozen=True, slots=True)
+class MemberRecord(Record):
+    type_name: ClassVar[str] = 'Member'
+    id: int
+    guild_id: int
+    name: str
+    display_name: str
+    bot: bool
+    joined_at: Optional[datetime] = None
+
+    @property
+    def mention(self) -> str: return f'<@{self.id}>'
+
+    @staticmethod
+    def of(member: Member) -> MemberRecord:
+        return MemberRecord(id=member.id, guild_id=member.guild.id, name=member.name, display_name=member.display_name, bot=member.bot, joined_at=member.joined_at)
+
+    async def live(self, client: Client) -> Member:
+        guild = client.get_guild(self.guild_id) or await client.fetch_guild(self.guild_id)
+        return guild.get_member(self.id) or await guild.fetch_member(self.id)
+
+# Message fields are denormalized onto the reaction, so reactions can be queried/grouped without the message
+@dataclass(frozen=True, slots=True)
+class ReactionRecord(Record):
+    type_name: ClassVar[str] = 'Reaction'
+    message_id: int
+    channel_id: int
+    guild_id: Optional[int]
+    author_id: int
+    emoji: str # str(reaction.emoji)
+    count: int
+    me: bool
+
+    @property
+    def id(self) -> str: return f'{self.message_id}:{self.emoji}'
+    @property
+    def created_at(self) -> datetime: return snowflake_time(self.message_id)
+
+    @staticmethod
+    def of(reaction: Reaction) -> ReactionRecord:
+        message = reaction.message
+        return ReactionRecord(
+            message_id=message.id,
+            channel_id=message.channel.id,
+            guild_id=message.guild.id if message.guild else None,
+            author_id=message.author.id,
+            emoji=intern(str(reaction.emoji)),
+            count=reaction.count,
+            me=reaction.me,
+        )
+
+    async def live(self, client: Client) -> Optional[Reaction]:
+        message = await MessageRecord(id=self.message_id, channel_id=self.channel_id, guild_id=self.guild_id, author_id=self.author_id, content='').live(client)
+        return next(filter(lambda reaction: str(reaction.emoji) == self.emoji, message.reactions), None)
+
+# Who reacted with an emoji on a message (reaction.users()), kept up-to-date by the reaction events after fetching once
+@dataclass(frozen=True, slots=True)
+class ReactorsRecord(Record):
+    type_name: ClassVar[str] = 'Reactors'
+    message_id: int
+    channel_id: int
+    guild_id: Optional[int]
+    author_id: int
+    emoji: str
+    user_ids: Tuple[int, ...]
+
+    @staticmethod
+    def key(message_id: int, emoji: Any) -> str: return f'{message_id}:{emoji}'
+
+    @property
+    def id(self) -> str: return ReactorsRecord.key(self.message_id, self.emoji)
+    @property
+    def created_at(self) -> datetime: return snowflake_time(self.message_id)
+    @property
+    def count(self) -> int: return len(self.user_ids)
+    @property
+    def self_reacted(self) -> bool: return self.author_id in self.user_ids
+    @property
+    def others(self) -> int: return self.count - self.self_reacted # Reactions, excluding the author's own
+
+    def add(self, user_id: int) -> ReactorsRecord:
+        if user_id in self.user_ids: return self
+        return replace(self, user_ids=(*self.user_ids, user_id))
+    def remove(self, user_id: int) -> ReactorsRecord:
+        return replace(self, user_ids=tuple(filter(lambda id: id != user_id, self.user_ids)))
+
+    @staticmethod
+    def of(reaction: Reaction, user_ids: Iterable[int]) -> ReactorsRecord:
+        reaction_record = ReactionRecord.of(reaction)
+        return ReactorsRecord(
+            message_id=reaction_record.message_id,
+            channel_id=reaction_record.channel_id,
+            guild_id=reaction_record.guild_id,
+            author_id=reaction_record.author_id,
+            emoji=reaction_record.emoji,
+            user_ids=tuple(user_ids),
+        )
+
+    async def live(self, client: Client) -> Optional[Reaction]:
+        return await ReactionRecord(message_id=self.message_id, channel_id=self.channel_id, guild_id=self.guild_id, author_id=self.author_id, emoji=self.emoji, count=self.count, me=False).live(client)
+
+@dataclass(frozen=True, slots=True)
+class MessageRecord(Record):
+    type_name: ClassVar[str] = 'Message'
+    id: int
+    channel_id: int
+    guild_id: Optional[int]
+    author_id: int
+    content: str
+    attachments: Tuple[str, ...] = () # urls
+    edited_at: Optional[datetime] = None
+    reactions: Tuple[ReactionRecord, ...] = ()
+
+    @property
+    def jump_url(self) -> str: return f'https://discord.com/channels/{self.guild_id or "@me"}/{self.channel_id}/{self.id}'
+
+    # Reaction events applied to the counts (delta None: cleared), emoji None: all of them
+    def react(self, emoji: Optional[str], delta: Optional[int]) -> MessageRecord:
+        reactions = {reaction.emoji: reaction for reaction in self.reactions}
+        for key in ([emoji] if emoji is not None else list(reactions)):
+            reaction = reactions.get(key) or ReactionRecord(message_id=self.id, channel_id=self.channel_id, guild_id=self.guild_id, author_id=self.author_id, emoji=intern(key), count=0, me=False)
+            reactions[key] = replace(reaction, count=0 if delta is None else max(0, reaction.count + delta))
+        return replace(self, reactions=tuple(reaction for reaction in reactions.values() if reaction.count > 0))
+    def clear(self, emoji: Optional[str] = None) -> MessageRecord: return self.react(emoji, None)
+
+    @staticmethod
+    def of(message: Message) -> MessageRecord:
+        return MessageRecord(
+            id=message.id,
+            channel_id=message.channel.id,
+            guild_id=message.guild.id if message.guild else None,
+            author_id=message.author.id,
+            content=message.content,
+            attachments=tuple(attachment.url for attachment in message.attachments),
+            edited_at=message.edited_at,
+            reactions=tuple(map(ReactionRecord.of, message.reactions)),
+        )
+
+    async def live(self, client: Client) -> Message:
+        channel = client.get_channel(self.channel_id) or await client.fetch_channel(self.channel_id)
+        return get(client.cached_messages, id=self.id) or await channel.fetch_message(self.id)
+
+def record(obj: Any) -> Any:
+    if isinstance(obj, Record): return obj
+    if isinstance(obj, Message): return MessageRecord.of(obj)
+    if isinstance(obj, Reaction): return ReactionRecord.of(obj)
+    if isinstance(obj, Member): return MemberRecord.of(obj)
+    if isinstance(obj, BaseUser): return UserRecord.of(obj)
+    if isinstance(obj, Guild): return GuildRecord.of(obj)
+    if isinstance(obj, (GuildChannel, Thread)): return ChannelRecord.of(obj)
+    return obj
+
+# Back from CacheEntry.to_dict (what the GitCache stores), None for anything that isn't a record
+RECORDS = {cls.type_name: cls for cls in (GuildRecord, UserRecord, MemberRecord, ReactionRecord, ReactorsRecord, MessageRecord)}
+DATETIMES = frozenset({'joined_at', 'edited_at'})
+
+def from_dict(data: Dict[str, Any]) -> Optional[Record]:
+    cls = ChannelRecord if 'type_name' in data else RECORDS.get(data.get('__type'))
+    if cls is None: return None
+
+    def value(name: str, value: Any) -> Any:
+        if value is None: return None
+        if name in DATETIMES: return datetime.fromisoformat(value) if isinstance(value, str) else value
+        if name == 'reactions': return tuple(map(from_dict, value))
+        if isinstance(value, list): return tuple(value)
+        if isinstance(value, str): return intern(value) if name in ('emoji', 'type_name') else value
+        return value
+
+    return cls(**{field.name: value(field.name, data[field.name]) for field in fields(cls) if field.name in data})
@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Any, List, Tuple, Optional, Iterable, Hashable
+
+from discord import PartialEmoji
+
+from cache import Cache, MemoryCache
+from histogram import ReactionHistogram
+from records import Record, from_dict, intern, MessageRecord, ReactionRecord, ReactorsRecord, MemberRecord
+
+# Rebuilds the cache (and with it the derived views: reaction histograms, leaderboards, member rosters) offline from
+# what the GitCache persisted: the objects, and the events (RawEvents/Events) since. Files are parsed across a process
+# pool, then partitioned by channel (messages, reactors) or guild (members) and each partition is folded in parallel.
+#
+# python3 ./bot/replay.py ./.bot/cache/git [--workers 8] [--output snapshot.jsonl]
+#
+# Snapshots are folded in at the time they were written (the file's mtime): older events are already in them and are
+# overwritten, newer ones apply on top. A fresh checkout sets every mtime to the checkout, so there snapshots win.
+
+Key = Tuple[str, Optional[int]] # ('channel', id) | ('guild', id) | ('other', None)
+Op = Tuple[Any, ...] # (dispatched_at, name, *args)
+
+EPOCH = datetime.min.replace(tzinfo=timezone.utc)
+
+def snowflake(value: Any) -> Optional[int]: return None if value is None else int(value)
+
+def emoji_of(emoji: Any) -> str:
+    if isinstance(emoji, str): return intern(emoji)
+    return intern(str(PartialEmoji(name=emoji.get('name'), id=snowflake(emoji.get('id')), animated=emoji.get('animated', False))))
+
+def message_of(data: Dict[str, Any]) -> MessageRecord:
+    message_id, channel_id, guild_id, author_id = int(data['id']), int(data['channel_id']), snowflake(data.get('guild_id')), int(data['author']['id'])
+    return MessageRecord(
+        id=message_id, channel_id=channel_id, guild_id=guild_id, author_id=author_id,
+        content=data.get('content', ''),
+        attachments=tuple(attachment['url'] for attachment in data.get('attachments', [])),
+        edited_at=None if data.get('edited_timestamp') is None else datetime.fromisoformat(data['edited_timestamp']),
+        reactions=tuple(ReactionRecord(message_id=message_id, channel_id=channel_id, guild_id=guild_id, author_id=author_id, emoji=emoji_of(reaction['emoji']), count=reaction['count'], me=reaction.get('me', False)) for reaction in data.get('reactions', [])),
+    )
+
+def member_of(data: Dict[str, Any]) -> MemberRecord:
+    user = data['user']
+    return MemberRecord(
+        id=int(user['id']), guild_id=int(data['guild_id']), name=user['username'], display_name=data.get('nick') or user.get('global_name') or user['username'],
+        bot=user.get('bot', False), joined_at=None if data.get('joined_at') is None else datetime.fromisoformat(data['joined_at']),
+    )
+
+# Gateway payload (RawEvent) -> the partition it belongs to, and what to do there
+def raw_ops(name: str, at: datetime, data: Dict[str, Any]) -> Iterable[Tuple[Key, Op]]:
+    channel = ('channel', snowflake(data.get('channel_id')))
+    guild = ('guild', snowflake(data.get('guild_id')))
+
+    if name == 'MESSAGE_CREATE': yield channel, (at, 'message', message_of(data))
+    elif name == 'MESSAGE_UPDATE' and 'author' in data: yield channel, (at, 'edit', int(data['id']), data.get('content', ''), None if data.get('edited_timestamp') is None else datetime.fromisoformat(data['edited_timestamp']))
+    elif name == 'MESSAGE_DELETE': yield channel, (at, 'delete', int(data['id']))
+    elif name == 'MESSAGE_DELETE_BULK':
+        for id in data['ids']: yield channel, (at, 'delete', int(id))
+    elif name in ('MESSAGE_REACTION_ADD', 'MESSAGE_REACTION_REMOVE') and not data.get('burst', False):
+        yield channel, (at, 'react', int(data['message_id']), emoji_of(data['emoji']), int(data['user_id']), 1 if name == 'MESSAGE_REACTION_ADD' else -1)
+    elif name == 'MESSAGE_REACTION_REMOVE_ALL': yield channel, (at, 'clear', int(data['message_id']), None)
+    elif name == 'MESSAGE_REACTION_REMOVE_EMOJI': yield channel, (at, 'clear', int(data['message_id']), emoji_of(data['emoji']))
+    elif name in ('GUILD_MEMBER_ADD', 'GUILD_MEMBER_UPDATE'): yield guild, (at, 'member', member_of(data))
+    elif name == 'GUILD_MEMBER_REMOVE': yield guild, (at, 'leave', int(data['user']['id']))
+
+# Event (cached_event, arguments as records/slotted objects) -> the same
+def event_ops(name: str, at: datetime, args: List[Any]) -> Iterable[Tuple[Key, Op]]:
+    if not args or not isinstance(args[0], dict): return
+    arg = args[0]
+
+    if name == 'on_message' and (message := from_dict(arg)) is not None: yield ('channel', message.channel_id), (at, 'message', message)
+    elif name in ('on_raw_reaction_add', 'on_raw_reaction_remove') and not arg.get('burst', False):
+        yield ('channel', arg['channel_id']), (at, 'react', arg['message_id'], emoji_of(arg['emoji']), arg['user_id'], 1 if name == 'on_raw_reaction_add' else -1)
+    elif name == 'on_raw_message_delete': yield ('channel', arg['channel_id']), (at, 'delete', arg['message_id'])
+    elif name in ('on_member_join', 'on_member_update') and (member := from_dict(args[-1])) is not None: yield ('guild', member.guild_id), (at, 'member', member)
+    elif name == 'on_raw_member_remove': yield ('guild', arg['guild_id']), (at, 'leave', arg['user']['id'] if isinstance(arg.get('user'), dict) else arg.get('user_id'))
+
+def partition_of(record: Record) -> Key:
+    if isinstance(record, (MessageRecord, ReactorsRecord)): return 'channel', record.channel_id
+    if isinstance(record, MemberRecord): return 'guild', record.guild_id
+    return 'other', None
+
+# Worker: files -> (partition, op); objects are ops at the time they were written
+def load(paths: List[str]) -> List[Tuple[Key, Op]]:
+    loaded = []
+    for path in paths:
+        try:
+            content = Path(path).read_bytes()
+            data = json.loads(gzip.decompress(content) if path.endswith('.gz') else content)
+        except (OSError, ValueError):
+            print(f'Skipping unreadable {path}')
+            continue
+
+        type = data.get('__type')
+        if type in ('RawEvent', 'Event'):
+            at = datetime.fromisoformat(data['dispatched_at']) if isinstance(data.get('dispatched_at'), str) else EPOCH
+            ops = raw_ops(data['name'], at, data['data']) if type == 'RawEvent' else event_ops(data['name'], at, data.get('args') or [])
+            loaded.extend(ops)
+            continue
+
+        record = from_dict(data)
+        if record is not None: loaded.append((partition_of(record), (datetime.fromtimestamp(os.stat(path).st_mtime, timezone.utc), 'object', record)))
+
+    return loaded
+
+# Worker: one partition's ops, in dispatch order -> its records
+def fold(ops: List[Op]) -> List[Record]:
+    objects: Dict[Hashable, Record] = {}
+    snapshotted = set()
+    reactors: Dict[int, set] = defaultdict(set) # message id -> reactors keys
+
+    def put(record: Record) -> None:
+        objects[record.id] = record
+        if isinstance(record, ReactorsRecord): reactors[record.message_id].add(record.id)
+
+    for at, name, *args in sorted(ops, key=lambda op: op[0]):
+        if name == 'object':
+            put(args[0])
+            if isinstance(args[0], MessageRecord): snapshotted.add(args[0].id)
+        elif name == 'message':
+            if args[0].id not in snapshotted: put(args[0])
+        elif name == 'edit':
+            message_id, content, edited_at = args
+            message = objects.get(message_id)
+            if isinstance(message, MessageRecord) and (message.edited_at is None or (edited_at is not None and edited_at >= message.edited_at)):
+                put(replace(message, content=content, edited_at=edited_at))
+        elif name == 'delete':
+            objects.pop(args[0], None)
+            for key in reactors.pop(args[0], ()): objects.pop(key, None)
+        elif name == 'react':
+            message_id, emoji, user_id, delta = args
+            current = objects.get(ReactorsRecord.key(message_id, emoji))
+            if current is not None: put(current.add(user_id) if delta > 0 else current.remove(user_id))
+
+            message = objects.get(message_id)
+            if isinstance(message, MessageRecord): put(message.react(emoji, delta))
+        elif name == 'clear':
+            message_id, emoji = args
+            for key in list(reactors.get(message_id, ())):
+                if key in objects and (emoji is None or objects[key].emoji == emoji): put(replace(objects[key], user_ids=()))
+
+            message = objects.get(message_id)
+            if isinstance(message, MessageRecord): put(message.clear(emoji))
+        elif name == 'member':
+            put(args[0])
+        elif name == 'leave':
+            objects.pop(args[0], None)
+
+    return list(objects.values())
+
+def chunks(items: List[Any], number: int) -> List[List[Any]]:
+    return [items[index::number] for index in range(number)]
+
+async def replay(directory: str, workers: Optional[int] = None, cache: Optional[Cache] = None) -> Cache:
+    workers = workers or os.cpu_count() or 1
+    cache = cache or MemoryCache(mirrors=[ReactionHistogram()])
+    paths = [str(path) for path in Path(directory).rglob('*.json*') if '.git' not in path.parts and path.name.endswith(('.json', '.json.gz'))]
+
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        partitions: Dict[Key, List[Op]] = defaultdict(list)
+        for loaded in await asyncio.gather(*(loop.run_in_executor(pool, load, chunk) for chunk in chunks(paths, workers * 4) if chunk)):
+            for key, op in loaded: partitions[key].append(op)
+
+        folded = await asyncio.gather(*(loop.run_in_executor(pool, fold, ops) for ops in partitions.values()))
+
+    for records in folded:
+        for record in records: await cache.push(record)
+
+    return cache
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', nargs='?', default=os.environ.get("BOT_CACHE_GIT_DIRECTORY", './.bot/cache/git'))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='Write the rebuilt objects as JSON lines')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    cache = asyncio.run(replay(args.directory, workers=args.workers))
+    print(f'Replayed {args.directory} in {time.perf_counter() - start:.2f}s: {cache.messages.count():,} messages, {cache.reactors.count():,} reactors, {cache.members.count():,} members, {cache.count():,} objects')
+
+    histogram = cache.mirror(ReactionHistogram)
+    emojis = sorted({key[0] for key in histogram.days if key[1] is None}, key=lambda emoji: -histogram.total(emoji))
+    for emoji in emojis[:10]: print(f'{emoji}: {histogram.total(emoji):,}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            for entry in cache.entries(): print(json.dumps(entry.to_dict(), sort_keys=True, default=str), file=file)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import functools
+import os
+import traceback
+from asyncio import Event, Task, create_task
+from collections import deque
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Callable, Awaitable, Any, Deque, Dict, Optional, Tuple, List, TYPE_CHECKING
+
+from metrics import registry
+
+if TYPE_CHECKING:
+    from cache import FunctionQueue
+
+class Priority(IntEnum):
+    INTERACTIVE = 0 # Someone is waiting on it: /count reaction, ...
+    BACKGROUND = 1 # Backfills, ...
+
+# What the running function (and the tasks it starts) was queued as, so that lower layers (the HTTP client) can tell
+# background work apart
+current_priority: ContextVar[Priority] = ContextVar('current_priority', default=Priority.INTERACTIVE)
+
+# Process-wide: every FunctionQueue submits here, since they all compete for the same Discord rate limits.
+# Requests are served round-robin within a priority class, and a single request can't hold more than `per_request`
+# workers, so a small request isn't stuck behind a guild-wide crawl.
+class Scheduler:
+
+    def __init__(self, workers: int, per_request: int, background: int):
+        self.workers = workers
+        self.per_request = per_request
+        self.background = background # Max workers background requests may hold, keeps room for interactive ones
+
+        self.requests: Dict[Priority, Deque[FunctionQueue]] = {priority: deque() for priority in Priority}
+        self.tasks: List[Task] = []
+        self.changed = Event()
+        self.busy = 0 # Workers currently running something
+        self.interactive_idle = Event() # No interactive work queued or running, background work waits on it
+        self.interactive_idle.set()
+
+    def submit(self, request: FunctionQueue) -> None:
+        ring = self.requests[request.priority]
+        if request not in ring: ring.append(request)
+
+        if not self.tasks: self.tasks = [create_task(self.work()) for i in range(self.workers)]
+        self.changed.set()
+        self.update()
+
+    def update(self) -> None:
+        if self.running(Priority.INTERACTIVE) or self.pending(Priority.INTERACTIVE): self.interactive_idle.clear()
+        else: self.interactive_idle.set()
+
+    def running(self, priority: Priority) -> int:
+        return sum(map(lambda request: len(request.running), self.requests[priority]))
+    def pending(self, priority: Priority) -> int:
+        return sum(map(lambda request: len(request.pending), self.requests[priority]))
+
+    def next(self) -> Optional[Tuple[FunctionQueue, Callable[[], Awaitable[Any]]]]:
+        for priority in Priority:
+            ring = self.requests[priority]
+            for request in [request for request in ring if not request.pending and not request.running]: ring.remove(request)
+
+            if priority == Priority.BACKGROUND and self.running(priority) >= self.background: continue
+
+            for i in range(len(ring)):
+                request = ring[0]
+                ring.rotate(-1)
+
+                if request.pending and len(request.running) < self.per_request:
+                    return request, request.pending.popleft()
+
+        return None
+
+    async def work(self):
+        while True:
+            picked = self.next()
+            if picked is None:
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+
+            request, func = picked
+            self.busy += 1
+            try:
+                await request.run(func)
+            finally:
+                self.busy -= 1
+            self.changed.set() # Might have freed up a slot for a request
+            self.update()
+
+    def cancel(self, request: FunctionQueue) -> None:
+        ring = self.requests[request.priority]
+        if request in ring: ring.remove(request)
+        self.update()
+
+scheduler = Scheduler(
+    workers=int(os.environ.get("BOT_SCHEDULER_WORKERS", 8)),
+    per_request=int(os.environ.get("BOT_SCHEDULER_PER_REQUEST", 3)),
+    background=int(os.environ.get("BOT_SCHEDULER_BACKGROUND", 2)),
+)
+
+scheduler_pending = registry.gauge('bot_scheduler_pending', 'Functions queued, not yet running')
+scheduler_running = registry.gauge('bot_scheduler_running', 'Functions running')
+scheduler_requests = registry.gauge('bot_scheduler_requests', 'Requests (FunctionQueues) with work')
+scheduler_utilisation = registry.gauge('bot_scheduler_utilisation', 'Share of the workers that are busy')
+task_seconds = registry.histogram('bot_task_seconds', 'Duration of a queued function')
+task_failures = registry.counter('bot_task_failures_total', 'Queued functions and workers that raised')
+
+for priority in Priority:
+    scheduler_pending.track(functools.partial(scheduler.pending, priority), priority=priority.name.lower())
+    scheduler_running.track(functools.partial(scheduler.running, priority), priority=priority.name.lower())
+    scheduler_requests.track(functools.partial(lambda priority: len(scheduler.requests[priority]), priority), priority=priority.name.lower())
+scheduler_utilisation.track(lambda: scheduler.busy / scheduler.workers)
+
+def log_failure(task: Task) -> None:
+    if task.cancelled() or task.exception() is None: return
+
+    task_failures.inc(error=type(task.exception()).__name__)
+    print(f"Task failed with error: {task.exception()}")
+    print("".join(traceback.format_exception(task.exception())))